@@ -0,0 +1,32 @@
+from fast_autocomplete import AutoComplete
+from itertools import chain
+from threading import Lock
+from toolz import unique
+from typing import Iterable
+
+
+class Autocompleter:
+    # Completes and corrects terms to the lemmas of the words in a vocabulary by way of fast_autocomplete, mapping the
+    # other forms of each lemma (its synonyms) to it. fast_autocomplete keeps its results in a cache of its own and hands
+    # them out as they are, so that searches are made one at a time and their results are copied before being returned.
+    # Words less than max_cost edits away from a term are taken as misspellings of it, as fast_autocomplete counts them:
+    # at the default of 1, only the words reached by completing the longest prefix of the term found among the words.
+    def __init__(self, synonyms: dict[str, Iterable[str]], max_cost: int = 1) -> None:
+        synonyms = {lemma: tuple(words) for lemma, words in synonyms.items()}
+        self.__autocomplete = AutoComplete(words=dict.fromkeys(synonyms.keys(), {}), synonyms=synonyms)
+        self.__lock = Lock()
+        self.__max_cost = max_cost
+        self.__word_count = len(set(chain(synonyms.keys(), chain.from_iterable(synonyms.values()))))
+
+    @property
+    def stats(self) -> dict:
+        return {'words': self.__word_count}
+
+    def search(self, term: str, size: int = 3) -> list[str]:
+        # Returns the lemmas of up to size matches, each a list of one or more words.
+        with self.__lock:
+            matches = self.__autocomplete.search(term, max_cost=self.__max_cost, size=size)
+        return list(unique(chain.from_iterable(matches)))
+
+
+__all__ = ('Autocompleter',)
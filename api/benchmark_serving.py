@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from os.path import abspath, dirname, join
+import random
+import re
+import signal
+import subprocess
+import sys
+from time import monotonic, sleep
+from typing import Iterable, Optional
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+from memory import get_page_usage, get_process_tree
+from repositories import ProductRepository
+
+# Gunicorn configurations compared by default, as workers × threads: one sync worker per core, a few gthread workers
+# with many threads each, and a single gthread worker serving everything
+DEFAULT_CONFIGURATIONS = (f'{os.cpu_count()}x1', f'{max(os.cpu_count() // 4, 1)}x8', '1x16')
+
+
+def get_memory_usage(process_id: int) -> int:
+    # The proportional set size, in bytes, of a process and all its descendants: pages shared between processes, as
+    # those of the indexes are between the workers of a preloaded app until they are written to, are split among them.
+    return sum(get_page_usage(process_id).get('pss', 0) for process_id in get_process_tree(process_id))
+
+
+def _request_suggestions(url: str, basket: list[int]) -> float:
+    start = monotonic()
+    with urlopen(Request(url, json.dumps({'basket': basket}).encode(), {'Content-Type': 'application/json'})) \
+            as response:
+        response.read()
+    return monotonic() - start
+
+
+def run_load(url: str, baskets: list[list[int]], client_count: int, duration: float) -> list[float]:
+    # Sends the baskets over and over from client_count clients at once for duration seconds, and returns the latency
+    # of each request.
+    deadline = monotonic() + duration
+
+    def run_client(client: int) -> list[float]:
+        latencies = []
+        for index in range(client, sys.maxsize, client_count):
+            if monotonic() > deadline:
+                return latencies
+            latencies.append(_request_suggestions(url, baskets[index % len(baskets)]))
+
+    with ThreadPoolExecutor(client_count) as executor:
+        return sorted(latency for latencies in executor.map(run_client, range(client_count)) for latency in latencies)
+
+
+def benchmark(model_directory: str, configuration: str, baskets: list[list[int]], client_count: int,
+              duration: float, port: int) -> dict:
+    # Starts gunicorn serving the model in model_directory with the configuration, given as workers × threads, loads
+    # it, and reports its throughput, latencies and memory usage.
+    worker_count, thread_count = map(int, configuration.split('x'))
+    server = subprocess.Popen(['gunicorn', '-b', f'127.0.0.1:{port}', '--chdir', model_directory,
+                               '--pythonpath', dirname(abspath(__file__)), '--workers', str(worker_count),
+                               '--threads', str(thread_count), '--preload', 'main:flask_app'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}/api/suggestion'
+    try:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f'gunicorn exited with {server.returncode}.')
+            try:
+                _request_suggestions(url, [])
+                break
+            except (ConnectionError, URLError):
+                sleep(0.5)
+        run_load(url, baskets, client_count, 1)  # Warms up every worker.
+        latencies = run_load(url, baskets, client_count, duration)
+        return {'configuration': configuration,
+                'worker_class': 'sync' if thread_count == 1 else 'gthread',
+                'requests_per_second': len(latencies) / duration,
+                'median_latency': latencies[len(latencies) // 2],
+                'p99_latency': latencies[len(latencies) * 99 // 100],
+                'memory': get_memory_usage(server.pid)}
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+def _parse_args() -> tuple[str, tuple[str, ...], int, float, int, int, Optional[int]]:
+    parser = ArgumentParser(description='Compares the throughput, latency and memory usage of the API server under'
+                                        ' gunicorn with sync workers and with gthread workers.')
+    parser.add_argument('--directory', metavar='PATH', action='store', type=str, default='.',
+                        help='the directory holding the model (products.tsv and suggestions.npz) to serve')
+    parser.add_argument('--configurations', metavar='WORKERSxTHREADS', action='store', type=str, nargs='+',
+                        default=DEFAULT_CONFIGURATIONS,
+                        help=f'the gunicorn configurations to compare (defaults to {" ".join(DEFAULT_CONFIGURATIONS)});'
+                             f' configurations with a single thread per worker use sync workers')
+    parser.add_argument('--clients', metavar='COUNT', action='store', type=int, default=16,
+                        help='the number of clients sending requests at once')
+    parser.add_argument('--duration', metavar='SECONDS', action='store', type=float, default=10,
+                        help='how long to load each configuration for')
+    parser.add_argument('--port', metavar='PORT', action='store', type=int, default=5099,
+                        help='the port to serve on while benchmarking')
+    parser.add_argument('--basket-size', metavar='COUNT', action='store', type=int, default=5,
+                        help='the largest number of items in the random baskets requested')
+    parser.add_argument('--seed', metavar='SEED', action='store', type=int, required=False,
+                        help='the seed to draw the random baskets with')
+    args = parser.parse_args()
+    for configuration in args.configurations:
+        if not re.fullmatch(r'[1-9]\d*x[1-9]\d*', configuration):
+            parser.error(f'invalid configuration {configuration!r}: expected WORKERSxTHREADS, such as 4x1 or 2x8')
+    return abspath(args.directory), tuple(args.configurations), args.clients, args.duration, args.port, \
+           args.basket_size, args.seed
+
+
+def _print_results(results: Iterable[dict]) -> None:
+    print(f'{"Configuration":<15}{"Workers":<10}{"Requests/s":>12}{"Median":>12}{"p99":>12}{"Memory":>12}')
+    for result in results:
+        print(f'{result["configuration"]:<15}{result["worker_class"]:<10}{result["requests_per_second"]:>12,.1f}'
+              f'{result["median_latency"] * 1000:>10.1f}ms{result["p99_latency"] * 1000:>10.1f}ms'
+              f'{result["memory"] / (1 << 20):>10,.0f}MB')
+
+
+def run() -> None:
+    directory, configurations, client_count, duration, port, basket_size, seed = _parse_args()
+    product_count = len(ProductRepository(join(directory, 'products.tsv')).get_all_products()[0])
+    generator = random.Random(seed)
+    baskets = [generator.sample(range(product_count), generator.randint(1, min(basket_size, product_count)))
+               for _ in range(10_000)]
+    results = []
+    for configuration in configurations:
+        print(f'Benchmarking {configuration}…')
+        results.append(benchmark(directory, configuration, baskets, client_count, duration, port))
+    _print_results(results)
+
+
+__all__ = ('benchmark', 'get_memory_usage', 'run_load')
+
+
+if __name__ == '__main__':
+    run()
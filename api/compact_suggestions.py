@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser, ArgumentTypeError
+from functools import cache, partial
+from itertools import chain, groupby, islice, repeat
+import numpy as np
+from os import remove, replace
+from os.path import abspath, exists, split
+import random
+import sys
+from tempfile import NamedTemporaryFile
+from toolz import thread_last as thread, unique
+from typing import Callable, Iterable, Optional
+from models import Suggestion
+from repositories import MAX_ANTECEDENT_ITEMS, ProductRepository, SuggestionRepository
+from services import ProductLookupService, RANKING_METRICS
+
+# The number of suggestions returned per request by ProductLookupService.get_suggestions
+SUGGESTIONS_PER_REQUEST = 10
+
+# Sort keys for the order suggestions are ranked in by each metric the API server ranks by: lift, as the suggestions
+# themselves sort, and confidence and support, after which the suggestions without antecedent items follow
+_RANK_KEYS: tuple[Callable[[Suggestion], tuple], ...] = \
+    (lambda suggestion: (False, suggestion),
+     lambda suggestion: (not suggestion.antecedent_items, -suggestion.confidence, suggestion),
+     lambda suggestion: (not suggestion.antecedent_items, -suggestion.support, suggestion))
+
+
+def _take_top_consequents(suggestions: Iterable[Suggestion], count: int) -> Iterable[Suggestion]:
+    # Keeps every suggestion for the first `count` distinct consequent items in rank order.
+    consequent_items = frozenset(thread(suggestions := tuple(suggestions),
+                                        (map, lambda suggestion: suggestion.consequent_item),
+                                        unique,
+                                        lambda consequent_items: islice(consequent_items, count)))
+    return filter(lambda suggestion: suggestion.consequent_item in consequent_items, suggestions)
+
+
+def compact(suggestions: Iterable[np.ndarray], max_antecedent_items: Optional[int] = MAX_ANTECEDENT_ITEMS,
+            top_per_antecedent_items: Optional[int] = None) -> list[np.ndarray]:
+    # Rules with more antecedent items than the server ever loads are dropped outright. Trimming each set of antecedent
+    # items to its top N consequents by lift leaves responses ranked by lift without a text query unchanged only as
+    # long as the basket, along with the products off sale, holds at most N − 10 items beyond the matched antecedent
+    # items. Responses to text queries and rankings by other metrics may change, which verify finds. The suggestions
+    # without antecedent items also back text search and are therefore always kept whole.
+    suggestions = map(Suggestion, suggestions)
+    if max_antecedent_items is not None:
+        suggestions = filter(lambda suggestion: len(suggestion.antecedent_items) <= max_antecedent_items, suggestions)
+    if top_per_antecedent_items is not None:
+        suggestions = thread(suggestions,
+                             partial(sorted, key=lambda suggestion: suggestion.antecedent_items),
+                             partial(groupby, key=lambda suggestion: suggestion.antecedent_items),
+                             (map, lambda pair: (_take_top_consequents(sorted(pair[1]), top_per_antecedent_items)
+                                                 if pair[0]
+                                                 else pair[1])),
+                             chain.from_iterable)
+    return thread(suggestions,
+                  sorted,
+                  (map, lambda suggestion: suggestion.data),
+                  list)
+
+
+def prune_redundant(suggestions: Iterable[np.ndarray]) -> list[np.ndarray]:
+    # A suggestion is redundant when, by every metric, another suggestion for the same consequent item whose antecedent
+    # items are a proper subset of its own ranks ahead of it: any basket matching the former also matches the latter,
+    # which then always claims the consequent item first. A subset ahead by lift may fall behind by confidence.
+    suggestions = tuple(map(Suggestion, suggestions))
+    suggestions_by_key = {}
+    for suggestion in suggestions:
+        key = suggestion.consequent_item, suggestion.antecedent_items
+        suggestions_by_key[key] = min(suggestion, suggestions_by_key.get(key, suggestion))
+
+    @cache
+    def get_best_of_proper_subsets(consequent_item: np.uint32, antecedent_items: tuple[np.uint32, ...]) \
+            -> tuple[Optional[Suggestion], ...]:
+        # The best by each metric, in the order of _RANK_KEYS
+        candidates = []
+        for index in range(len(antecedent_items)):
+            subset = antecedent_items[:index] + antecedent_items[index + 1:]
+            candidates.append((suggestions_by_key.get((consequent_item, subset)),) * len(_RANK_KEYS))
+            candidates.append(get_best_of_proper_subsets(consequent_item, subset))
+        return tuple(min(filter(None, bests), key=rank_key, default=None)
+                     for rank_key, bests in zip(_RANK_KEYS, zip(*candidates) if candidates else repeat(())))
+
+    return [suggestion.data
+            for suggestion in suggestions
+            if not all(best is not None and rank_key(best) < rank_key(suggestion)
+                       for rank_key, best in zip(_RANK_KEYS,
+                                                 get_best_of_proper_subsets(suggestion.consequent_item,
+                                                                            suggestion.antecedent_items)))]
+
+
+def verify(products_data_file: str, expected_suggestions_data_file: str, actual_suggestions_data_file: str,
+           request_count: int, seed: int = 0) -> int:
+    # Replays a sample workload against both models and returns the number of requests whose responses differ: baskets
+    # of one to three of the sets of antecedent items of the expected suggestions, with up to twice as many products as
+    # a response holds besides, half of them with a text query for a product name lemma or the beginning of one, each
+    # ranked by any of the metrics.
+    product_repository = ProductRepository(products_data_file)
+    expected_service, actual_service = (ProductLookupService(product_repository, SuggestionRepository(data_file))
+                                        for data_file in (expected_suggestions_data_file, actual_suggestions_data_file))
+    products, product_name_lemmas = product_repository.get_all_products()
+    antecedent_item_sets = tuple(unique(filter(None,
+                                               map(lambda suggestion: suggestion.antecedent_items,
+                                                   map(Suggestion,
+                                                       SuggestionRepository(expected_suggestions_data_file)
+                                                       .get_all_suggestion_data())))))
+    generator = random.Random(seed)
+    mismatch_count = 0
+    for _ in range(request_count):
+        basket = set(generator.sample(range(len(products)),
+                                      min(generator.randint(1, 2 * SUGGESTIONS_PER_REQUEST), len(products))))
+        if antecedent_item_sets:
+            for _ in range(generator.randint(1, 3)):
+                basket.update(map(int, generator.choice(antecedent_item_sets)))
+        lemma_word_pairs = generator.choice(product_name_lemmas)
+        query = (lemma_word_pairs[0][0][:generator.randint(2, max(len(lemma_word_pairs[0][0]), 2))]
+                 if lemma_word_pairs and generator.random() < 0.5
+                 else '')
+        rank_by = generator.choice(RANKING_METRICS)
+        if expected_service.get_suggestions(basket, query, rank_by) != \
+                actual_service.get_suggestions(basket, query, rank_by):
+            mismatch_count += 1
+    return mismatch_count
+
+
+def _parse_args() -> tuple[str, str, Optional[int], Optional[int], bool, Optional[str], int]:
+    parser = ArgumentParser(description='Compacts a model of association rules by dropping the rules which the API'
+                                        ' server never serves.')
+    parser.add_argument('--input', metavar='PATH', action='store', type=str, default='suggestions.npz',
+                        help='the association rules to compact')
+    parser.add_argument('--output', metavar='PATH', action='store', type=str, required=False,
+                        help='the path to save the compacted association rules to (defaults to overwriting the input)')
+    add_compaction_arguments(parser)
+    parser.add_argument('--verify', metavar='COUNT', action='store', type=int, default=0,
+                        help='the number of sample requests to replay against both models, saving the compacted model'
+                             ' only if none of the responses has changed (requires --products)')
+    parser.add_argument('--products', metavar='PATH', action='store', type=str, required=False,
+                        help='the product list that goes with the association rules')
+    args = parser.parse_args()
+    if args.verify and not args.products:
+        parser.error('--verify requires --products')
+    return abspath(args.input), abspath(args.output or args.input), args.max_antecedents, args.top_per_antecedent, \
+           args.prune_redundant, abspath(args.products) if args.products else None, args.verify
+
+
+def _parse_top_per_antecedent(value: str) -> int:
+    if (count := int(value)) < SUGGESTIONS_PER_REQUEST:
+        raise ArgumentTypeError(f'must be at least {SUGGESTIONS_PER_REQUEST}')
+    return count
+
+
+def add_compaction_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument('--max-antecedents', metavar='COUNT', action='store', type=int,
+                        default=MAX_ANTECEDENT_ITEMS,
+                        help=f'the maximum number of antecedent items for any rule kept (defaults to'
+                             f' {MAX_ANTECEDENT_ITEMS}, the most the API server loads)')
+    parser.add_argument('--top-per-antecedent', metavar='COUNT', action='store', type=_parse_top_per_antecedent,
+                        required=False,
+                        help=f'the number of distinct consequents to keep per set of antecedent items; only responses'
+                             f' ranked by lift without a text query are unchanged, for baskets of up to'
+                             f' COUNT − {SUGGESTIONS_PER_REQUEST} items beyond the matched antecedent items, and the'
+                             f' API server ends pages of suggestions after the first COUNT')
+    parser.add_argument('--prune-redundant', action='store_true',
+                        help='drop each rule outranked by every metric by rules for the same consequent whose'
+                             ' antecedent items are a proper subset of its own')
+
+
+def run() -> None:
+    input_path, output_path, max_antecedents, top_per_antecedent, redundant, products_path, request_count = \
+        _parse_args()
+    print(f'Loading rules from {input_path}…')
+    suggestions = SuggestionRepository(input_path).get_all_suggestion_data()
+    print(f' Loaded {len(suggestions):,} rules.')
+    print('Compacting rules…')
+    compacted_suggestions = compact(suggestions, max_antecedents, top_per_antecedent)
+    print(f' Kept {len(compacted_suggestions):,} rules; dropped {len(suggestions) - len(compacted_suggestions):,}'
+          f' rules.')
+    if redundant:
+        print('Pruning redundant rules…')
+        suggestion_count = len(compacted_suggestions)
+        compacted_suggestions = prune_redundant(compacted_suggestions)
+        print(f' Kept {len(compacted_suggestions):,} rules; dropped {suggestion_count - len(compacted_suggestions):,}'
+              f' redundant rules.')
+    # A model trimmed before stays trimmed as deep as it was.
+    top_per_antecedent = min(filter(None, (top_per_antecedent,
+                                           SuggestionRepository(input_path).get_top_per_antecedent())),
+                             default=None)
+    if not request_count:
+        print(f'Saving rules to {output_path}…')
+        SuggestionRepository(output_path).save_all_suggestions(compacted_suggestions,
+                                                               top_per_antecedent=top_per_antecedent)
+        return
+    # A model to be verified is saved next to the output first, and only replaces it if no response has changed.
+    directory, name = split(output_path)
+    with NamedTemporaryFile('wb', dir=directory, prefix=f'.{name}.', suffix='.npz', delete=False) as file:
+        pass
+    try:
+        SuggestionRepository(file.name).save_all_suggestions(compacted_suggestions,
+                                                             top_per_antecedent=top_per_antecedent)
+        print(f'Verifying {request_count:,} sample requests against both models…')
+        mismatch_count = verify(products_path, input_path, file.name, request_count)
+        print(f' {mismatch_count:,} of {request_count:,} responses differ.')
+        if mismatch_count:
+            sys.exit(f'The compacted rules were not saved to {output_path}, as they change responses.')
+        print(f'Saving rules to {output_path}…')
+        replace(file.name, output_path)
+    finally:
+        if exists(file.name):
+            remove(file.name)
+
+
+__all__ = ('SUGGESTIONS_PER_REQUEST', 'add_compaction_arguments', 'compact', 'prune_redundant', 'verify')
+
+
+if __name__ == '__main__':
+    run()
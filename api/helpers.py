@@ -1,5 +1,6 @@
 import csv
 from functools import partial
+from hashlib import sha256
 from io import TextIOBase, TextIOWrapper
 import re
 from toolz import apply, compose_left as compose
@@ -17,6 +18,14 @@ def first(sequence: tuple[T, U]) -> T:
     return sequence[0]
 
 
+def hash_file(file_path: str) -> str:
+    digest = sha256()
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def read_csv(file: IO[bytes] | str | TextIOBase, delimiter: str = '\t') -> Iterable[list[str]]:
     if isinstance(file, TextIOBase):
         for row in csv.reader(file, delimiter=delimiter):
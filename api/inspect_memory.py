@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+from os.path import abspath
+from typing import Optional
+from memory import get_page_usage, get_process_tree
+from repositories import ProductRepository, SuggestionRepository
+from services import ProductLookupService
+
+
+def _format_bytes(size: int, lower_bound: bool = False) -> str:
+    # The nodes of set-tries are out of reach of measuring, so that the sizes of those are only the least they may be.
+    return f'{"≥ " if lower_bound else ""}{size / (1 << 20):,.1f} MiB'
+
+
+def _parse_args() -> tuple[str, str, Optional[int]]:
+    parser = ArgumentParser(description='Reports the memory taken by each index of the API server, loading the model'
+                                        ' as the server does, or the pages shared between the processes of a running'
+                                        ' server and those private to each.')
+    parser.add_argument('--products', metavar='PATH', action='store', type=str, default='products.tsv',
+                        help='the product list that goes with the association rules')
+    parser.add_argument('--suggestions', metavar='PATH', action='store', type=str, default='suggestions.npz',
+                        help='the association rules')
+    parser.add_argument('--pid', metavar='PID', action='store', type=int,
+                        help='the process identifier of a running server, such as its gunicorn master, to report the'
+                             ' pages of it and of its workers instead')
+    args = parser.parse_args()
+    return abspath(args.products), abspath(args.suggestions), args.pid
+
+
+def run() -> None:
+    products_path, suggestions_path, process_id = _parse_args()
+    if process_id is not None:
+        print(f'{"Process":>10}  {"Shared":>14}  {"Private":>14}  {"Proportional":>14}')
+        # Processes which exited since the tree was listed report nothing.
+        page_usages = {process_id: page_usage
+                       for process_id in get_process_tree(process_id)
+                       if (page_usage := get_page_usage(process_id))}
+        for process_id, page_usage in page_usages.items():
+            print(f'{process_id:>10}  {_format_bytes(page_usage["shared"]):>14}'
+                  f'  {_format_bytes(page_usage["private"]):>14}  {_format_bytes(page_usage["pss"]):>14}')
+        print(f'{"Total":>10}  {"":>14}'
+              f'  {_format_bytes(sum(page_usage["private"] for page_usage in page_usages.values())):>14}'
+              f'  {_format_bytes(sum(page_usage["pss"] for page_usage in page_usages.values())):>14}')
+        return
+    memory_stats = ProductLookupService(ProductRepository(products_path),
+                                        SuggestionRepository(suggestions_path)).get_memory_stats()
+    for name, structure_stats in memory_stats['structures'].items():
+        print(f'{name:<22}  {_format_bytes(structure_stats["bytes"], structure_stats.get("bytes_lower_bound")):>14}  '
+              + ', '.join(f'{field.replace("_", " ")} {value:,.1f}' if isinstance(value, float)
+                          else f'{field.replace("_", " ")} {value:,}'
+                          for field, value in structure_stats.items()
+                          if field not in ('bytes', 'bytes_lower_bound')))
+    total_size = sum(structure_stats['bytes'] for structure_stats in memory_stats['structures'].values())
+    total_lower_bound = any(structure_stats.get('bytes_lower_bound')
+                            for structure_stats in memory_stats['structures'].values())
+    print(f'{"total":<22}  {_format_bytes(total_size, total_lower_bound):>14}')
+    if memory_stats['process']:
+        print(f'{"resident":<22}  {_format_bytes(memory_stats["process"]["rss"]):>14}')
+
+
+__all__ = ()
+
+
+if __name__ == '__main__':
+    run()
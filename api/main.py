@@ -1,16 +1,132 @@
-from flask import Flask, jsonify, request, Response
+import atexit
+from flask import Flask, redirect, request, Response
+from hashlib import sha256
+from hmac import compare_digest
+import json
+from os import environ, stat
+from os.path import isfile
+import sys
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Iterable, Optional
 from werkzeug.exceptions import HTTPException
-from urllib.parse import urlparse
-from repositories import ProductRepository, SuggestionRepository
-from services import ProductLookupService
+from urllib.parse import quote_plus, urlparse
+from repositories import AvailabilityRepository, MaterializedSuggestionRepository, ProductRepository, \
+    SketchRepository, SuggestionRepository
+from services import ProductLookupService, ShardedProductLookupService
+from sketches import OnlineRuleLearner
+from shard_suggestions import get_shard_data_file
+
+
+# How long browsers and nginx may reuse a response to a GET request before revalidating it by its ETag
+CACHE_MAX_AGE = 300
+
+# The most items accepted in a basket, and the time in seconds spent matching a basket before it is cut short, so that
+# no single request ties up a worker for long
+MAX_BASKET_SIZE = 200
+BASKET_TIME_BUDGET = 0.2
+
+# Suggestions computed ahead of time by materialize_suggestions.py, which are looked up if present
+MATERIALIZED_SUGGESTIONS_DATA_FILE = 'suggestions.materialized.npz'
+
+# The number of shard processes to serve the rules from, each loading the shard of suggestions.npz saved by
+# shard_suggestions.py with as many shards; with none, the rules are served from this process
+SHARD_COUNT = int(environ.get('SHARD_COUNT', 0))
+
+# Products taken off sale since the model was trained, by product identifier, one per line, which are never suggested;
+# the file is checked for changes at most once per interval in seconds
+UNAVAILABLE_PRODUCTS_DATA_FILE = 'unavailable.txt'
+AVAILABILITY_CHECK_INTERVAL = 5
+
+# Whether to learn rules of a single item online from the baskets suggestions are requested for, and from the orders
+# appended to a log, if one is given, to suggest along with the mined ones until the model is next trained; the
+# sketches the rules are learned from are saved to a file, to be carried on from after a restart
+ONLINE_LEARNING = bool(int(environ.get('ONLINE_LEARNING', 0)))
+ORDER_LOG_FILE = environ.get('ORDER_LOG_FILE')
+SKETCH_DATA_FILE = 'sketches.npz'
+
+# The bearer token which requests to the admin endpoints must carry; without one, those endpoints do not exist
+ADMIN_TOKEN = environ.get('ADMIN_TOKEN')
+
+# The header which asks for a request for suggestions to be profiled, along with the admin token
+PROFILE_HEADER = 'X-Profile'
+
+
+# The characters which axios leaves unescaped in query strings, besides those which quote_plus never escapes, and
+# which browsers then send as they are; browsers escape the apostrophe which axios leaves too, so it is escaped here
+_SAFE_CHARACTERS = "!$()*,:[]"
+
+
+def _encode_query_string(parameters: Iterable[tuple[str, str]]) -> str:
+    # Encodes the non-empty parameters as browsers send those axios encodes, so that the URLs the front end requests
+    # are already canonical.
+    return '&'.join(f'{name}={quote_plus(value, safe=_SAFE_CHARACTERS)}' for name, value in parameters if value)
 
 
 def create_app() -> Flask:  # TODO: Move views to a separate file
     app = Flask(__name__,
                 static_folder='../build',
                 static_url_path='/')
-    product_lookup_service = ProductLookupService(ProductRepository('products.tsv'),
-                                                  SuggestionRepository('suggestions.npz'))
+    if SHARD_COUNT and ONLINE_LEARNING:
+        raise RuntimeError('Rules cannot be learned online while serving them from shards.')
+    if SHARD_COUNT:
+        product_lookup_service = ShardedProductLookupService(
+            ProductRepository('products.tsv'),
+            [SuggestionRepository(get_shard_data_file('suggestions.npz', index, SHARD_COUNT))
+             for index in range(SHARD_COUNT)],
+            max_basket_size=MAX_BASKET_SIZE,
+            basket_time_budget=BASKET_TIME_BUDGET)
+    else:
+        # The rules are learned by a thread of this process, which the workers of a preloaded app are forked from, and
+        # from which they all share the rules; each worker without preloading would learn from its own requests.
+        if ONLINE_LEARNING:
+            online_rule_learner = OnlineRuleLearner(len(ProductRepository('products.tsv').get_all_products()[0]),
+                                                    sketch_repository=SketchRepository(SKETCH_DATA_FILE),
+                                                    order_log_file=ORDER_LOG_FILE)
+            online_rule_learner.start()
+            atexit.register(online_rule_learner.stop)
+        else:
+            online_rule_learner = None
+        product_lookup_service = ProductLookupService(ProductRepository('products.tsv'),
+                                                      SuggestionRepository('suggestions.npz'),
+                                                      max_basket_size=MAX_BASKET_SIZE,
+                                                      basket_time_budget=BASKET_TIME_BUDGET,
+                                                      materialized_suggestions_repository=(
+                                                          MaterializedSuggestionRepository(
+                                                              MATERIALIZED_SUGGESTIONS_DATA_FILE)
+                                                          if isfile(MATERIALIZED_SUGGESTIONS_DATA_FILE)
+                                                          else None),
+                                                      online_rule_learner=online_rule_learner)
+
+    # The products off sale are reloaded whenever their file is replaced or changed, by whichever worker first notices,
+    # as the mask of them is shared between the workers. A file which cannot be read leaves the mask as it was.
+    availability_repository = AvailabilityRepository(UNAVAILABLE_PRODUCTS_DATA_FILE)
+    availability_lock = Lock()
+    availability_file_state, next_availability_check = None, 0.0
+
+    def get_availability_file_state() -> Optional[tuple[int, int, int]]:
+        try:
+            file_stat = stat(UNAVAILABLE_PRODUCTS_DATA_FILE)
+        except FileNotFoundError:
+            return None
+        return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
+    @app.before_request
+    def reload_unavailable_products() -> None:
+        nonlocal availability_file_state, next_availability_check
+        if monotonic() < next_availability_check or not availability_lock.acquire(blocking=False):
+            return
+        try:
+            next_availability_check = monotonic() + AVAILABILITY_CHECK_INTERVAL
+            if (file_state := get_availability_file_state()) != availability_file_state:
+                product_lookup_service.set_unavailable_products(availability_repository.get_unavailable_products())
+                availability_file_state = file_state
+        except (OSError, ValueError) as error:
+            print(f'Failed to reload {UNAVAILABLE_PRODUCTS_DATA_FILE}: {error}', file=sys.stderr)
+        finally:
+            availability_lock.release()
+
+    reload_unavailable_products()
 
     # See the Stack Overflow answer for why this is needed: https://stackoverflow.com/a/44572672/1405571.
     @app.after_request
@@ -28,16 +144,188 @@ def create_app() -> Flask:  # TODO: Move views to a separate file
     @app.errorhandler(HTTPException)
     def errorhandler(exception: HTTPException):
         if app.debug:
-            return Response({'error': str(exception)}, 500)
-        return exception, 500
+            return {'error': str(exception)}, exception.code
+        return exception
 
     @app.route('/')
     def index() -> Response:
         return app.send_static_file('index.html')
 
+    # Responses are assembled from JSON fragments serialized ahead of time, exactly as jsonify would have them outside
+    # of debug mode.
+    def create_data_response(data: bytes, **fields: Any) -> Response:
+        return Response(b''.join((b'{"data":', data,
+                                  *(f',{json.dumps(name)}:{json.dumps(value)}'.encode()
+                                    for name, value in sorted(fields.items())),
+                                  b'}\n')),
+                        mimetype='application/json')
+
+    # Responses to GET requests are cacheable. Requests are redirected to their canonical URLs, so that equivalent
+    # requests share cache entries, and their responses are identified by strong ETags derived from the model version
+    # and the canonical URL, so that they are revalidated without being recomputed. Responses which must not be stored
+    # are passed through as they are.
+    def create_cacheable_response(query_string: str, create_response: Callable[[], Response]) -> Response:
+        url = f'{request.path}?{query_string}' if query_string else request.path
+        if request.query_string.decode() != query_string:
+            response = redirect(url, 301)
+        elif request.if_none_match.contains(etag := sha256(f'{product_lookup_service.model_version}'
+                                                           f' {product_lookup_service.availability_version}'
+                                                           f' {product_lookup_service.online_rules_version} {url}'
+                                                           .encode()).hexdigest()):
+            response = Response(status=304)
+            response.set_etag(etag)
+        elif (response := create_response()).status_code == 200 and not response.cache_control.no_store:
+            response.set_etag(etag)
+        else:
+            return response
+        response.cache_control.public = True
+        response.cache_control.max_age = CACHE_MAX_AGE
+        return response
+
+    # Suggestions for a basket cut short by the time budget are flagged as truncated, and are not cached, as the next
+    # request for the same basket may well get further.
+    def create_suggestions_response(basket: Iterable[int], query: str, limit: int, cursor: Optional[str],
+                                    rank_by: str) -> Response:
+        try:
+            data, next_cursor, truncated = product_lookup_service.get_suggestions_page_json(basket, query, limit,
+                                                                                            cursor, rank_by)
+        except ValueError as error:
+            return Response(str(error), 400)
+        response = create_data_response(data, next_cursor=next_cursor, truncated=truncated)
+        if truncated:
+            response.cache_control.no_store = True
+        return response
+
+    # A request for suggestions carrying a PROFILE_HEADER and the admin token is answered as any other, under a
+    # profiler, with where its time went along with the suggestions, and never cached. Other requests only have their
+    # headers checked for it.
+    def create_profiled_suggestions_response(basket: Iterable[int], query: str, limit: int, cursor: Optional[str],
+                                             rank_by: str) -> Response:
+        if (response := check_admin_token()) is not None:
+            return response
+        try:
+            data, next_cursor, truncated, profile = \
+                product_lookup_service.profile_suggestions_page_json(basket, query, limit, cursor, rank_by)
+        except ValueError as error:
+            return Response(str(error), 400)
+        response = create_data_response(data, next_cursor=next_cursor, truncated=truncated, profile=profile)
+        response.cache_control.no_store = True
+        return response
+
     @app.route('/api/suggestion', methods=['POST'])
     def suggestion() -> Response:
-        return jsonify({'data': product_lookup_service.get_suggestions(**request.json)})
+        arguments = request.json
+        if PROFILE_HEADER in request.headers:
+            return create_profiled_suggestions_response(arguments.get('basket', ()), arguments.get('query', ''),
+                                                        arguments.get('limit', 10), arguments.get('cursor'),
+                                                        arguments.get('rank_by', 'lift'))
+        return create_suggestions_response(arguments.get('basket', ()), arguments.get('query', ''),
+                                           arguments.get('limit', 10), arguments.get('cursor'),
+                                           arguments.get('rank_by', 'lift'))
+
+    @app.route('/api/suggestion', methods=['GET'])
+    def get_suggestion() -> Response:
+        try:
+            basket = sorted(set(map(int, filter(None, request.args.get('basket', '').split(',')))))
+        except ValueError:
+            return Response('The basket must be a comma-separated list of product identifiers.', 400)
+        query = ' '.join(request.args.get('query', '').split())
+        try:
+            limit = int(request.args.get('limit', 10))
+        except ValueError:
+            return Response('The limit must be a number.', 400)
+        cursor = request.args.get('cursor')
+        rank_by = request.args.get('rank_by', 'lift')
+        if PROFILE_HEADER in request.headers:
+            return create_profiled_suggestions_response(basket, query, limit, cursor, rank_by)
+        return create_cacheable_response(_encode_query_string((('basket', ','.join(map(str, basket))),
+                                                               ('query', query),
+                                                               ('limit', str(limit) if limit != 10 else ''),
+                                                               ('cursor', cursor or ''),
+                                                               ('rank_by', rank_by if rank_by != 'lift' else ''))),
+                                         lambda: create_suggestions_response(basket, query, limit, cursor, rank_by))
+
+    # Sessions suit clients which change a basket one item at a time: each update only matches the rules involving the
+    # items added. Requests for a session which has expired are answered with 404, upon which the client starts afresh.
+    @app.route('/api/session', methods=['POST'])
+    def create_session() -> Response:
+        arguments = request.json
+        try:
+            session_id = product_lookup_service.create_session(arguments.get('basket', ()))
+        except ValueError as error:
+            return Response(str(error), 400)
+        return create_data_response(product_lookup_service.get_session_suggestions_json(session_id,
+                                                                                         arguments.get('query', '')),
+                                    session=session_id)
+
+    @app.route('/api/session/<session_id>', methods=['POST'])
+    def update_session(session_id: str) -> Response:
+        arguments = request.json
+        try:
+            product_lookup_service.update_session(session_id, arguments.get('add', ()), arguments.get('remove', ()))
+            data = product_lookup_service.get_session_suggestions_json(session_id, arguments.get('query', ''))
+        except KeyError:
+            return Response('The session does not exist or has expired.', 404)
+        except ValueError as error:
+            return Response(str(error), 400)
+        return create_data_response(data, session=session_id)
+
+    @app.route('/api/complete', methods=['GET'])
+    def complete() -> Response:
+        query = ' '.join(request.args.get('query', '').split())
+        return create_cacheable_response(_encode_query_string((('query', query),)),
+                                         lambda: create_data_response(product_lookup_service.complete_json(query)))
+
+    # Products are taken off sale and put back on without retraining the model. The change applies to every worker at
+    # once, and is saved to the file of products off sale so that it outlasts a restart. Responses cached before it may
+    # still be served until they expire.
+    def check_admin_token() -> Optional[Response]:
+        if not ADMIN_TOKEN:
+            return Response(status=404)
+        if not (request.authorization and request.authorization.type == 'bearer'
+                and compare_digest((request.authorization.token or '').encode(), ADMIN_TOKEN.encode())):
+            return Response('A valid admin token is required.', 401, {'WWW-Authenticate': 'Bearer'})
+        return None
+
+    def create_unavailable_products_response() -> Response:
+        response = create_data_response(json.dumps(product_lookup_service.unavailable_products).encode(),
+                                        version=product_lookup_service.availability_version)
+        response.cache_control.no_store = True
+        return response
+
+    @app.route('/api/admin/unavailable', methods=['GET'])
+    def get_unavailable_products() -> Response:
+        if (response := check_admin_token()) is not None:
+            return response
+        return create_unavailable_products_response()
+
+    @app.route('/api/admin/unavailable', methods=['POST'])
+    def update_unavailable_products() -> Response:
+        nonlocal availability_file_state
+        if (response := check_admin_token()) is not None:
+            return response
+        arguments = request.json
+        with availability_lock:
+            try:
+                product_lookup_service.update_unavailable_products(arguments.get('add', ()),
+                                                                   arguments.get('remove', ()))
+            except (TypeError, ValueError) as error:
+                return Response(str(error), 400)
+            availability_repository.save_unavailable_products(product_lookup_service.unavailable_products)
+            availability_file_state = get_availability_file_state()
+        return create_unavailable_products_response()
+
+    # The counters of the service and the memory taken by each of its indexes and caches, along with the pages of the
+    # worker answering, shared with the other workers or private to it. Measuring walks every object of the model, so
+    # that a request ties up its worker for seconds with a large one.
+    @app.route('/api/admin/stats', methods=['GET'])
+    def get_stats() -> Response:
+        if (response := check_admin_token()) is not None:
+            return response
+        response = create_data_response(json.dumps({'service': product_lookup_service.stats,
+                                                    'memory': product_lookup_service.get_memory_stats()}).encode())
+        response.cache_control.no_store = True
+        return response
 
     return app
 
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+from os.path import abspath
+from typing import Iterable
+from compact_suggestions import SUGGESTIONS_PER_REQUEST
+from models import Suggestion
+from repositories import MaterializedSuggestionRepository, ProductRepository, SuggestionRepository
+from services import ProductLookupService
+
+
+def get_frequent_pairs(suggestions: Iterable[Suggestion], count: int) -> list[tuple[int, int]]:
+    # The pairs of items which the rules show to occur together most often: each rule with a single antecedent item
+    # pairs it with its consequent item, occurring together as often as its item set does, and each rule with two
+    # antecedent items pairs those, occurring together as often as its antecedent items do.
+    pair_counts = {}
+    for suggestion in suggestions:
+        match tuple(map(int, suggestion.antecedent_items)):
+            case (item,):
+                pair, pair_count = tuple(sorted((item, int(suggestion.consequent_item)))), suggestion.item_set_count
+            case (first_item, second_item):
+                pair, pair_count = (first_item, second_item), suggestion.antecedent_count
+            case _:
+                continue
+        pair_counts[pair] = max(pair_counts.get(pair, 0), int(pair_count))
+    return sorted(pair_counts.keys(), key=lambda pair: (-pair_counts[pair], pair))[:count]
+
+
+def _parse_args() -> tuple[str, str, str, int]:
+    parser = ArgumentParser(description='Computes the suggestions for every basket of a single item and for the most'
+                                        ' frequent pairs of items ahead of time, for the API server to look up.')
+    parser.add_argument('--products', metavar='PATH', action='store', type=str, default='products.tsv',
+                        help='the product list that goes with the association rules')
+    parser.add_argument('--suggestions', metavar='PATH', action='store', type=str, default='suggestions.npz',
+                        help='the association rules')
+    parser.add_argument('--output', metavar='PATH', action='store', type=str,
+                        default='suggestions.materialized.npz',
+                        help='the path to save the materialized suggestions to')
+    parser.add_argument('--pairs', metavar='COUNT', action='store', type=int, default=100_000,
+                        help='the number of the most frequent pairs of items to materialize the suggestions for')
+    args = parser.parse_args()
+    if args.pairs < 0:
+        parser.error('--pairs must not be negative')
+    return abspath(args.products), abspath(args.suggestions), abspath(args.output), args.pairs
+
+
+def run() -> None:
+    products_path, suggestions_path, output_path, pair_count = _parse_args()
+    suggestions_repository = SuggestionRepository(suggestions_path)
+    product_lookup_service = ProductLookupService(ProductRepository(products_path), suggestions_repository)
+    print('Finding the most frequent pairs of items…')
+    pairs = get_frequent_pairs(suggestions_repository.get_all_suggestions(), pair_count)
+    print(f' Found {len(pairs):,} pairs of items.')
+    print('Materializing suggestions…')
+    materialized_suggestions = product_lookup_service.materialize_suggestions(pairs, SUGGESTIONS_PER_REQUEST)
+    print(f' Materialized suggestions for {len(materialized_suggestions["single_suggestions"]):,} single items and'
+          f' {len(pairs):,} pairs of items.')
+    print(f'Saving materialized suggestions to {output_path}…')
+    MaterializedSuggestionRepository(output_path).save_materialized_suggestions(product_lookup_service.model_version,
+                                                                                materialized_suggestions)
+
+
+__all__ = ('get_frequent_pairs',)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,81 @@
+from collections import Counter
+import gc
+import numpy as np
+import os
+import re
+import sys
+from types import BuiltinFunctionType, CodeType, FrameType, FunctionType, GeneratorType, MethodType, \
+    MethodWrapperType, ModuleType, WrapperDescriptorType
+from typing import Any, Iterable, Optional
+
+# Objects which are never counted as part of a data structure, nor looked into: they either belong to the interpreter
+# or lead back to whatever holds the structure, as a bound method leads back to its instance.
+_UNCOUNTED_TYPES = (type, ModuleType, FunctionType, BuiltinFunctionType, MethodType, MethodWrapperType,
+                    WrapperDescriptorType, CodeType, FrameType, GeneratorType)
+
+# The fields of /proc/<pid>/smaps_rollup summed into each figure reported by get_page_usage
+_PAGE_FIELDS = {'rss': ('Rss',), 'pss': ('Pss',), 'shared': ('Shared_Clean', 'Shared_Dirty'),
+                'private': ('Private_Clean', 'Private_Dirty'), 'swap': ('Swap',)}
+
+
+def get_deep_size(objects: Iterable[Any], seen: Optional[set[int]] = None) -> int:
+    # The bytes taken by the objects and everything they refer to, each object counted once, and none of those already
+    # in seen, to which those counted are added, so that structures sharing objects are measured without counting them
+    # twice. The data of NumPy arrays is counted once, with the array owning it, whichever views of it are reached.
+    seen = set() if seen is None else seen
+    size, pending = 0, list(objects)
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _UNCOUNTED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, np.ndarray):
+            if obj.base is not None:
+                pending.append(obj.base)
+        else:
+            pending.extend(gc.get_referents(obj))
+    return size
+
+
+def get_set_trie_stats(keys: Iterable[Iterable]) -> dict:
+    # The shape of the set-trie holding the keys, each a set of items stored as a path of nodes in ascending order of
+    # its items, as sets sharing their smallest items share the first nodes of their paths: the number of entries, of
+    # nodes besides the root, the depth of the deepest node, and the mean and largest number of children of the nodes
+    # which have any.
+    entry_count, depth, prefixes = 0, 0, set()
+    for key in keys:
+        key = tuple(sorted(key))
+        entry_count += 1
+        depth = max(depth, len(key))
+        prefixes.update(key[:length] for length in range(1, len(key) + 1))
+    fan_outs = Counter(prefix[:-1] for prefix in prefixes).values()  # The children of each node, by their own paths
+    return {'entries': entry_count, 'nodes': len(prefixes), 'depth': depth,
+            'mean_fan_out': len(prefixes) / len(fan_outs) if fan_outs else 0.0,
+            'max_fan_out': max(fan_outs, default=0)}
+
+
+def get_process_tree(process_id: int) -> list[int]:
+    # The process and all its descendants, parents before children.
+    process_ids = [process_id]
+    for process_id in process_ids:
+        for task in os.listdir(f'/proc/{process_id}/task'):
+            with open(f'/proc/{process_id}/task/{task}/children') as file:
+                process_ids.extend(map(int, file.read().split()))
+    return process_ids
+
+
+def get_page_usage(process_id: int | str = 'self') -> dict[str, int]:
+    # The resident memory of a process in bytes, split between the pages it shares with other processes, such as those
+    # of the indexes between the workers of a preloaded app until they are written to, and those private to it, along
+    # with its proportional set size, in which each shared page is split among the processes sharing it. Only Linux
+    # reports these, elsewhere nothing is.
+    try:
+        with open(f'/proc/{process_id}/smaps_rollup') as file:
+            fields = {name: int(value) * 1024 for name, value in re.findall(r'^(\w+):\s+(\d+) kB', file.read(), re.M)}
+    except FileNotFoundError:
+        return {}
+    return {figure: sum(fields.get(name, 0) for name in names) for figure, names in _PAGE_FIELDS.items()}
+
+
+__all__ = ('get_deep_size', 'get_page_usage', 'get_process_tree', 'get_set_trie_stats')
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 import numpy as np
+from typing import Optional
 
 
 @dataclass(init=True, repr=False, eq=False, frozen=True, slots=True)
@@ -17,9 +18,16 @@ class Suggestion:
             raise ValueError('Field \'data\' at index 3 must be a non-zero value.')
         if not self.consequent_count > 0:
             raise ValueError('Field \'data\' at index 4 must be a non-zero value.')
-        if np.any(np.diff(self.data[5:]) <= 0):
+        if np.any(np.diff(self.data[5:].astype(np.int64)) <= 0):  # Unsigned differences would wrap around.
             raise ValueError('Field \'data\' must contain only unique values sorted in ascending order from index 5.')
 
+    @classmethod
+    def from_validated_data(cls, data: np.ndarray) -> 'Suggestion':
+        # Skips __post_init__ for data already checked as a whole by validate_suggestion_data.
+        suggestion = object.__new__(cls)
+        object.__setattr__(suggestion, 'data', data)
+        return suggestion
+
     def __hash__(self) -> int:
         return hash(tuple(self.data))
 
@@ -102,4 +110,47 @@ class Suggestion:
                else float('inf')
 
 
-__all__ = ('Suggestion',)
+def validate_suggestion_data(array: np.ndarray, indices: np.ndarray, product_count: Optional[int] = None) -> None:
+    # Checks the same invariants as Suggestion.__post_init__ for every suggestion in a ragged array at once, plus, given
+    # the number of products, that every item refers to a product.
+    def check(valid: np.ndarray, message: str) -> None:
+        if not np.all(valid):
+            raise ValueError(f'Suggestion {np.flatnonzero(~valid)[0]:,}: {message}')
+
+    if not (isinstance(array, np.ndarray) and array.dtype == np.uint32 and len(array.shape) == 1):
+        raise TypeError('The suggestion data must be a one-dimensional NumPy array of uint32.')
+    starts = np.concatenate(([0], indices)).astype(np.int64)
+    lengths = np.diff(np.concatenate((starts, [array.shape[0]])))
+    check(lengths >= 5, 'Field \'data\' must be a one-dimensional array of at least 5 elements.')
+    check(array[starts + 1] > 0, 'Field \'data\' at index 1 must be a non-zero value.')
+    check(array[starts + 3] > 0, 'Field \'data\' at index 3 must be a non-zero value.')
+    check(array[starts + 4] > 0, 'Field \'data\' at index 4 must be a non-zero value.')
+    rows = np.repeat(np.arange(lengths.shape[0]), lengths)  # The suggestion to which each element belongs
+    offsets = np.arange(array.shape[0]) - starts[rows]
+
+    def find_rows_without(invalid: np.ndarray) -> np.ndarray:
+        valid = np.ones(lengths.shape[0], dtype=bool)
+        valid[rows[invalid]] = False
+        return valid
+
+    not_increasing = np.zeros(array.shape[0], dtype=bool)
+    not_increasing[1:] = np.diff(array.astype(np.int64)) <= 0
+    check(find_rows_without((offsets >= 6) & not_increasing),
+          'Field \'data\' must contain only unique values sorted in ascending order from index 5.')
+    if product_count is not None:
+        validate_suggestion_products(array, indices, product_count)
+
+
+def validate_suggestion_products(array: np.ndarray, indices: np.ndarray, product_count: int) -> None:
+    # Checks only that every item of the suggestions in a ragged array, otherwise valid, refers to a product, which is
+    # cheap enough to do even for models whose checksum proves that they were validated on export.
+    starts = np.concatenate(([0], indices)).astype(np.int64)
+    is_item = np.ones(array.shape[0], dtype=bool)
+    for offset in range(1, 5):
+        is_item[starts + offset] = False
+    if (invalid := np.flatnonzero(is_item & (array >= product_count))).shape[0]:
+        raise ValueError(f'Suggestion {np.searchsorted(starts, invalid[0], side="right") - 1:,}: Field \'data\' must'
+                         f' refer only to products identified by 0 through {product_count - 1:,}.')
+
+
+__all__ = ('Suggestion', 'validate_suggestion_data', 'validate_suggestion_products')
@@ -5,24 +5,32 @@ from argparse import ArgumentParser
 from collections import Counter, defaultdict, namedtuple
 import csv
 from dataclasses import astuple, fields, is_dataclass
-from efficient_apriori import apriori, Rule
-from functools import partial
+from efficient_apriori import Rule
+from efficient_apriori.itemsets import apriori_gen, itemsets_from_transactions
+from efficient_apriori.rules import generate_rules_apriori
+from functools import cache, partial, reduce
+from hashlib import sha256
 import html
 from io import TextIOBase, TextIOWrapper
 from itertools import chain, filterfalse, starmap
+from math import erf, log, sqrt
 from nltk import download
 from nltk.corpus import stopwords, wordnet as wn
 from nltk.data import find
 from nltk.stem.wordnet import WordNetLemmatizer
 from nltk.tag import pos_tag
 import numpy as np
+import os
 import os.path as path
 from os.path import abspath
+from time import perf_counter
 from toolz import apply, compose_left as compose, identity, juxt, mapcat, thread_last as thread, unique
 from typing import Any, Callable, IO, Iterable, Optional
 from zipfile import ZipFile
+from compact_suggestions import add_compaction_arguments, compact, prune_redundant
 from models import Suggestion
-from helpers import first, read_csv, second, tokenize
+from repositories import SuggestionRepository
+from helpers import first, hash_file, read_csv, second, star, tokenize
 
 
 def _ensure_nltk_data(names: Iterable[str]) -> None:
@@ -76,7 +84,8 @@ _lemmatize: Callable[[str], Iterable[tuple[str, Optional[str]]]] = \
             unique)
 
 
-def _parse_args() -> tuple[str, Optional[str], Optional[float], Optional[float], str]:
+def _parse_args() -> tuple[str, Optional[str], Optional[float], Optional[float], str, Optional[str], Optional[int],
+                           Optional[int], bool, Optional[float], int, bool]:
     parser = ArgumentParser(description='Mines association rules from Instacart’s market basket analysis data. Download'
                                         ' it from: https://www.kaggle.com/c/instacart-market-basket-analysis/data')
     parser.add_argument('--input', metavar='PATH', action='store', type=str,
@@ -90,7 +99,23 @@ def _parse_args() -> tuple[str, Optional[str], Optional[float], Optional[float],
                         help='the minimum confidence for any rule under consideration')
     parser.add_argument('--output', metavar='PATH', action='store', type=str,
                         help='the output directory to store the association rules and product list')
+    parser.add_argument('--checkpoints', metavar='PATH', action='store', type=str, required=False,
+                        help='the directory to store the output of each stage in for reuse by later runs (defaults to'
+                             ' .checkpoints under the output directory)')
+    parser.add_argument('--no-checkpoints', action='store_true',
+                        help='run every stage from scratch without reading or writing any checkpoints')
+    parser.add_argument('--sample', metavar='FRACTION', action='store', type=float, required=False,
+                        help='mine only a random sample of this fraction of the transactions, at a lowered minimum'
+                             ' support, to quickly estimate the rules')
+    parser.add_argument('--seed', metavar='NUMBER', action='store', type=int, default=0,
+                        help='the seed for drawing the sample of transactions')
+    parser.add_argument('--verify-sample', action='store_true',
+                        help='count the item sets found in the sample exactly over all transactions, keeping only'
+                             ' those which are truly frequent and checking whether any frequent item set was missed')
+    add_compaction_arguments(parser)
     args = parser.parse_args()
+    if args.sample is not None and not 0 < args.sample <= 1:
+        parser.error('--sample must be greater than 0 and at most 1')
     input_path = abspath(args.input)
     exclusions_path = (abspath(args.exclusions)
                        if args.exclusions
@@ -102,7 +127,11 @@ def _parse_args() -> tuple[str, Optional[str], Optional[float], Optional[float],
                if args.minconf
                else None)
     output_path = abspath(args.output or '')
-    return input_path, exclusions_path, minsupport, minconf, output_path
+    checkpoints_path = (None
+                        if args.no_checkpoints
+                        else abspath(args.checkpoints or path.join(output_path, '.checkpoints')))
+    return input_path, exclusions_path, minsupport, minconf, output_path, checkpoints_path, args.max_antecedents, \
+           args.top_per_antecedent, args.prune_redundant, args.sample, args.seed, args.verify_sample
 
 
 def _preprocess(archive: ZipFile, exclusions: frozenset[int]) -> tuple[tuple[str], tuple[tuple[int, ...], ...]]:
@@ -149,24 +178,137 @@ def _preprocess(archive: ZipFile, exclusions: frozenset[int]) -> tuple[tuple[str
                   in transactions.values()))
 
 
-def _train(transactions: tuple[tuple[int, ...]], min_support: Optional[float] = None,
-           min_confidence: Optional[float] = None) -> tuple[Rule, ...]:
+# The probability that the sample misses a frequent item set, from which the minimum support to mine the sample at is
+# lowered (see Toivonen, H. (1996). “Sampling Large Databases for Association Rules.”)
+_SAMPLE_MISS_PROBABILITY = 1 / 100
+
+
+def _get_min_support(min_support: Optional[float], transaction_count: int) -> float:
+    return (min(100 / transaction_count, max(2 / transaction_count, 1 / 10))
+            if min_support is None
+            else min_support)
+
+
+def _mine(transactions: tuple[tuple[int, ...]], min_support: Optional[float] = None) \
+        -> tuple[dict[int, dict[tuple[int, ...], int]], int, Counter]:
+    product_counts = Counter(chain.from_iterable(transactions))
+    transaction_count = len(transactions)
+    item_sets, _ = itemsets_from_transactions(transactions,
+                                              _get_min_support(min_support, transaction_count),
+                                              max_length=max(map(len, transactions)),
+                                              verbosity=1)
+    return item_sets, transaction_count, product_counts
+
+
+def _mine_sample(transactions: tuple[tuple[int, ...]], fraction: float, seed: int, verify: bool,
+                 min_support: Optional[float] = None) -> tuple[dict[int, dict[tuple[int, ...], int]], int, Counter]:
     product_counts = Counter(chain.from_iterable(transactions))
     transaction_count = len(transactions)
+    min_support = _get_min_support(min_support, transaction_count)
+    sample = tuple(map(transactions.__getitem__,
+                       np.sort(np.random.default_rng(seed).choice(transaction_count,
+                                                                  max(1, round(fraction * transaction_count)),
+                                                                  replace=False))))
+    lowered_min_support = max(min_support / 2,
+                              min_support - sqrt(log(1 / _SAMPLE_MISS_PROBABILITY) / (2 * len(sample))))
+    print(f' Mining a sample of {len(sample):,} transactions at a lowered minimum support of {lowered_min_support:.4%}…')
+    candidates, _ = itemsets_from_transactions(sample, lowered_min_support, max_length=max(map(len, sample)),
+                                               verbosity=1)
+    if verify:
+        # Besides the candidates, the negative border (the item sets not found in the sample whose every subset was) is
+        # also counted: if none of them is frequent, then neither is any other item set missing from the sample.
+        negative_border = (*((item,) for item in product_counts.keys() if (item,) not in candidates.get(1, {})),
+                           *(item_set
+                             for length in candidates
+                             for item_set in apriori_gen(sorted(candidates[length]))
+                             if item_set not in candidates.get(length + 1, {})))
+        print(f' Counting {sum(map(len, candidates.values())):,} candidate item sets and {len(negative_border):,} item'
+              f' sets on the negative border over all {transaction_count:,} transactions…')
+        count = _create_item_set_counter(transactions, product_counts)
+        item_sets = _select_item_sets(candidates, lambda item_set, _: count(item_set),
+                                      lambda item_set_count: item_set_count / transaction_count >= min_support)
+        missed_item_set_count = sum(1
+                                    for item_set in negative_border
+                                    if count(item_set) / transaction_count >= min_support)
+        print(f' Confirmed {sum(map(len, item_sets.values())):,} frequent item sets; '
+              + ('none on the negative border is frequent, so none were missed (recall: 100%).'
+                 if missed_item_set_count == 0
+                 else f'{missed_item_set_count:,} on the negative border are also frequent, so some were missed. Use a'
+                      f' larger sample.'))
+    else:
+        # Counts are scaled up from the sample, except those of single items, which are known exactly. Recall is
+        # estimated from the probability that each item set is truly frequent given its support in the sample.
+        def estimate_probability_of_being_frequent(item_set_count: int) -> float:
+            support = item_set_count / len(sample)
+            standard_error = sqrt(max(support * (1 - support), 1 / len(sample)) / len(sample))
+            return (1 + erf((support - min_support) / (standard_error * sqrt(2)))) / 2
+
+        def is_frequent(item_set_count: int) -> bool:
+            return item_set_count / len(sample) >= min_support
+
+        scale = transaction_count / len(sample)
+        item_sets = {length: {item_set: (product_counts[item_set[0]]
+                                         if length == 1
+                                         else max(1, round(item_set_count * scale)))
+                              for item_set, item_set_count in counts.items()}
+                     for length, counts in _select_item_sets(candidates, lambda _, item_set_count: item_set_count,
+                                                             is_frequent).items()}
+        sample_counts = tuple(chain.from_iterable(map(dict.values, candidates.values())))
+        found, missed = (sum(map(estimate_probability_of_being_frequent, filter(predicate, sample_counts)))
+                         for predicate in (is_frequent, compose(is_frequent, lambda frequent: not frequent)))
+        print(f' Estimated {sum(map(len, item_sets.values())):,} frequent item sets with an estimated recall of'
+              f' {found / (found + missed) if found + missed else 1:.2%}.')
+    return item_sets, transaction_count, product_counts
+
+
+def _select_item_sets(item_sets: dict[int, dict[tuple[int, ...], int]], count: Callable[[tuple[int, ...], int], int],
+                      predicate: Callable[[int], bool]) -> dict[int, dict[tuple[int, ...], int]]:
+    selected_item_sets = defaultdict(dict)
+    for length, counts in item_sets.items():
+        for item_set, item_set_count in counts.items():
+            if predicate(item_set_count := count(item_set, item_set_count)):
+                selected_item_sets[length][item_set] = item_set_count
+    return dict(selected_item_sets)
+
+
+def _create_item_set_counter(transactions: tuple[tuple[int, ...]], product_counts: Counter) \
+        -> Callable[[tuple[int, ...]], int]:
+    # Maps each item to the sorted array of the transactions containing it; item sets are counted by intersection.
+    transaction_data = _encode_transactions((), transactions)
+    items = transaction_data['items']
+    transaction_indices = np.repeat(np.arange(len(transactions), dtype=np.uint32), np.diff(transaction_data['offsets']))
+    order = np.argsort(items, kind='stable')
+    item_values, item_starts = np.unique(items[order], return_index=True)
+    transaction_indices_by_item = dict(zip(item_values.tolist(),
+                                           np.split(transaction_indices[order], item_starts[1:])))
+
+    def count(item_set: tuple[int, ...]) -> int:
+        if len(item_set) == 1:
+            return product_counts[item_set[0]]
+        return reduce(partial(np.intersect1d, assume_unique=True),
+                      sorted(map(transaction_indices_by_item.__getitem__, item_set), key=len)).shape[0]
+
+    return count
+
+
+def _generate_rules(item_sets: dict[int, dict[tuple[int, ...], int]], transaction_count: int, product_counts: Counter,
+                    min_confidence: Optional[float] = None) -> tuple[Rule, ...]:
     null_base_rules = (Rule((), (product,), count, transaction_count, count, transaction_count)
                        for product, count in product_counts.items())
-    item_sets, rules = apriori(transactions,
-                               min_support=(min(100 / transaction_count, max(2 / transaction_count, 1 / 10))
-                                            if min_support is None
-                                            else min_support),
-                               min_confidence=(1 / 10
-                                               if min_confidence is None
-                                               else min_confidence),
-                               max_length=max(map(len, transactions)),
-                               verbosity=1)
+    rules = generate_rules_apriori(item_sets,
+                                   (1 / 10
+                                    if min_confidence is None
+                                    else min_confidence),
+                                   transaction_count,
+                                   verbosity=1)
     return tuple(chain(null_base_rules, filter(lambda rule: rule.lift > 1, rules)))
 
 
+def _train(transactions: tuple[tuple[int, ...]], min_support: Optional[float] = None,
+           min_confidence: Optional[float] = None) -> tuple[Rule, ...]:
+    return _generate_rules(*_mine(transactions, min_support), min_confidence)
+
+
 def _convert_rules_to_suggestions(rules: tuple[Rule, ...]) -> list[np.array]:
     return thread(rules,
                   (mapcat, lambda rule: ((item, rule.num_transactions, rule.count_full, rule.count_lhs, rule.count_rhs,
@@ -178,8 +320,8 @@ def _convert_rules_to_suggestions(rules: tuple[Rule, ...]) -> list[np.array]:
                   list)
 
 
-def _dump(directory: str, products: tuple[tuple[str, list[tuple[str, Optional[str]]]], ...], suggestions: list[np.array]) \
-        -> None:
+def _dump(directory: str, products: tuple[tuple[str, list[tuple[str, Optional[str]]]], ...], suggestions: list[np.array],
+          top_per_antecedent: Optional[int] = None) -> None:
     products_path = path.join(directory, 'products.tsv')
     suggestions_path = path.join(directory, 'suggestions.npz')
 
@@ -190,12 +332,110 @@ def _dump(directory: str, products: tuple[tuple[str, list[tuple[str, Optional[st
                       (starmap, lambda product_name, lemma_word_pairs: (product_name, repr(lemma_word_pairs)))))
 
     print(f' Writing {len(suggestions):,} rules to {suggestions_path}…')
-    # See https://tonysyu.github.io/ragged-arrays.html for the method to save/load ragged arrays with NumPy.
+    SuggestionRepository(suggestions_path).save_all_suggestions(suggestions, len(products), top_per_antecedent)
+
+
+def _encode_suggestions(suggestions: list[np.array]) -> dict[str, np.ndarray]:
+    # The rules concatenated, with the index of each but the first: the flat layout models had before
+    # SuggestionRepository.save_all_suggestions split the fields of the rules into compact columns. A checkpoint is only
+    # ever read back whole by this script, so it is kept flat rather than written through the repository.
     lengths = [np.shape(array)[0] for array in suggestions]
     indices = np.cumsum(lengths[:-1])
     array = np.concatenate(suggestions)
-    with open(suggestions_path, 'wb') as file:
-        np.savez(file, array=array, indices=indices)
+    return {'array': array, 'indices': indices}
+
+
+def _decode_suggestions(data: Any) -> list[np.array]:
+    return np.split(data['array'], data['indices'])
+
+
+def _encode_transactions(products: tuple[str], transactions: tuple[tuple[int, ...], ...]) -> dict[str, np.ndarray]:
+    # Transactions are stored in the compressed sparse row (CSR) format: the items of transaction i are located at
+    # items[offsets[i]:offsets[i + 1]].
+    return {'products': np.array(products, dtype=str),
+            'offsets': np.cumsum([0, *map(len, transactions)], dtype=np.int64),
+            'items': np.fromiter(chain.from_iterable(transactions), dtype=np.uint32)}
+
+
+def _decode_transactions(data: Any) -> tuple[tuple[str], tuple[tuple[int, ...], ...]]:
+    items = data['items'].tolist()
+    offsets = data['offsets'].tolist()
+    return (tuple(data['products'].tolist()),
+            tuple(tuple(items[start:end]) for start, end in zip(offsets[:-1], offsets[1:])))
+
+
+def _encode_lemmas(products_with_lemmas: tuple[tuple[str, list[tuple[str, Optional[str]]]], ...]) \
+        -> dict[str, np.ndarray]:
+    pairs = tuple(chain.from_iterable(map(second, products_with_lemmas)))
+    return {'products': np.array(tuple(map(first, products_with_lemmas)), dtype=str),
+            'offsets': np.cumsum([0, *map(compose(second, len), products_with_lemmas)], dtype=np.int64),
+            'lemmas': np.array(tuple(map(first, pairs)), dtype=str),
+            'words': np.array(tuple(map(lambda pair: second(pair) or '', pairs)), dtype=str)}  # '' stands for None.
+
+
+def _decode_lemmas(data: Any) -> tuple[tuple[str, list[tuple[str, Optional[str]]]], ...]:
+    pairs = tuple(zip(data['lemmas'].tolist(), map(lambda word: word or None, data['words'].tolist())))
+    offsets = data['offsets'].tolist()
+    return tuple((product, list(pairs[start:end]))
+                 for product, start, end
+                 in zip(data['products'].tolist(), offsets[:-1], offsets[1:]))
+
+
+def _encode_item_sets(item_sets: dict[int, dict[tuple[int, ...], int]], transaction_count: int,
+                      product_counts: Counter) -> dict[str, np.ndarray]:
+    return {'transaction_count': np.array(transaction_count, dtype=np.int64),
+            'product_items': np.fromiter(product_counts.keys(), dtype=np.uint32, count=len(product_counts)),
+            'product_counts': np.fromiter(product_counts.values(), dtype=np.uint32, count=len(product_counts)),
+            **{f'items_{length}': np.array(tuple(counts.keys()), dtype=np.uint32).reshape(-1, length)
+               for length, counts in item_sets.items()},
+            **{f'counts_{length}': np.fromiter(counts.values(), dtype=np.uint32, count=len(counts))
+               for length, counts in item_sets.items()}}
+
+
+def _decode_item_sets(data: Any) -> tuple[dict[int, dict[tuple[int, ...], int]], int, Counter]:
+    return ({int(name.removeprefix('items_')): dict(zip(map(tuple, data[name].tolist()),
+                                                        data[f'counts_{name.removeprefix("items_")}'].tolist()))
+             for name in data.files
+             if name.startswith('items_')},
+            int(data['transaction_count']),
+            Counter(dict(zip(data['product_items'].tolist(), data['product_counts'].tolist()))))
+
+
+def _hash(*parts: Any) -> str:
+    digest = sha256()
+    for part in parts:
+        digest.update(repr(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _run_stage(directory: Optional[str], stage: str, key: str, compute: Callable[[], Any],
+               encode: Callable[[Any], dict[str, np.ndarray]], decode: Callable[[Any], Any]) -> Any:
+    # The checkpoint’s file name carries the hash of the stage’s inputs and parameters, so a stale one is never loaded.
+    if directory is None:
+        return compute()
+    checkpoint_path = path.join(directory, f'{stage}-{key}.npz')
+    if path.exists(checkpoint_path):
+        print(f' Reusing checkpoint {checkpoint_path}…')
+        with np.load(checkpoint_path, allow_pickle=False) as data:
+            return decode(data)
+    start = perf_counter()
+    result = compute()
+    seconds = perf_counter() - start
+    print(f' Writing checkpoint {checkpoint_path}…')
+    os.makedirs(directory, exist_ok=True)
+    with open(temporary_path := f'{checkpoint_path}.tmp', 'wb') as file:  # Never leave a partial checkpoint behind.
+        np.savez_compressed(file, **encode(result), stage_seconds=np.float64(seconds))
+    os.replace(temporary_path, checkpoint_path)
+    return result
+
+
+def _read_stage_seconds(directory: Optional[str], stage: str, key: str) -> Optional[float]:
+    # Returns how long computing the stage took when its checkpoint was written, if there is one.
+    if directory is None or not path.exists(checkpoint_path := path.join(directory, f'{stage}-{key}.npz')):
+        return None
+    with np.load(checkpoint_path, allow_pickle=False) as data:
+        return float(data['stage_seconds']) if 'stage_seconds' in data else None
 
 
 def _is_namedtuple_instance(value: Any) -> bool:
@@ -255,28 +495,90 @@ def _write_csv(file: IO[bytes] | str | TextIOBase, column_names: Optional[Iterab
 
 
 def run() -> None:
-    input_path, exclusions_path, minsupport, minconf, output_path = _parse_args()
+    input_path, exclusions_path, minsupport, minconf, output_path, checkpoints_path, max_antecedents, \
+        top_per_antecedent, redundant, sample, seed, verify_sample = _parse_args()
     print(f'Loading exclusions from {exclusions_path}…')
     exclusions = frozenset(map(int, _read_txt(exclusions_path))
                            if exclusions_path is not None
                            else ())
-    print(f'Preprocessing data from file {input_path}…')
-    with ZipFile(input_path) as archive:
-        products, transactions = _preprocess(archive, exclusions)
-    del exclusions
-    print('Lemmatizing product names…')
-    products_with_lemmas = thread(products,
-                                  (map, juxt(identity, compose(_lemmatize, list))),
-                                  tuple)
-    del products
-    print('Training…')
-    rules = _train(transactions, minsupport, minconf)
-    del transactions
-    print('Generating suggestions…')
-    suggestions = _convert_rules_to_suggestions(rules)
-    del rules
+
+    # Each stage is keyed by a hash of its inputs and parameters, chained through the keys of the stages it depends on,
+    # so that changing a parameter invalidates only the stages downstream of it.
+    print(f'Hashing {input_path}…')
+    ingest_key = _hash('ingest', hash_file(input_path), sorted(exclusions))
+    lemmatize_key = _hash('lemmatize', ingest_key)
+    exact_mine_key = _hash('mine', ingest_key, minsupport)
+    mine_key = (exact_mine_key
+                if sample is None
+                else _hash('mine', ingest_key, minsupport, sample, seed, verify_sample))
+    rules_key = _hash('rules', mine_key, minconf)
+    dump_key = _hash('dump', lemmatize_key, rules_key, max_antecedents, top_per_antecedent, redundant)
+
+    @cache
+    def ingest() -> tuple[tuple[str], tuple[tuple[int, ...], ...]]:
+        def preprocess() -> tuple[tuple[str], tuple[tuple[int, ...], ...]]:
+            with ZipFile(input_path) as archive:
+                return _preprocess(archive, exclusions)
+        print(f'Preprocessing data from file {input_path}…')
+        return _run_stage(checkpoints_path, 'ingest', ingest_key, preprocess,
+                          partial(star, _encode_transactions), _decode_transactions)
+
+    def lemmatize() -> tuple[tuple[str, list[tuple[str, Optional[str]]]], ...]:
+        print('Lemmatizing product names…')
+        return _run_stage(checkpoints_path, 'lemmatize', lemmatize_key,
+                          lambda: thread(first(ingest()),
+                                         (map, juxt(identity, compose(_lemmatize, list))),
+                                         tuple),
+                          _encode_lemmas, _decode_lemmas)
+
+    def mine() -> tuple[dict[int, dict[tuple[int, ...], int]], int, Counter]:
+        print('Training…')
+        if sample is None:
+            return _run_stage(checkpoints_path, 'mine', mine_key, lambda: _mine(second(ingest()), minsupport),
+                              partial(star, _encode_item_sets), _decode_item_sets)
+        start = perf_counter()
+        result = _run_stage(checkpoints_path, 'mine', mine_key,
+                            lambda: _mine_sample(second(ingest()), sample, seed, verify_sample, minsupport),
+                            partial(star, _encode_item_sets), _decode_item_sets)
+        seconds = _read_stage_seconds(checkpoints_path, 'mine', mine_key) or perf_counter() - start
+        if (exact_seconds := _read_stage_seconds(checkpoints_path, 'mine', exact_mine_key)) is not None:
+            print(f' Mined in {seconds:,.1f} s, {exact_seconds / seconds:,.1f}× as fast as mining every transaction.')
+        else:
+            print(f' Mined in {seconds:,.1f} s.')
+        return result
+
+    def generate() -> list[np.array]:
+        print('Generating suggestions…')
+        return _run_stage(checkpoints_path, 'rules', rules_key,
+                          lambda: _convert_rules_to_suggestions(_generate_rules(*mine(), minconf)),
+                          _encode_suggestions, _decode_suggestions)
+
+    dump_marker_path = (path.join(checkpoints_path, f'dump-{dump_key}.txt')
+                        if checkpoints_path is not None
+                        else None)
+    output_paths = (path.join(output_path, 'products.tsv'), path.join(output_path, 'suggestions.npz'))
+    if dump_marker_path is not None and path.exists(dump_marker_path) and all(map(path.exists, output_paths)) \
+            and tuple(_read_txt(dump_marker_path)) == tuple(map(hash_file, output_paths)):
+        print(f'Products and rules in {output_path} are already up to date.')
+        return
+    products_with_lemmas = lemmatize()
+    suggestions = generate()
+    ingest.cache_clear()  # The transactions are no longer needed.
+    print('Compacting suggestions…')
+    suggestion_count = len(suggestions)
+    suggestions = compact(suggestions, max_antecedents, top_per_antecedent)
+    print(f' Kept {len(suggestions):,} rules; dropped {suggestion_count - len(suggestions):,} rules.')
+    if redundant:
+        print('Pruning redundant suggestions…')
+        suggestion_count = len(suggestions)
+        suggestions = prune_redundant(suggestions)
+        print(f' Kept {len(suggestions):,} rules; dropped {suggestion_count - len(suggestions):,} redundant rules.')
     print(f'Saving products and rules to {output_path}…')
-    _dump(output_path, products_with_lemmas, suggestions)
+    _dump(output_path, products_with_lemmas, suggestions, top_per_antecedent)
+    if dump_marker_path is not None:
+        os.makedirs(checkpoints_path, exist_ok=True)
+        with open(dump_marker_path, 'wt', encoding='utf-8') as file:
+            file.writelines(f'{digest}\n' for digest in map(hash_file, output_paths))
 
 
 if __name__ == '__main__':
@@ -1,15 +1,152 @@
 from ast import literal_eval
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from functools import cache
+from hashlib import sha256
+from itertools import compress
+import json
 from lzma import LZMAFile
 import numpy as np
+from os import path, replace
 from smart_open import open, register_compressor
-from typing import Optional
+import struct
+from tempfile import NamedTemporaryFile
+from typing import Iterable, Optional
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
 from helpers import read_csv
-from models import Suggestion
+from models import Suggestion, validate_suggestion_data, validate_suggestion_products
 
 register_compressor('.xz', LZMAFile)
 
+# Suggestions with more antecedent items than this are never served.
+MAX_ANTECEDENT_ITEMS = 9
+
+# The most bytes of a column compressed together in a model saved in blocks
+BLOCK_SIZE = 1 << 20
+
+# The member of a model saved in blocks which lists its columns
+_BLOCK_INDEX = 'index.json'
+
+
+# The compact encoding stores each field of the suggestions as its own column in the narrowest unsigned integer type
+# which can hold it, and the transaction count, identical across all suggestions of a model, is dictionary-encoded. It
+# only makes the file smaller: the suggestions are decoded back into rows of 32-bit integers as they load.
+def _encode_suggestions(suggestions: tuple[np.ndarray, ...]) -> dict[str, np.ndarray]:
+    def narrow(array: np.ndarray) -> np.ndarray:
+        return array.astype(np.min_scalar_type(array.max(initial=0)))
+
+    lengths = np.fromiter(map(len, suggestions), dtype=np.int64, count=len(suggestions))
+    starts = np.cumsum(lengths) - lengths
+    array = (np.concatenate(suggestions)
+             if suggestions
+             else np.empty(0, dtype=np.uint32)).astype(np.int64)
+    antecedent_lengths = lengths - 5
+    antecedent_items = array[np.repeat(starts + 5, antecedent_lengths)
+                             + np.arange(antecedent_lengths.sum())
+                             - np.repeat(np.cumsum(antecedent_lengths) - antecedent_lengths, antecedent_lengths)]
+    transaction_counts, transaction_count_codes = np.unique(array[starts + 1], return_inverse=True)
+    return {'consequent_items': narrow(array[starts]),
+            'transaction_counts': transaction_counts.astype(np.uint32),
+            'transaction_count_codes': narrow(transaction_count_codes),
+            'item_set_counts': narrow(array[starts + 2]),
+            'antecedent_counts': narrow(array[starts + 3]),
+            'consequent_counts': narrow(array[starts + 4]),
+            'antecedent_lengths': narrow(antecedent_lengths),
+            'antecedent_items': narrow(antecedent_items)}
+
+
+def _decode_suggestions(data) -> tuple[np.ndarray, np.ndarray]:
+    # Models saved while the antecedent items of each suggestion were delta-encoded store them as antecedent_deltas.
+    antecedent_lengths = data['antecedent_lengths'].astype(np.int64)
+    lengths = antecedent_lengths + 5
+    starts = np.cumsum(lengths) - lengths
+    array = np.empty(lengths.sum(), dtype=np.uint32)
+    array[starts] = data['consequent_items']
+    array[starts + 1] = data['transaction_counts'][data['transaction_count_codes']]
+    array[starts + 2] = data['item_set_counts']
+    array[starts + 3] = data['antecedent_counts']
+    array[starts + 4] = data['consequent_counts']
+    antecedent_ends = np.cumsum(antecedent_lengths)
+    if 'antecedent_items' in data:
+        antecedent_items = data['antecedent_items']
+    else:
+        antecedent_sums = np.cumsum(data['antecedent_deltas'], dtype=np.int64)
+        antecedent_bases = np.concatenate(([0], antecedent_sums))[antecedent_ends - antecedent_lengths]
+        antecedent_items = antecedent_sums - np.repeat(antecedent_bases, antecedent_lengths)
+    array[np.repeat(starts + 5, antecedent_lengths)
+          + np.arange(antecedent_ends[-1] if len(antecedent_ends) else 0)
+          - np.repeat(antecedent_ends - antecedent_lengths, antecedent_lengths)] = antecedent_items
+    return array, starts[1:]
+
+
+def _compute_checksum(columns: dict[str, np.ndarray]) -> np.ndarray:
+    digest = sha256()
+    for name in sorted(columns.keys() - {'checksum'}):
+        column = np.ascontiguousarray(columns[name])
+        digest.update(f'{name}:{column.dtype.str}:{column.shape}'.encode('utf-8'))
+        digest.update(column.tobytes())
+    return np.frombuffer(digest.digest(), dtype=np.uint8)
+
+
+def _memory_map_arrays(data_file: str) -> dict[str, np.ndarray]:
+    # Maps each array of an uncompressed .npz file into memory where it lies, which np.load does only for .npy files:
+    # every member of the archive is a .npy file stored as is after its local file header.
+    arrays = {}
+    with ZipFile(data_file) as archive, open(data_file, 'rb') as file:
+        for member in archive.infolist():
+            if member.compress_type != ZIP_STORED:
+                raise ValueError(f'{member.filename} in {data_file} is compressed.')
+            file.seek(member.header_offset + 26)
+            file.seek(member.header_offset + 30 + sum(struct.unpack('<HH', file.read(4))))
+            version = np.lib.format.read_magic(file)
+            shape, fortran_order, dtype = (np.lib.format.read_array_header_1_0
+                                           if version == (1, 0)
+                                           else np.lib.format.read_array_header_2_0)(file)
+            arrays[member.filename.removesuffix('.npy')] = \
+                (np.memmap(data_file, dtype, 'r', file.tell(), shape, 'F' if fortran_order else 'C')
+                 if np.prod(shape) > 0
+                 else np.empty(shape, dtype))
+    return arrays
+
+
+def _save_blocks(file, arrays: dict[str, np.ndarray], block_size: int = BLOCK_SIZE) -> None:
+    # Saves the arrays as a ZIP archive of blocks of at most block_size bytes of each, compressed independently of one
+    # another so that they can be decompressed at once, numbered within each array, along with an index of the types
+    # and shapes of the arrays.
+    index = {'block_size': block_size,
+             'columns': {name: {'dtype': array.dtype.str, 'shape': array.shape} for name, array in arrays.items()}}
+    with ZipFile(file, 'w', ZIP_DEFLATED) as archive:
+        archive.writestr(_BLOCK_INDEX, json.dumps(index))
+        for name, array in arrays.items():
+            data = np.ascontiguousarray(array).tobytes()
+            for number, start in enumerate(range(0, len(data), block_size)):
+                archive.writestr(f'{name}/{number}', data[start:start + block_size])
+
+
+def _load_blocks(archive: ZipFile, names: Optional[Iterable[str]] = None) -> dict[str, np.ndarray]:
+    # Decompresses the blocks of a ZIP archive saved by _save_blocks on a pool of threads, each block straight into its
+    # place in arrays allocated up front; zlib and lzma let go of the GIL while they decompress. Only the arrays named
+    # are loaded, if any are, leaving out those the archive lacks.
+    index = json.loads(archive.read(_BLOCK_INDEX))
+    block_size = index['block_size']
+    arrays = {name: np.empty(column['shape'], column['dtype'])
+              for name, column in index['columns'].items()
+              if names is None or name in names}
+
+    def load_block(name: str, number: int) -> None:
+        data = arrays[name].reshape(-1).view(np.uint8)[number * block_size:(number + 1) * block_size]
+        block = archive.read(f'{name}/{number}')
+        if len(block) != len(data):
+            raise ValueError(f'Block {number} of {name} is {len(block):,} bytes long rather than {len(data):,}.')
+        data[:] = np.frombuffer(block, np.uint8)
+
+    with ThreadPoolExecutor() as executor:
+        for future in [executor.submit(load_block, name, number)
+                       for name, array in arrays.items()
+                       for number in range(-(-array.nbytes // block_size))]:
+            future.result()
+    return arrays
+
 
 @dataclass(eq=False, frozen=True, slots=True)
 class ProductRepository:
@@ -26,12 +163,125 @@ class ProductRepository:
 @dataclass(eq=False, frozen=True, slots=True)
 class SuggestionRepository:
     suggestions_data_file: str
+    validate: bool = False  # Whether to validate even models whose checksum proves that they were validated on export
+    product_count: Optional[int] = None
 
-    # See https://tonysyu.github.io/ragged-arrays.html for the method to save/load ragged arrays with NumPy.
+    # A ragged array with no elements holds no suggestions, as every suggestion has at least five.
     def get_all_suggestions(self) -> tuple:
+        array, indices, trusted = self.__load()
+        if not array.shape[0]:
+            return ()
+        if self.validate or not trusted:
+            validate_suggestion_data(array, indices, self.product_count)
+        elif self.product_count is not None:
+            # A model exported against another product list is valid as far as its checksum can tell.
+            validate_suggestion_products(array, indices, self.product_count)
+        lengths = np.diff(np.concatenate(([0], indices, [array.shape[0]])))
+        return tuple(compress(map(Suggestion.from_validated_data, np.split(array, indices)),
+                              lengths - 5 <= MAX_ANTECEDENT_ITEMS))
+
+    def get_all_suggestion_data(self) -> list[np.ndarray]:
+        array, indices, _ = self.__load()
+        return np.split(array, indices) if array.shape[0] else []
+
+    # Models trimmed to the top consequents of each set of antecedent items (see compact_suggestions.py) record how many
+    # they kept, which is as deep as their rankings can be trusted; it is read on its own, without loading the rules.
+    def get_top_per_antecedent(self) -> Optional[int]:
         with open(self.suggestions_data_file, 'rb') as file:
-            data = np.load(file, allow_pickle=False)
-            return tuple(filter(lambda suggestion: len(suggestion.antecedent_items) < 10, map(Suggestion, np.split(data['array'], data['indices']))))
+            with ZipFile(file) as archive:
+                column = (_load_blocks(archive, ('top_per_antecedent',)).get('top_per_antecedent')
+                          if _BLOCK_INDEX in archive.namelist()
+                          else None)
+        return int(column[0]) if column is not None else None
+
+    def save_all_suggestions(self, suggestions: Iterable[np.ndarray], product_count: Optional[int] = None,
+                             top_per_antecedent: Optional[int] = None) -> None:
+        suggestions = tuple(suggestions)
+        if suggestions:
+            validate_suggestion_data(np.concatenate(suggestions),
+                                     np.cumsum([np.shape(array)[0] for array in suggestions[:-1]], dtype=np.int64),
+                                     product_count)
+        columns = _encode_suggestions(suggestions)
+        if top_per_antecedent is not None:
+            columns['top_per_antecedent'] = np.array([top_per_antecedent], dtype=np.uint32)
+        columns['checksum'] = _compute_checksum(columns)
+        with open(self.suggestions_data_file, 'wb') as file:
+            _save_blocks(file, columns)
+
+    # See https://tonysyu.github.io/ragged-arrays.html for the method to save/load ragged arrays with NumPy. Models
+    # saved before the compact encoding was introduced store the ragged array as is, without a checksum, and those
+    # saved before models were saved in blocks are .npz files of the same columns.
+    def __load(self) -> tuple[np.ndarray, np.ndarray, bool]:
+        with open(self.suggestions_data_file, 'rb') as file:
+            with ZipFile(file) as archive:
+                if _BLOCK_INDEX in archive.namelist():
+                    columns = _load_blocks(archive)
+                else:
+                    file.seek(0)
+                    data = np.load(file, allow_pickle=False)
+                    if 'array' in data.files:
+                        return data['array'], data['indices'], False
+                    columns = {name: data[name] for name in data.files}
+        if 'checksum' in columns and not np.array_equal(columns['checksum'], _compute_checksum(columns)):
+            raise ValueError(f'The checksum of {self.suggestions_data_file} does not match its contents.')
+        return *_decode_suggestions(columns), 'checksum' in columns
+
+
+# Responses computed ahead of time are saved uncompressed, so that they are memory-mapped rather than read in whole, and
+# record the version of the model they were computed from.
+@dataclass(eq=False, frozen=True, slots=True)
+class MaterializedSuggestionRepository:
+    materialized_suggestions_data_file: str
+
+    def get_materialized_suggestions(self) -> tuple[str, dict[str, np.ndarray]]:
+        arrays = _memory_map_arrays(self.materialized_suggestions_data_file)
+        return bytes(arrays.pop('model_version')).decode('ascii'), arrays
+
+    def save_materialized_suggestions(self, model_version: str, arrays: dict[str, np.ndarray]) -> None:
+        with open(self.materialized_suggestions_data_file, 'wb') as file:
+            np.savez(file, model_version=np.frombuffer(model_version.encode('ascii'), dtype=np.uint8), **arrays)
+
+
+# Products taken off sale since the model was trained are listed by product identifier, one per line. The file is
+# replaced whole when saved, so that a process reading it never sees it half-written, and no file means that every
+# product is available.
+@dataclass(eq=False, frozen=True, slots=True)
+class AvailabilityRepository:
+    unavailable_products_data_file: str
+
+    def get_unavailable_products(self) -> frozenset[int]:
+        try:
+            with open(self.unavailable_products_data_file, 'rt', encoding='utf-8') as file:
+                return frozenset(map(int, filter(None, map(str.strip, file))))
+        except FileNotFoundError:
+            return frozenset()
+
+    def save_unavailable_products(self, products: Iterable[int]) -> None:
+        directory, name = path.split(path.abspath(self.unavailable_products_data_file))
+        with NamedTemporaryFile('wt', encoding='utf-8', dir=directory, prefix=f'.{name}.', delete=False) as file:
+            file.writelines(f'{product}\n' for product in sorted(set(products)))
+        replace(file.name, self.unavailable_products_data_file)
+
+
+# Sketches of the baskets seen while serving are checkpointed as they stand, uncompressed, and replaced whole like the
+# products off sale, so that a checkpoint cut short never replaces the last one.
+@dataclass(eq=False, frozen=True, slots=True)
+class SketchRepository:
+    sketch_data_file: str
+
+    def get_sketches(self) -> Optional[dict[str, np.ndarray]]:
+        try:
+            with open(self.sketch_data_file, 'rb') as file, np.load(file, allow_pickle=False) as data:
+                return {name: data[name] for name in data.files}
+        except FileNotFoundError:
+            return None
+
+    def save_sketches(self, arrays: dict[str, np.ndarray]) -> None:
+        directory, name = path.split(path.abspath(self.sketch_data_file))
+        with NamedTemporaryFile('wb', dir=directory, prefix=f'.{name}.', suffix='.npz', delete=False) as file:
+            np.savez(file, **arrays)
+        replace(file.name, self.sketch_data_file)
 
 
-__all__ = ('ProductRepository', 'SuggestionRepository')
+__all__ = ('BLOCK_SIZE', 'MAX_ANTECEDENT_ITEMS', 'AvailabilityRepository', 'MaterializedSuggestionRepository',
+           'ProductRepository', 'SketchRepository', 'SuggestionRepository')
@@ -1,19 +1,325 @@
-from fast_autocomplete import AutoComplete
-from functools import partial
-from itertools import chain, groupby, islice, starmap
+from bisect import bisect_left
+from collections import defaultdict, OrderedDict
+import cProfile
+from functools import lru_cache, partial
+from hashlib import sha256
+from itertools import chain, groupby, islice, repeat, starmap
+import heapq
+import json
+from math import inf
+from mmap import mmap
+import multiprocessing
+from multiprocessing.connection import Client, Connection, Listener
+from operator import not_
 import numpy as np
+from os import getpid, path, sched_yield
+import pstats
+from secrets import token_urlsafe
 from settrie import SetTrieMap
+from shutil import rmtree
+from sortedcontainers import SortedList
 import sys
-from time import ctime, time
+from tempfile import mkdtemp
+from threading import Event, get_ident, Lock, Thread
+from time import ctime, monotonic, perf_counter, time
 from toolz import compose_left as compose, identity, juxt, merge_sorted, thread_last as thread, unique
-from typing import Callable, Iterable, Optional
+from typing import Any, Callable, Hashable, Iterable, Iterator, Optional, Sequence
+from weakref import finalize
+from autocomplete import Autocompleter
+from memory import get_deep_size, get_page_usage, get_set_trie_stats
 from models import Suggestion
-from repositories import ProductRepository, SuggestionRepository
-from helpers import first, second, star, tokenize, zipapply
+from repositories import MaterializedSuggestionRepository, ProductRepository, SuggestionRepository
+from sketches import OnlineRuleLearner
+from helpers import first, hash_file, second, tokenize, zipapply
+
+
+# The maximum number of suggestions per page
+MAX_PAGE_SIZE = 100
+
+# The metrics suggestions can be ranked by. Under lift, all the suggestions matching a request rank together; under the
+# others, the suggestions for the basket rank by the metric ahead of those without antecedent items, which rank products
+# by popularity whatever the metric.
+RANKING_METRICS = ('lift', 'confidence', 'support')
+
+# Marks the empty slots of materialized suggestions
+_NO_ITEM = np.iinfo(np.uint32).max
+
+
+def _check_rank_by(rank_by: str) -> None:
+    if rank_by not in RANKING_METRICS:
+        raise ValueError(f'The ranking metric must be one of {", ".join(RANKING_METRICS)}.')
+
+
+def _get_offset(limit: int, cursor: Optional[str]) -> int:
+    # Checks the limit on the suggestions per page and returns the position in the ranked suggestions of the cursor.
+    # Both come straight from JSON request bodies, so their types are checked too.
+    if not (isinstance(limit, int) and not isinstance(limit, bool) and 1 <= limit <= MAX_PAGE_SIZE):
+        raise ValueError(f'The limit must be a number between 1 and {MAX_PAGE_SIZE}.')
+    if cursor is None:
+        return 0
+    if not (isinstance(cursor, str) and cursor.isascii() and cursor.isdigit()):
+        raise ValueError('The cursor is invalid.')
+    return int(cursor)
+
+
+def _end_at_ranking_depth(page: tuple[list[Suggestion], Optional[str], bool], offset: int,
+                          ranking_depth: Optional[int]) -> tuple[list[Suggestion], Optional[str], bool]:
+    # A model trimmed to the top consequents of each set of antecedent items ranks suggestions past that depth
+    # differently from the model it was trimmed from, so that its rankings end there instead.
+    suggestions, next_cursor, truncated = page
+    if ranking_depth is None or offset + len(suggestions) < ranking_depth:
+        return page
+    return suggestions[:max(ranking_depth - offset, 0)], None, truncated
+
+
+def _to_dict(get_name_by_identifier: Callable[[np.uint32], str], suggestion: Suggestion) -> dict:
+    return {'identifier': int(suggestion.consequent_item),
+            'name': get_name_by_identifier(suggestion.consequent_item),
+            'lift': suggestion.lift,
+            'support': suggestion.support,
+            'antecedent_items': [get_name_by_identifier(item) for item in suggestion.antecedent_items]}
+
+
+def _is_available(unavailable: np.ndarray, suggestion: Suggestion) -> bool:
+    return not unavailable[suggestion.consequent_item]
+
+
+def _hash_pair(first_item: int, second_item: int, bits: int) -> int:
+    # Fibonacci hashing: the top bits of a multiplicative hash of the pair pick its slot in a table of 2 ** bits slots.
+    return ((first_item * 0x9E3779B1 ^ second_item) * 0x85EBCA6B & 0xFFFFFFFF) >> (32 - bits)
+
+
+def _get_consequent_items(suggestions: tuple[Suggestion, ...]) -> np.ndarray:
+    consequent_items = np.fromiter(map(lambda suggestion: suggestion.consequent_item, suggestions), np.uint32,
+                                   len(suggestions))
+    consequent_items.setflags(write=False)
+    return consequent_items
+
+
+def _get_metric_orders(suggestions: Sequence[Suggestion]) -> np.ndarray:
+    # The numbers of the suggestions in rank order by each metric but lift, one row per metric: the suggestions with
+    # antecedent items by the metric and then as the suggestions themselves rank, followed by those without. The fields
+    # of all the suggestions are sorted on at once, their antecedent items padded so that longer sets come first.
+    lengths = np.fromiter((len(suggestion.data) for suggestion in suggestions), np.int64, len(suggestions))
+    data = np.zeros((len(suggestions), max(lengths, default=5)), np.int64)
+    rows = np.repeat(np.arange(len(suggestions)), lengths)
+    data[rows, np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)] = \
+        np.concatenate([suggestion.data for suggestion in suggestions] or [np.empty(0, np.uint32)])
+    transaction_counts, item_set_counts, antecedent_counts, consequent_counts = data[:, 1:5].astype(float).T
+    antecedent_keys = np.where(np.arange(5, data.shape[1]) < lengths[:, np.newaxis], -data[:, 5:], 1)
+    keys = (*antecedent_keys.T[::-1], -data[:, 0], -(item_set_counts / transaction_counts),
+            -(transaction_counts * item_set_counts / (antecedent_counts * consequent_counts)))
+    metrics = {'confidence': item_set_counts / antecedent_counts, 'support': item_set_counts / transaction_counts}
+    return np.stack([np.lexsort((*keys, -metrics[metric], lengths == 5)) for metric in RANKING_METRICS[1:]]
+                    or np.empty((0, len(suggestions)), np.int64)).astype(np.uint32)
+
+
+def _get_metric_rank_key(rank_by: str, suggestion: Suggestion) -> tuple:
+    # Sorts in the same order as _get_metric_orders.
+    return not suggestion.antecedent_items, -getattr(suggestion, rank_by), *_get_rank_key(suggestion)
+
+
+def _get_rank_key(suggestion: Suggestion) -> tuple:
+    # Sorts in the same order as the suggestions themselves; the trailing infinity ranks longer sets of antecedent items
+    # ahead of their prefixes, as their descending order does.
+    return (-suggestion.lift, -suggestion.support, -int(suggestion.consequent_item),
+            *(-int(item) for item in suggestion.antecedent_items), inf)
+
+
+def _profile(function: Callable, *arguments: Any) -> tuple[Any, float, dict]:
+    # Calls the function under a deterministic profiler of the calling thread, and returns its result, the seconds it
+    # took, and the statistics of every function profiled, as pstats keeps them.
+    profiler = cProfile.Profile()
+    start = perf_counter()
+    result = profiler.runcall(function, *arguments)
+    return result, perf_counter() - start, pstats.Stats(profiler).stats
+
+
+def _get_profiled_calls(function_stats: dict, *functions: Callable) -> tuple[int, float]:
+    # The calls profiled to the functions, and the seconds spent in them and in the functions they called
+    keys = {(code.co_filename, code.co_firstlineno, code.co_name)
+            for code in map(lambda function: function.__code__, functions)}
+    return (sum(function_stats[key][1] for key in keys if key in function_stats),
+            sum((function_stats[key][3] for key in keys if key in function_stats), 0.0))
+
+
+def _get_slowest_functions(function_stats: dict, count: int = 20) -> list[dict]:
+    # The functions profiled which took the longest, including the functions they called
+    return [{'function': f'{path.basename(file)}:{line}({name})', 'calls': call_count, 'seconds': cumulative_time}
+            for (file, line, name), (_, call_count, _, cumulative_time, _)
+            in sorted(function_stats.items(), key=lambda item: item[1][3], reverse=True)[:count]]
+
+
+class _Flight:
+    # A computation under way, which other threads wait on for its result
+    def __init__(self) -> None:
+        self.done = Event()
+        self.result: Any = None
+        self.succeeded = False
+
+
+class _SingleFlight:
+    # Runs a single computation at a time for each key: callers asking for a key already being computed wait for that
+    # computation and share its result, and compute it themselves if it fails or takes longer than timeout seconds.
+    def __init__(self, timeout: float) -> None:
+        self.__computed_count = self.__coalesced_count = self.__fallback_count = 0
+        self.__flights: dict[Hashable, _Flight] = {}
+        self.__lock = Lock()
+        self.__timeout = timeout
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {'computed': self.__computed_count,
+                    'coalesced': self.__coalesced_count,
+                    'fallbacks': self.__fallback_count}
+
+    def run(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        with self.__lock:
+            if leading := (flight := self.__flights.get(key)) is None:
+                flight = self.__flights[key] = _Flight()
+                self.__computed_count += 1
+        if not leading:
+            succeeded = flight.done.wait(self.__timeout) and flight.succeeded
+            with self.__lock:
+                if succeeded:
+                    self.__coalesced_count += 1
+                else:
+                    self.__fallback_count += 1
+            return flight.result if succeeded else compute()
+        try:
+            flight.result = compute()
+            flight.succeeded = True
+            return flight.result
+        finally:
+            with self.__lock:
+                del self.__flights[key]
+            flight.done.set()
+
+
+class _AvailabilityMask:
+    # Marks the products which must not be suggested by product identifier, along with a digest of them which versions
+    # the mask, in memory shared with the processes forked from this one, such as the workers of a preloaded gunicorn
+    # app, so that a change made by any of them applies to all. Changes are made holding the lock, which is shared too,
+    # and are published as a sequence lock: the sequence number is made odd before the mask and then the digest are
+    # written, and even again after. Readers take no lock; they copy the mask and the digest, and copy them again if the
+    # sequence number was odd or has changed meanwhile, so that a version always comes with the mask it identifies. The
+    # copies are kept until the sequence number next changes, so that most reads only check it.
+    def __init__(self, product_count: int) -> None:
+        memory = mmap(-1, 24 + product_count)
+        self.__sequence = np.frombuffer(memory, np.uint64, 1)
+        self.__digest = np.frombuffer(memory, np.uint8, 16, 8)
+        self.__mask = np.frombuffer(memory, bool, product_count, 24)
+        self.__snapshot: tuple[int, str, np.ndarray] = -1, '', self.__mask
+        self.lock = multiprocessing.Lock()
+        self.set(())
+
+    @property
+    def mask(self) -> np.ndarray:
+        return self.read()[1]
+
+    @property
+    def products(self) -> list[int]:
+        return np.flatnonzero(self.mask).tolist()
+
+    @property
+    def version(self) -> str:
+        return self.read()[0]
+
+    def get_products(self, products: Iterable[int]) -> list[int]:
+        # Returns the product identifiers sorted, without duplicates, and raises ValueError for any unknown product.
+        products = sorted(set(map(int, products)))
+        if products and not (0 <= products[0] and products[-1] < len(self.__mask)):
+            raise ValueError(f'The products must be identified by numbers from 0 to {len(self.__mask) - 1}.')
+        return products
+
+    def read(self) -> tuple[str, np.ndarray]:
+        # Returns the version and the read-only mask it identifies.
+        while True:
+            sequence, snapshot = int(self.__sequence[0]), self.__snapshot
+            if sequence == snapshot[0]:
+                return snapshot[1:]
+            if sequence % 2:
+                sched_yield()
+                continue
+            version, mask = self.__digest.tobytes().hex(), self.__mask.copy()
+            if int(self.__sequence[0]) == sequence:
+                mask.setflags(write=False)
+                self.__snapshot = sequence, version, mask
+                return version, mask
+
+    def set(self, products: Iterable[int]) -> None:
+        # Marks only the products, which must have been checked by get_products; the lock must be held.
+        products = np.fromiter(products, np.int64)
+        mask = np.zeros_like(self.__mask)
+        mask[products] = True
+        self.__sequence[0] += 1
+        self.__mask[:] = mask
+        self.__digest[:] = np.frombuffer(sha256(products.tobytes()).digest(), np.uint8, 16)
+        self.__sequence[0] += 1
+
+
+class _BasketSession:
+    # A basket built up one item at a time, with the sets of antecedent items it matches and the best suggestion for
+    # each consequent item among theirs kept in rank order, so that a change to the basket is applied without matching
+    # the whole basket again.
+    def __init__(self) -> None:
+        self.basket: set[np.int32] = set()
+        self.expiry: float = 0.0
+        self.lock = Lock()  # Held while the basket is changed or its suggestions are ranked
+        self.__best_suggestions: dict[np.int32, tuple[tuple, Suggestion]] = {}
+        self.__matched_suggestions: dict[tuple[np.int32, ...], tuple[Suggestion, ...]] = {}
+        self.__ranked_suggestions: SortedList = SortedList()
+
+    def __rank(self, suggestions: Iterable[Suggestion]) -> None:
+        for suggestion in suggestions:
+            ranked_suggestion = _get_rank_key(suggestion), suggestion
+            best = self.__best_suggestions.get(suggestion.consequent_item)
+            if best is None or ranked_suggestion < best:
+                if best is not None:
+                    self.__ranked_suggestions.remove(best)
+                self.__best_suggestions[suggestion.consequent_item] = ranked_suggestion
+                self.__ranked_suggestions.add(ranked_suggestion)
+
+    def add(self, item: np.int32,
+            antecedent_item_set_suggestions: Iterable[tuple[int, tuple[np.int32, ...],
+                                                            tuple[tuple[Suggestion, ...], np.ndarray, np.ndarray]]]) \
+            -> None:
+        # Only the sets of antecedent items containing the new item can be newly matched.
+        if item in self.basket:
+            return
+        self.basket.add(item)
+        for _, antecedent_items, (suggestions, *_) in antecedent_item_set_suggestions:
+            if all(map(self.basket.__contains__, antecedent_items)):
+                self.__matched_suggestions[antecedent_items] = suggestions
+                self.__rank(suggestions)
+
+    def remove(self, item: np.int32) -> None:
+        # The suggestions still matched are ranked again, without matching the basket again.
+        if item not in self.basket:
+            return
+        self.basket.remove(item)
+        self.__matched_suggestions = {antecedent_items: suggestions
+                                      for antecedent_items, suggestions in self.__matched_suggestions.items()
+                                      if item not in antecedent_items}
+        self.__best_suggestions = {}
+        self.__ranked_suggestions = SortedList()
+        for suggestions in self.__matched_suggestions.values():
+            self.__rank(suggestions)
+
+    def __iter__(self) -> Iterator[Suggestion]:
+        return map(second, self.__ranked_suggestions)
 
 
 class ProductLookupService:
-    def __init__(self, product_repository: ProductRepository, suggestions_repository: SuggestionRepository) -> None:
+    # Safe for use by many threads at once: the indexes are never changed once built, while the caches, sessions and
+    # counters, which are, each have a lock of their own that is only held to look up, store or count something.
+    def __init__(self, product_repository: ProductRepository, suggestions_repository: SuggestionRepository,
+                 max_cost: int = 1, fragment_cache_size: int = 1 << 16, page_cache_size: int = 1024,
+                 session_count: int = 10_000, session_lifetime: float = 30 * 60, term_cache_size: int = 4096,
+                 max_basket_size: Optional[int] = None, basket_time_budget: Optional[float] = None,
+                 materialized_suggestions_repository: Optional[MaterializedSuggestionRepository] = None,
+                 coalescing_timeout: float = 1.0, online_rule_learner: Optional[OnlineRuleLearner] = None) -> None:
         get_time_as_string = compose(time, ctime)
 
         print(f'[{get_time_as_string()}] Initializing ProductLookupService…',
@@ -23,21 +329,70 @@ class ProductLookupService:
         print(f'[{get_time_as_string()}]  Loading suggestions from {suggestions_repository.suggestions_data_file}…',
               file=sys.stderr)
         suggestions = suggestions_repository.get_all_suggestions()
+        self.__ranking_depth: Optional[int] = suggestions_repository.get_top_per_antecedent()
         print(f'[{get_time_as_string()}]   Loaded {len(suggestions):,} suggestions.',
               file=sys.stderr)
 
-        # Index of sets of suggestions by antecedent items (maps sets of Products to sorted sets of Suggestions)
+        # Numbers of the suggestions grouped by their antecedent items
+        rule_number_groups = thread(range(len(suggestions)),
+                                    partial(sorted, key=lambda rule_number: suggestions[rule_number].antecedent_items),
+                                    partial(groupby, key=lambda rule_number: suggestions[rule_number].antecedent_items),
+                                    (map, compose(partial(zipapply, (identity, tuple)), tuple)),
+                                    tuple)
+
+        # Orders of the suggestions by each ranking metric but lift, as permutations of their numbers, and the positions
+        # in those orders of the suggestions of each set of antecedent items, sorted, one row per metric, all sorted at
+        # once rather than set by set
+        print(f'[{get_time_as_string()}]  Ranking suggestions by {", ".join(RANKING_METRICS[1:])}…',
+              file=sys.stderr)
+        metric_orders = _get_metric_orders(suggestions)
+        metric_positions = np.empty_like(metric_orders)
+        metric_positions[np.arange(len(metric_orders))[:, np.newaxis], metric_orders] = \
+            np.arange(len(suggestions), dtype=np.uint32)
+        group_sizes = np.fromiter(map(compose(second, len), rule_number_groups), np.int64, len(rule_number_groups))
+        group_numbers = np.repeat(np.arange(len(rule_number_groups)), group_sizes)
+        group_positions = metric_positions[:, np.fromiter(chain.from_iterable(map(second, rule_number_groups)),
+                                                          np.int64, len(suggestions))]
+        for positions in group_positions:
+            positions[:] = positions[np.lexsort((positions, group_numbers))]
+        group_positions.setflags(write=False)
+        del metric_positions, group_numbers
+        print(f'[{get_time_as_string()}]   Ranked suggestions by {", ".join(RANKING_METRICS[1:])}.',
+              file=sys.stderr)
+
+        # Index of sets of suggestions by antecedent items (maps sets of Products to sorted sets of Suggestions, along
+        # with arrays of their consequent items for filtering them by product without going through them one by one,
+        # and of their positions in the order of each ranking metric for merging them in that order)
         print(f'[{get_time_as_string()}]  Creating association rule-based suggestions indexed by antecedent item sets…',
               file=sys.stderr)
-        suggestions_by_antecedent_items = \
-            thread(suggestions,
-                   partial(sorted, key=lambda suggestion: suggestion.antecedent_items),
-                   partial(groupby, key=lambda suggestion: suggestion.antecedent_items),
-                   (map, partial(zipapply, (identity, compose(sorted, tuple)))),
-                   SetTrieMap)
+        antecedent_item_set_suggestions = \
+            tuple((antecedent_items,
+                   (antecedent_suggestions := tuple(sorted(map(suggestions.__getitem__, rule_numbers))),
+                    _get_consequent_items(antecedent_suggestions),
+                    positions))
+                  for (antecedent_items, rule_numbers), positions
+                  in zip(rule_number_groups, np.split(group_positions, np.cumsum(group_sizes)[:-1], axis=1)))
+        del rule_number_groups, group_positions
+        suggestions_by_antecedent_items = SetTrieMap(antecedent_item_set_suggestions)
         print(f'[{get_time_as_string()}]   Created association rule-based suggestions indexed by antecedent item sets.',
               file=sys.stderr)
 
+        # Index of the same by each of their antecedent items, for updating the suggestions for a session’s basket and
+        # for matching baskets within a time budget, numbered in rank order of the best suggestion of each set of
+        # antecedent items so that the sets for several items are merged into that order by comparing numbers alone
+        print(f'[{get_time_as_string()}]  Indexing antecedent item sets by item…',
+              file=sys.stderr)
+        antecedent_item_set_suggestions_by_item = defaultdict(list)
+        for rank, (antecedent_items, antecedent_suggestion_group) in \
+                enumerate(sorted(antecedent_item_set_suggestions, key=compose(second, first, first, _get_rank_key))):
+            for item in antecedent_items:
+                antecedent_item_set_suggestions_by_item[item].append((rank, antecedent_items,
+                                                                      antecedent_suggestion_group))
+        del antecedent_item_set_suggestions
+        print(f'[{get_time_as_string()}]   Indexed antecedent item sets by'
+              f' {len(antecedent_item_set_suggestions_by_item):,} items.',
+              file=sys.stderr)
+
         # Dictionary of Product to lemma-word pairs and tuple of Products indexed by product identifier
         print(f'[{get_time_as_string()}]  Loading products from {product_repository.products_data_file}…',
               file=sys.stderr)
@@ -47,7 +402,12 @@ class ProductLookupService:
               file=sys.stderr)
 
         # Default product suggestions sorted in descending order of support (lift being exactly 1.0 for all Suggestions)
-        default_suggestions = suggestions_by_antecedent_items.get(())
+        default_suggestion_group = suggestions_by_antecedent_items.get(())
+        default_suggestions, default_consequent_items, _ = default_suggestion_group
+        # Positions of the same by product identifier, for ranking any of them by sorting numbers
+        default_suggestion_ranks = np.full(len(products), len(default_suggestions), np.uint32)
+        default_suggestion_ranks[default_consequent_items] = np.arange(len(default_suggestions), dtype=np.uint32)
+        default_suggestion_ranks.setflags(write=False)
 
         # Index of sets of products by words in product names (maps sets of words to sorted sets of Suggestions)
         print(f'[{get_time_as_string()}]  Creating search index by product name…',
@@ -84,84 +444,1040 @@ class ProductLookupService:
                                                     unique,
                                                     tuple)))),
                    dict,  # Mapping of lemmas to a set of their other forms
-                   juxt(lambda dictionary: dict.fromkeys(dictionary.keys(), {}),  # Words with empty context dictionaries
-                        identity),  # Unchanged dictionary to be passed on to AutoComplete as the synonyms argument
-                   partial(star, AutoComplete))  # Calls the AutoComplete constructor with the two dictionaries
+                   partial(Autocompleter, max_cost=max_cost))
         print(f'[{get_time_as_string()}]   Initialized autocompleter for product names.',
               file=sys.stderr)
 
+        # Sorted vocabulary of lemmas and their other forms, each mapped to its lemma, and the default suggestions of
+        # products whose names contain each lemma in descending order of popularity, for answering prefix completions
+        print(f'[{get_time_as_string()}]  Creating prefix completion index by product name…',
+              file=sys.stderr)
+        default_suggestions_by_lemma = defaultdict(list)
+        for suggestion in default_suggestions:
+            for lemma in unique(map(first, product_name_lemmas[products[suggestion.consequent_item]])):
+                default_suggestions_by_lemma[lemma].append(suggestion)
+        vocabulary = thread(product_name_lemmas.values(),
+                            chain.from_iterable,
+                            (map, lambda pair: ((word, pair[0]) for word in filter(None, pair))),  # Word-lemma pairs
+                            chain.from_iterable,
+                            (filter, lambda pair: pair[1] in default_suggestions_by_lemma),
+                            set,
+                            sorted)
+        print(f'[{get_time_as_string()}]   Created prefix completion index of {len(vocabulary):,} words.',
+              file=sys.stderr)
+
+        # Version of the model, which identifies the responses it gives
+        model_version = sha256(' '.join(map(hash_file, (product_repository.products_data_file,
+                                                        suggestions_repository.suggestions_data_file))).encode())
+
+        # Top suggestions computed ahead of time for baskets of a single item and for pairs of items, by rule number
+        materialized_suggestions, materialized_single_count, materialized_pair_count = {}, 0, 0
+        if materialized_suggestions_repository is not None:
+            print(f'[{get_time_as_string()}]  Loading materialized suggestions from'
+                  f' {materialized_suggestions_repository.materialized_suggestions_data_file}…',
+                  file=sys.stderr)
+            materialized_model_version, materialized_suggestions = \
+                materialized_suggestions_repository.get_materialized_suggestions()
+            if materialized_model_version == model_version.hexdigest():
+                materialized_single_count = len(materialized_suggestions['single_suggestions'])
+                materialized_pair_count = int(np.count_nonzero(materialized_suggestions['pair_items'][:, 0]
+                                                               != _NO_ITEM))
+                print(f'[{get_time_as_string()}]   Loaded materialized suggestions for'
+                      f' {materialized_single_count:,} single items and {materialized_pair_count:,} pairs of items.',
+                      file=sys.stderr)
+            else:
+                materialized_suggestions = {}
+                print(f'[{get_time_as_string()}]   Ignored materialized suggestions computed from another model.',
+                      file=sys.stderr)
+
         # Private instance fields
         def get_suggestions_by_words(words: Iterable[str]) -> set[Suggestion]:
             result = set()
             for word in words:
-                for suggestions in suggestions_by_word.itersupersets(word, 'values'):
+                for suggestions in suggestions_by_word.itersupersets((word,), 'values'):
                     result.update(suggestions)
             return result
 
-        self.__autocomplete: Callable[[str], list[str]] = partial(autocompleter.search, max_cost=1, size=3)
+        self.__autocomplete: Callable[[str], list[str]] = partial(autocompleter.search, size=3)
+        # Products taken off sale, which are never suggested, shared with the processes forked from this one
+        self.__availability = _AvailabilityMask(len(products))
         self.__default_suggestions: tuple[Suggestion, ...] = default_suggestions
-        self.__get_name_by_identifier = products.__getitem__
+        self.__default_suggestion_group: tuple[tuple[Suggestion, ...], np.ndarray, np.ndarray] = \
+            default_suggestion_group
+        self.__default_suggestion_ranks: np.ndarray = default_suggestion_ranks
+        self.__default_suggestions_by_lemma: dict[str, tuple[Suggestion, ...]] = \
+            dict(zip(default_suggestions_by_lemma.keys(), map(tuple, default_suggestions_by_lemma.values())))
+        self.__get_lemmas_by_identifier = compose(products.__getitem__, product_name_lemmas.__getitem__,
+                                                  partial(map, first), frozenset)
         self.__get_suggestions_by_antecedent_items = partial(suggestions_by_antecedent_items.itersubsets, mode='values')
         self.__get_suggestions_by_words = get_suggestions_by_words
         self.__has_suggestions_by_antecedent_items = partial(suggestions_by_antecedent_items.hassubset)
+        # Limits on the baskets accepted and on the time spent matching each basket, and how many were cut short
+        self.__basket_time_budget = basket_time_budget
+        self.__max_basket_size = max_basket_size
+        self.__truncated_request_count = 0
+        # Held while any of the counters of requests is updated or read
+        self.__counter_lock = Lock()
+        self.__model_version: str = model_version.hexdigest()
+        # Rules in the order the materialized suggestions number them, and how often those answered requests
+        self.__materialized_pair_items: Optional[np.ndarray] = materialized_suggestions.get('pair_items')
+        self.__materialized_pair_suggestions: Optional[np.ndarray] = materialized_suggestions.get('pair_suggestions')
+        self.__materialized_single_suggestions: Optional[np.ndarray] = \
+            materialized_suggestions.get('single_suggestions')
+        self.__materialized_hits = self.__materialized_misses = 0
+        self.__materialized_pair_count = materialized_pair_count
+        self.__materialized_single_count = materialized_single_count
+        # Rules of a single antecedent item learned from the baskets seen since the model was mined, if any are
+        self.__online_rule_learner = online_rule_learner
+        self.__suggestions: tuple[Suggestion, ...] = suggestions
+        # The same in the order of each ranking metric but lift, and their consequent items in that order
+        self.__metric_ranked_consequent_items: np.ndarray = _get_consequent_items(suggestions)[metric_orders]
+        self.__metric_ranked_consequent_items.setflags(write=False)
+        self.__metric_ranked_suggestions: tuple[tuple[Suggestion, ...], ...] = \
+            tuple(tuple(map(suggestions.__getitem__, order.tolist())) for order in metric_orders)
+        # The suggestions paged through so far and the rest yet to be ranked, of the most recently paged requests
+        self.__page_cache_size = page_cache_size
+        self.__page_lock = Lock()
+        # Identical requests being ranked at the same time, each ranked only once
+        self.__single_flight = _SingleFlight(coalescing_timeout)
+        # Baskets being built up by sessions, the least recently used first, which expire after a period of disuse
+        self.__get_antecedent_item_set_suggestions_by_item = \
+            lambda item: antecedent_item_set_suggestions_by_item.get(item, ())
+        self.__session_count = session_count
+        self.__session_lifetime = session_lifetime
+        self.__session_lock = Lock()
+        self.__sessions: OrderedDict[str, _BasketSession] = OrderedDict()
+        self.__pages: OrderedDict[tuple[frozenset[np.int32], str, str, str, int],
+                                  tuple[list[Suggestion], Iterator[Suggestion], bool]] = OrderedDict()
+        # JSON fragments of the most recently served suggestions, serialized as Flask’s jsonify would
+        self.__to_dict: Callable[[Suggestion], dict] = partial(_to_dict, products.__getitem__)
+        self.__serialize: Callable[[Suggestion], bytes] = \
+            lru_cache(maxsize=fragment_cache_size)(compose(self.__to_dict,
+                                                           partial(json.dumps, sort_keys=True, separators=(',', ':')),
+                                                           str.encode))
+        # Products matching each of the most recently searched terms, the least recently used first, with the range of
+        # the sorted vocabulary beginning with the terms if any of it does, the lemmas they matched, and how often
+        # searches for terms were answered from them
+        self.__term_cache_size = term_cache_size
+        self.__term_cache_lock = Lock()
+        self.__term_suggestions: OrderedDict[str, tuple[Optional[tuple[int, int]], frozenset[str],
+                                                        frozenset[Suggestion]]] = OrderedDict()
+        self.__term_cache_hits = self.__term_cache_refinements = self.__term_cache_misses = 0
+        self.__vocabulary_lemmas: tuple[str, ...] = tuple(map(second, vocabulary))
+        self.__vocabulary_words: tuple[str, ...] = tuple(map(first, vocabulary))
+        # The structures requests are answered from, by name, each with a function describing its shape, for measuring
+        # their memory; the suggestions of the rules come first, as every index shares them.
+        self.__structures: dict[str, tuple[Callable[[], dict], tuple]] = {
+            'rules': (lambda: {'entries': len(suggestions)},
+                      (suggestions, self.__metric_ranked_suggestions, self.__metric_ranked_consequent_items,
+                       default_suggestion_ranks)),
+            'products': (lambda: {'entries': len(products)}, (products, product_name_lemmas)),
+            'antecedent_index': (lambda: get_set_trie_stats(suggestions_by_antecedent_items.keys()),
+                                 (suggestions_by_antecedent_items,)),
+            'antecedent_item_index': (lambda: {'entries': len(antecedent_item_set_suggestions_by_item)},
+                                      (antecedent_item_set_suggestions_by_item,)),
+            'word_index': (lambda: {**get_set_trie_stats(suggestions_by_word.keys()),
+                                    'lemmas': len(self.__default_suggestions_by_lemma),
+                                    'words': len(self.__vocabulary_words)},
+                           (suggestions_by_word, self.__default_suggestions_by_lemma, self.__vocabulary_lemmas,
+                            self.__vocabulary_words)),
+            'autocompleter': (lambda: autocompleter.stats, (autocompleter,))}
 
         print(f'[{get_time_as_string()}]  Initialized ProductLookupService.',
               file=sys.stderr)
 
-    def __get_basket_suggestions(self, basket: frozenset[np.int32]) -> Optional[Iterable[Suggestion]]:
-        if not self.__has_suggestions_by_antecedent_items(basket):
-            return None
-        return merge_sorted(*self.__get_suggestions_by_antecedent_items(basket))
+    @property
+    def model_version(self) -> str:
+        return self.__model_version
+
+    @property
+    def availability_version(self) -> str:
+        return self.__availability.version
+
+    @property
+    def unavailable_products(self) -> list[int]:
+        return self.__availability.products
+
+    @property
+    def online_rules_version(self) -> str:
+        return '' if self.__online_rule_learner is None else str(self.__online_rule_learner.version)
+
+    @property
+    def stats(self) -> dict:
+        with self.__counter_lock, self.__term_cache_lock:
+            return {'truncated_requests': self.__truncated_request_count,
+                    'unavailable_products': int(np.count_nonzero(self.__availability.mask)),
+                    'online_learning': (None
+                                        if self.__online_rule_learner is None
+                                        else self.__online_rule_learner.stats),
+                    'coalescing': self.__single_flight.stats,
+                    'materialized': {'single_items': self.__materialized_single_count,
+                                     'pairs': self.__materialized_pair_count,
+                                     'hits': self.__materialized_hits,
+                                     'misses': self.__materialized_misses},
+                    'term_cache': {'size': len(self.__term_suggestions),
+                                   'hits': self.__term_cache_hits,
+                                   'refinements': self.__term_cache_refinements,
+                                   'misses': self.__term_cache_misses}}
+
+    def get_memory_stats(self) -> dict:
+        # Reports the bytes taken by each structure requests are answered from, each object counted with the first
+        # structure reaching it, along with its entries and the shape of its set-tries, then the same of the caches, and
+        # the resident pages of this process, split between those shared with the other processes forked from the same
+        # parent and those private to it. Measuring walks every object of the model, which takes seconds for large ones.
+        # The nodes of a set-trie are kept by the settrie extension, out of reach of the garbage collector through which
+        # objects are measured, so that only its values, which are Python objects, are counted with it, and its bytes
+        # are reported as a lower bound.
+        seen = set()
+        structures = {name: {**describe(),
+                             'bytes': get_deep_size(chain(objects, *(obj.values()
+                                                                     for obj in objects
+                                                                     if isinstance(obj, SetTrieMap))),
+                                                    seen),
+                             **({'bytes_lower_bound': True}
+                                if any(isinstance(obj, SetTrieMap) for obj in objects)
+                                else {})}
+                      for name, (describe, objects) in self.__structures.items()}
+        # The materialized suggestions are mapped from their file rather than read into memory.
+        structures['materialized'] = {'single_items': self.__materialized_single_count,
+                                      'pairs': self.__materialized_pair_count,
+                                      'bytes': sum(array.nbytes
+                                                   for array in (self.__materialized_single_suggestions,
+                                                                 self.__materialized_pair_items,
+                                                                 self.__materialized_pair_suggestions)
+                                                   if array is not None)}
+        if self.__online_rule_learner is not None:
+            structures['online_rules'] = {'entries': self.__online_rule_learner.stats['rules'],
+                                          'bytes': get_deep_size((self.__online_rule_learner.get_rules(),), seen)}
+        with self.__page_lock:
+            pages = {'entries': len(self.__pages), 'bytes': get_deep_size((self.__pages,), seen)}
+        with self.__session_lock:
+            sessions = {'entries': len(self.__sessions), 'bytes': get_deep_size((self.__sessions,), seen)}
+        with self.__term_cache_lock:
+            terms = {'entries': len(self.__term_suggestions), 'bytes': get_deep_size((self.__term_suggestions,), seen)}
+        fragments = {'entries': self.__serialize.cache_info().currsize,
+                     'bytes': get_deep_size((self.__serialize,), seen)}
+        return {'structures': structures,
+                'caches': {'pages': pages, 'sessions': sessions, 'terms': terms, 'fragments': fragments},
+                'process': get_page_usage()}
+
+    def __get_basket_suggestions(self, basket: frozenset[np.int32]) \
+            -> tuple[Optional[list[tuple[tuple[Suggestion, ...], np.ndarray, np.ndarray]]], bool]:
+        # Returns the sorted suggestions of each set of antecedent items within the basket, along with their consequent
+        # items and their positions by each ranking metric, and whether matching the basket was cut short. Without a
+        # time budget, every set of antecedent items within the basket is matched at once. With one, the sets containing
+        # any item in the basket are checked in rank order of their best suggestions until the budget runs out, so that
+        # a basket cut short still gets the suggestions most likely to be ranked first.
+        if self.__basket_time_budget is None:
+            if not self.__has_suggestions_by_antecedent_items(basket):
+                return None, False
+            return list(self.__get_suggestions_by_antecedent_items(basket)), False
+        deadline = monotonic() + self.__basket_time_budget
+        matched_suggestions, truncated = [self.__default_suggestion_group] if self.__default_suggestions else [], False
+        antecedent_item_set_suggestions = heapq.merge(*map(self.__get_antecedent_item_set_suggestions_by_item, basket))
+        for _, antecedent_items, antecedent_suggestion_group in unique(antecedent_item_set_suggestions, first):
+            if monotonic() > deadline:
+                truncated = True
+                with self.__counter_lock:
+                    self.__truncated_request_count += 1
+                break
+            if all(map(basket.__contains__, antecedent_items)):
+                matched_suggestions.append(antecedent_suggestion_group)
+        return matched_suggestions or None, truncated
+
+    def __get_online_suggestions(self, basket: frozenset[np.int32]) \
+            -> list[tuple[tuple[Suggestion, ...], np.ndarray, None]]:
+        # Returns the sorted suggestions learned online for each item in the basket which has any, along with their
+        # consequent items; they have no positions by the other ranking metrics, under which they are not ranked.
+        if self.__online_rule_learner is None or not basket:
+            return []
+        rules = self.__online_rule_learner.get_rules()
+        return [(*rules[item], None) for item in map(int, basket) if item in rules]
+
+    def __get_product_mask(self, suggestions: Iterable[Suggestion], basket: frozenset[np.int32]) -> np.ndarray:
+        # Marks the consequent items of the suggestions, except those already in the basket, by product identifier.
+        product_mask = np.zeros(len(self.__default_suggestion_ranks), bool)
+        product_mask[np.fromiter(map(lambda suggestion: suggestion.consequent_item, suggestions), np.uint32)] = True
+        basket_items = np.fromiter(basket, np.int64, len(basket))
+        product_mask[basket_items[(basket_items >= 0) & (basket_items < len(product_mask))]] = False
+        return product_mask
+
+    def __get_default_suggestions(self, product_mask: np.ndarray) -> Iterator[Suggestion]:
+        # The default suggestions for the marked products, ranked by sorting their positions among all of them
+        return map(self.__default_suggestions.__getitem__,
+                   np.sort(self.__default_suggestion_ranks[np.flatnonzero(product_mask)]))
+
+    def __get_suggestions_by_term(self, term: str) -> frozenset[Suggestion]:
+        # A term matches the lemmas of the words in the vocabulary beginning with it and, only when there are none,
+        # those it is autocompleted to, misspellings and all. As a query is typed, each term usually extends one
+        # searched for just before, whose words are narrowed down to those beginning with the term within their range
+        # of the sorted vocabulary, and whose products are filtered to those matching the remaining lemmas, without
+        # autocompleting the term or searching the index of product names again. The cache is only locked to look up
+        # and store entries, which are never changed, so that threads search for terms at the same time.
+        term = term.lower()
+        with self.__term_cache_lock:
+            if (cached := self.__term_suggestions.get(term)) is not None:
+                self.__term_cache_hits += 1
+                self.__term_suggestions.move_to_end(term)
+                return cached[2]
+            cached = next(filter(None, map(self.__term_suggestions.get,
+                                           (term[:length] for length in range(len(term) - 1, 0, -1)))), None)
+        if cached is not None and cached[0] is not None:
+            words = self.__get_vocabulary_range(term, *cached[0])
+        else:
+            words = self.__get_vocabulary_range(term)
+        if words[0] < words[1]:
+            lemmas = frozenset(self.__vocabulary_lemmas[slice(*words)])
+        else:
+            words, lemmas = None, frozenset(self.__autocomplete(term))
+        if cached is None or not lemmas <= cached[1]:
+            cached = None
+            suggestions = frozenset(self.__get_suggestions_by_words(lemmas))
+        else:
+            suggestions = frozenset(filter(compose(lambda suggestion: suggestion.consequent_item,
+                                                   self.__get_lemmas_by_identifier,
+                                                   lemmas.isdisjoint,
+                                                   not_),
+                                           cached[2]))
+        with self.__term_cache_lock:
+            if cached is not None:
+                self.__term_cache_refinements += 1
+            else:
+                self.__term_cache_misses += 1
+            self.__term_suggestions[term] = words, lemmas, suggestions
+            if len(self.__term_suggestions) > self.__term_cache_size:
+                self.__term_suggestions.popitem(last=False)
+        return suggestions
 
     def __get_products_from_query(self, query: str) -> Optional[Iterable[Suggestion]]:
         if not query:
             return None
-        terms = tokenize(query)
-        suggestion_sets = (self.__get_suggestions_by_words(word)
-                           for word in (self.__autocomplete(term)
-                                        for term in terms))
+        suggestion_sets = map(self.__get_suggestions_by_term, tokenize(query))
         try:
-            results = next(suggestion_sets)
+            results = set(next(suggestion_sets))
         except StopIteration:
             return frozenset()
         for suggestions in suggestion_sets:
             results.intersection_update(suggestions)
         return results
 
-    def get_suggestions(self, basket: Iterable[int] = frozenset(), query: str = '') -> list[dict]:
+    def __get_lemmas_by_prefix(self, prefix: str) -> frozenset[str]:
+        return frozenset(self.__vocabulary_lemmas[slice(*self.__get_vocabulary_range(prefix))])
+
+    def __get_vocabulary_range(self, prefix: str, start: int = 0, end: Optional[int] = None) -> tuple[int, int]:
+        # Every word in the vocabulary starting with the prefix lies in one contiguous range of the sorted array, within
+        # that of any shorter prefix of it.
+        end = len(self.__vocabulary_words) if end is None else end
+        start = bisect_left(self.__vocabulary_words, prefix, start, end)
+        return start, bisect_left(self.__vocabulary_words, prefix + '\U0010ffff', start, end)
+
+    def __get_lemma_by_word(self, word: str) -> Optional[str]:
+        index = bisect_left(self.__vocabulary_words, word)
+        return (self.__vocabulary_lemmas[index]
+                if index < len(self.__vocabulary_words) and self.__vocabulary_words[index] == word
+                else None)
+
+    def __to_json(self, suggestions: Iterable[Suggestion]) -> bytes:
+        return b'[' + b','.join(map(self.__serialize, suggestions)) + b']'
+
+    def __complete(self, query: str) -> list[Suggestion]:
+        # Only when nothing begins with the last term of the query is the query searched for as in get_suggestions,
+        # misspellings and all.
+        return self.__complete_prefix(query) or first(self.__suggest(frozenset(), query))
+
+    def __complete_prefix(self, query: str) -> list[Suggestion]:
+        # Completes the last term of the query as a prefix of the words in product names, the other terms having to be
+        # whole words.
+        *terms, prefix = chain(('',), query.lower().split())
+        lemmas = tuple(map(self.__get_lemma_by_word, tokenize(' '.join(terms))))
+        prefix_lemmas = self.__get_lemmas_by_prefix(prefix) if prefix and None not in lemmas else ()
+        suggestions = unique(filter(partial(_is_available, self.__availability.mask),
+                                    merge_sorted(*map(self.__default_suggestions_by_lemma.__getitem__, prefix_lemmas))),
+                             lambda suggestion: suggestion.consequent_item)
+        if lemmas:
+            lemmas = frozenset(lemmas)
+            suggestions = filter(compose(lambda suggestion: suggestion.consequent_item,
+                                         self.__get_lemmas_by_identifier,
+                                         lemmas.issubset),
+                                 suggestions)
+        return list(islice(suggestions, 10))
+
+    def __get_metric_ranked_suggestions(self, basket_suggestions: Iterable[tuple[tuple[Suggestion, ...], np.ndarray,
+                                                                                 np.ndarray]],
+                                        rank_by: str, product_mask: Optional[np.ndarray]) -> Iterator[Suggestion]:
+        # The suggestions with antecedent items for the basket, for the marked products if any are, ranked by the metric
+        # by merging their positions in its order; the default suggestions are left for the caller to follow them with.
+        metric = RANKING_METRICS.index(rank_by) - 1
+        ranked_suggestions = self.__metric_ranked_suggestions[metric]
+        positions = (group_positions[metric]
+                     for suggestions, _, group_positions in basket_suggestions
+                     if suggestions is not self.__default_suggestions)
+        if product_mask is not None:
+            consequent_items = self.__metric_ranked_consequent_items[metric]
+            positions = (metric_positions[product_mask[consequent_items[metric_positions]]]
+                         for metric_positions in positions)
+        return map(ranked_suggestions.__getitem__, heapq.merge(*map(np.ndarray.tolist, positions)))
+
+    def __rank(self, basket_products: frozenset[np.int32], query: str, session: Optional[_BasketSession] = None,
+               rank_by: str = 'lift', unavailable: Optional[np.ndarray] = None) -> tuple[Iterator[Suggestion], bool]:
+        # Returns the ranked suggestions, and whether matching the basket was cut short by the time budget. Products
+        # are skipped as marked in the mask of those taken off sale read by the caller, if it passes one.
         # Determine what to get suggestions for; execute only the code necessary to fulfill the request.
-        query_suggestions = self.__get_products_from_query(query.strip())
-        if basket:
-            basket_products = frozenset(map(np.int32, basket))
-            basket_suggestions = self.__get_basket_suggestions(basket_products)
+        query_suggestions = self.__get_products_from_query(query)
+        truncated = False
+        if not basket_products:
+            basket_suggestions = None
+        elif session is not None:  # A session has already matched its basket.
+            basket_suggestions = session
         else:
-            basket_suggestions = basket_products = None
+            basket_suggestions, truncated = self.__get_basket_suggestions(basket_products)
+        # Rules learned online rank along with the mined ones under lift, as if they had been matched with the basket.
+        online_suggestions = self.__get_online_suggestions(basket_products) if rank_by == 'lift' else []
+        if online_suggestions and session is not None:
+            basket_suggestions = merge_sorted(session, *map(first, online_suggestions))
+        elif online_suggestions:
+            basket_suggestions = (basket_suggestions or [self.__default_suggestion_group]) + online_suggestions
 
         # Grab the relevant suggestions based on the request and whether results are available.
         match query_suggestions is None, basket_suggestions is None:
             case True, True:  # No query, and basket suggestions came up empty
                 suggestions = self.__default_suggestions
+            case _, False if rank_by != 'lift':  # Basket suggestions ranked by another metric than lift
+                product_mask = (None
+                                if query_suggestions is None
+                                else self.__get_product_mask(query_suggestions, basket_products))
+                suggestions = chain(self.__get_metric_ranked_suggestions(basket_suggestions, rank_by, product_mask),
+                                    (self.__default_suggestions
+                                     if product_mask is None
+                                     else self.__get_default_suggestions(product_mask)))
             case True, False:  # No query, but there were some basket suggestions
-                suggestions = basket_suggestions
+                suggestions = (merge_sorted(basket_suggestions, self.__default_suggestions)
+                               if session is not None
+                               else merge_sorted(*map(first, basket_suggestions)))
             case False, True:  # Possible query results, but basket suggestions came up empty
-                suggestions = sorted(query_suggestions)
+                suggestions = self.__get_default_suggestions(self.__get_product_mask(query_suggestions,
+                                                                                     basket_products))
             case _:  # Possible query results, and also basket suggestions
-                query_products = frozenset(map(lambda suggestion: suggestion.consequent_item, query_suggestions))
-                suggestions = filter(lambda suggestion: suggestion.consequent_item in query_products,
-                                     chain(basket_suggestions, self.__default_suggestions))
+                # Only the suggestions for products matching the query are merged: those of each set of antecedent
+                # items are picked out by masking their consequent items, and the default ones by their positions.
+                product_mask = self.__get_product_mask(query_suggestions, basket_products)
+                if session is not None:
+                    basket_suggestions = filter(lambda suggestion: product_mask[suggestion.consequent_item],
+                                                basket_suggestions)
+                else:
+                    basket_suggestions = merge_sorted(*(tuple(map(suggestions.__getitem__, indices))
+                                                        for suggestions, consequent_items, _ in basket_suggestions
+                                                        if suggestions is not self.__default_suggestions
+                                                        and (indices := np.flatnonzero(product_mask[consequent_items]))
+                                                        .size))
+                suggestions = merge_sorted(basket_suggestions, self.__get_default_suggestions(product_mask))
 
-        # Filter for 10 unique products.
-        unique_suggestions = unique(suggestions, lambda suggestion: suggestion.consequent_item)
+        # Filter for unique products, skipping those taken off sale.
+        unique_suggestions = filter(partial(_is_available,
+                                            self.__availability.mask if unavailable is None else unavailable),
+                                    unique(suggestions, lambda suggestion: suggestion.consequent_item))
         if basket_products:
             unique_suggestions = filter(lambda suggestion: suggestion.consequent_item not in basket_products,
                                         unique_suggestions)
-        return list({'identifier': int(suggestion.consequent_item),
-                     'name': self.__get_name_by_identifier(suggestion.consequent_item),
-                     'lift': suggestion.lift,
-                     'support': suggestion.support,
-                     'antecedent_items': [self.__get_name_by_identifier(item)
-                                          for item in suggestion.antecedent_items]}
-                    for suggestion in islice(unique_suggestions, 10))
+        return iter(unique_suggestions), truncated
+
+    def __check_basket_size(self, basket_size: int) -> None:
+        if self.__max_basket_size is not None and basket_size > self.__max_basket_size:
+            raise ValueError(f'The basket must hold at most {self.__max_basket_size} items.')
+
+    def __get_materialized_suggestions(self, basket: frozenset[np.int32]) -> Optional[np.ndarray]:
+        # Looks up the rule numbers of the top suggestions for a basket of a single item or a pair of items. Pairs are
+        # found by linear probing from the slots their hashes pick.
+        items = sorted(map(int, basket))
+        if len(items) == 1:
+            if not 0 <= items[0] < len(self.__materialized_single_suggestions):
+                return None
+            rule_numbers = self.__materialized_single_suggestions[items[0]]
+        else:
+            slot_count = len(self.__materialized_pair_items)
+            slot = _hash_pair(*items, slot_count.bit_length() - 1)
+            while (pair_items := self.__materialized_pair_items[slot].tolist()) != items:
+                if pair_items[0] == _NO_ITEM:
+                    return None
+                slot = (slot + 1) % slot_count
+            rule_numbers = self.__materialized_pair_suggestions[slot]
+        return rule_numbers[rule_numbers != _NO_ITEM]
+
+    def __suggest(self, basket: Iterable[int], query: str, limit: int = 10, cursor: Optional[str] = None,
+                  rank_by: str = 'lift') -> tuple[list[Suggestion], Optional[str], bool]:
+        # The cursor is the position of the next page in the ranked suggestions. Identical requests arriving while one
+        # is being ranked wait for its page rather than ranking it again; the pages returned are shared, and never
+        # changed.
+        offset = _get_offset(limit, cursor)
+        _check_rank_by(rank_by)
+        # Rankings made before products were taken off sale or put back on, or before rules learned online were
+        # published, are never shared with those made after.
+        version, unavailable = self.__availability.read()
+        key = frozenset(map(np.int32, basket)), query.strip(), rank_by, version, \
+            self.__online_rule_learner.version if self.__online_rule_learner is not None else 0
+        self.__check_basket_size(len(key[0]))
+        # A basket is learned from when the first page of its suggestions without a query is requested, and not again
+        # for each query typed against it, so that the sketches count baskets rather than keystrokes.
+        if key[0] and not key[1] and offset == 0:
+            self.__observe(key[0])
+        # The first page for a basket of one or two items without a query, ranked by lift, may have been computed ahead
+        # of time; one more suggestion than the most on any such page was kept, to tell whether another page follows.
+        # Those of products taken off sale are skipped, and if too few are left, the page is ranked afresh, as it is
+        # for a basket with items that have rules learned online.
+        if self.__materialized_single_suggestions is not None and 1 <= len(key[0]) <= 2 and not key[1] \
+                and rank_by == 'lift' and offset == 0 and limit < self.__materialized_single_suggestions.shape[1] \
+                and not self.__get_online_suggestions(key[0]):
+            rule_numbers = self.__get_materialized_suggestions(key[0])
+            if rule_numbers is not None:
+                suggestions = list(filter(partial(_is_available, unavailable),
+                                          map(self.__suggestions.__getitem__, rule_numbers)))
+                if len(suggestions) <= limit and len(rule_numbers) == self.__materialized_single_suggestions.shape[1]:
+                    rule_numbers = None
+            with self.__counter_lock:
+                if rule_numbers is None:
+                    self.__materialized_misses += 1
+                else:
+                    self.__materialized_hits += 1
+            if rule_numbers is not None:
+                return _end_at_ranking_depth((suggestions[:limit], str(limit) if len(suggestions) > limit else None,
+                                              False),
+                                             offset, self.__ranking_depth)
+        return _end_at_ranking_depth(self.__single_flight.run((*key, offset, limit),
+                                                              partial(self.__suggest_page, key, unavailable, offset,
+                                                                      limit)),
+                                     offset, self.__ranking_depth)
+
+    def __suggest_page(self, key: tuple[frozenset[np.int32], str, str, str, int], unavailable: np.ndarray, offset: int,
+                       limit: int) -> tuple[list[Suggestion], Optional[str], bool]:
+        # Requests with more pages keep their ranking where it left off in a bounded cache, so that later pages resume
+        # from there; one evicted from the cache is ranked again from the start. A ranking taken from the cache belongs
+        # to the thread which took it until it is put back, so that a request for other pages at the same time is
+        # ranked afresh.
+        with self.__page_lock:
+            page_state = self.__pages.pop(key, None)
+        if page_state is None:
+            remaining_suggestions, truncated = self.__rank(key[0], key[1], rank_by=key[2], unavailable=unavailable)
+            if offset == 0:  # Most requests never ask for a second page, so nothing is kept for one.
+                suggestions = list(islice(remaining_suggestions, limit + 1))
+                return suggestions[:limit], str(limit) if len(suggestions) > limit else None, truncated
+            page_state = [], remaining_suggestions, truncated
+        suggestions, remaining_suggestions, truncated = page_state
+        suggestions.extend(islice(remaining_suggestions, max(offset + limit + 1 - len(suggestions), 0)))
+        if len(suggestions) <= offset + limit:
+            return suggestions[offset:offset + limit], None, truncated
+        with self.__page_lock:
+            self.__pages[key] = page_state
+            if len(self.__pages) > self.__page_cache_size:
+                self.__pages.popitem(last=False)
+        return suggestions[offset:offset + limit], str(offset + limit), truncated
+
+    def __get_session(self, session_id: str) -> _BasketSession:
+        # Raises KeyError for a session which never existed or has expired.
+        with self.__session_lock:
+            session = self.__sessions[session_id]
+            if session.expiry < (now := monotonic()):
+                del self.__sessions[session_id]
+                raise KeyError(session_id)
+            session.expiry = now + self.__session_lifetime
+            self.__sessions.move_to_end(session_id)
+        return session
+
+    def __suggest_for_session(self, session_id: str, query: str, count: int = 10) -> list[Suggestion]:
+        session = self.__get_session(session_id)
+        with session.lock:
+            return list(islice(first(self.__rank(frozenset(session.basket), query.strip(), session)), count))
+
+    def materialize_suggestions(self, pairs: Iterable[tuple[int, int]], count: int = 10) -> dict[str, np.ndarray]:
+        # Computes the top count suggestions, plus one to tell whether more follow, for the basket of every single item
+        # and of each of the pairs of items, as rule numbers. Pairs are kept in a hash table at most half full.
+        rule_numbers = {id(suggestion): rule_number for rule_number, suggestion in enumerate(self.__suggestions)}
+
+        def get_rule_numbers(basket: Iterable[int]) -> np.ndarray:
+            suggestions, truncated = self.__rank(frozenset(map(np.int32, basket)), '')
+            if truncated:
+                raise RuntimeError('Materialized suggestions must not be cut short by a time budget.')
+            suggestions = list(islice(suggestions, count + 1))
+            row = np.full(count + 1, _NO_ITEM, np.uint32)
+            row[:len(suggestions)] = list(map(compose(id, rule_numbers.__getitem__), suggestions))
+            return row
+
+        single_suggestions = np.stack([get_rule_numbers((item,))
+                                       for item in range(len(self.__default_suggestion_ranks))]
+                                      or np.empty((0, count + 1), np.uint32))
+        pairs = sorted(set(map(compose(sorted, tuple), filter(lambda pair: len(set(pair)) == 2, pairs))))
+        bits = (2 * len(pairs) - 1).bit_length() if pairs else 0
+        pair_items = np.full((1 << bits, 2), _NO_ITEM, np.uint32)
+        pair_suggestions = np.full((1 << bits, count + 1), _NO_ITEM, np.uint32)
+        for pair in pairs:
+            slot = _hash_pair(*pair, bits)
+            while pair_items[slot, 0] != _NO_ITEM:
+                slot = (slot + 1) % len(pair_items)
+            pair_items[slot] = pair
+            pair_suggestions[slot] = get_rule_numbers(pair)
+        return {'single_suggestions': single_suggestions,
+                'pair_items': pair_items,
+                'pair_suggestions': pair_suggestions}
+
+    # The suggestions themselves rather than their serialized forms, for merging with those of other shards: each
+    # method ranks the same suggestions as its counterpart below, up to count of them.
+    def rank(self, basket: Iterable[int] = frozenset(), query: str = '', count: int = 10, rank_by: str = 'lift') \
+            -> tuple[list[Suggestion], bool]:
+        # Also returns whether matching the basket was cut short by the time budget.
+        _check_rank_by(rank_by)
+        basket = frozenset(map(np.int32, basket))
+        self.__check_basket_size(len(basket))
+        suggestions, truncated = self.__rank(basket, query.strip(), rank_by=rank_by)
+        return list(islice(suggestions, count)), truncated
+
+    def rank_completions(self, query: str = '') -> list[Suggestion]:
+        # Only completions of the last term as a prefix, without falling back to searching for the query
+        return self.__complete_prefix(query)
+
+    def rank_session(self, session_id: str, query: str = '', count: int = 10) -> list[Suggestion]:
+        return self.__suggest_for_session(session_id, query, count)
+
+    def complete(self, query: str = '') -> list[dict]:
+        return list(map(self.__to_dict, self.__complete(query)))
+
+    def complete_json(self, query: str = '') -> bytes:
+        # The same as complete, but already serialized to a JSON array from cached fragments
+        return self.__to_json(self.__complete(query))
+
+    def get_suggestions(self, basket: Iterable[int] = frozenset(), query: str = '', rank_by: str = 'lift') \
+            -> list[dict]:
+        return list(map(self.__to_dict, first(self.__suggest(basket, query, rank_by=rank_by))))
+
+    def get_suggestions_json(self, basket: Iterable[int] = frozenset(), query: str = '', rank_by: str = 'lift') \
+            -> bytes:
+        # The same as get_suggestions, but already serialized to a JSON array from cached fragments
+        return self.__to_json(first(self.__suggest(basket, query, rank_by=rank_by)))
+
+    def get_suggestions_page(self, basket: Iterable[int] = frozenset(), query: str = '', limit: int = 10,
+                             cursor: Optional[str] = None, rank_by: str = 'lift') \
+            -> tuple[list[dict], Optional[str], bool]:
+        # Returns up to limit suggestions from the cursor on, the cursor of the next page if there is one, and whether
+        # matching the basket was cut short by the time budget.
+        suggestions, next_cursor, truncated = self.__suggest(basket, query, limit, cursor, rank_by)
+        return list(map(self.__to_dict, suggestions)), next_cursor, truncated
+
+    def get_suggestions_page_json(self, basket: Iterable[int] = frozenset(), query: str = '', limit: int = 10,
+                                  cursor: Optional[str] = None, rank_by: str = 'lift') \
+            -> tuple[bytes, Optional[str], bool]:
+        # The same as get_suggestions_page, but already serialized to a JSON array from cached fragments
+        suggestions, next_cursor, truncated = self.__suggest(basket, query, limit, cursor, rank_by)
+        return self.__to_json(suggestions), next_cursor, truncated
+
+    def profile_suggestions_page_json(self, basket: Iterable[int] = frozenset(), query: str = '', limit: int = 10,
+                                      cursor: Optional[str] = None, rank_by: str = 'lift') \
+            -> tuple[bytes, Optional[str], bool, dict]:
+        # The same as get_suggestions_page_json, profiled, along with where the time went: the seconds spent in each
+        # stage of answering the request, and in none of them, as when the page was computed ahead of time or shared
+        # with an identical request; how many rules and products the request involved; and the functions which took the
+        # longest. Only requests made through here are profiled, so that the others cost nothing more.
+        (data, next_cursor, truncated), total_time, function_stats = \
+            _profile(self.get_suggestions_page_json, basket, query, limit, cursor, rank_by)
+        # The terms of the query are scanned for lazily, as each is looked up, so tokenizing is timed on its own.
+        start = perf_counter()
+        terms = tuple(tokenize(query.strip()))
+        stage_times = {'tokenize': perf_counter() - start if terms else 0.0,
+                       'autocomplete': _get_profiled_calls(function_stats, Autocompleter.search)[1],
+                       'word_index': _get_profiled_calls(function_stats, self.__get_suggestions_by_words)[1],
+                       'antecedent_lookup': _get_profiled_calls(function_stats,
+                                                                ProductLookupService.__get_basket_suggestions)[1]}
+        # Merging is whatever else ranking took: merging the suggestions matched, skipping repeated products and those
+        # off sale, and picking out those matching the query.
+        stage_times['merge'] = max(_get_profiled_calls(function_stats, ProductLookupService.__suggest_page)[1]
+                                   - sum(stage_times.values()), 0.0)
+        stage_times['serialization'] = _get_profiled_calls(function_stats, ProductLookupService.__to_json)[1]
+        stage_times['other'] = max(total_time - sum(stage_times.values()), 0.0)
+        # The rules are counted afterwards by matching the whole basket, however much of it the time budget allowed.
+        basket = frozenset(map(np.int32, basket))
+        matched_suggestions = [suggestions
+                               for suggestions, _, _ in (self.__get_suggestions_by_antecedent_items(basket)
+                                                         if basket
+                                                         else ())
+                               if suggestions is not self.__default_suggestions]
+        query_suggestions = self.__get_products_from_query(query.strip())
+        return data, next_cursor, truncated, \
+            {'seconds': total_time,
+             'stages': stage_times,
+             'counts': {'antecedent_item_sets': len(matched_suggestions),
+                        'rules': sum(map(len, matched_suggestions)),
+                        'online_rules': sum(len(suggestions)
+                                            for suggestions, _, _ in self.__get_online_suggestions(basket)),
+                        'query_terms': len(terms),
+                        'query_products': 0 if query_suggestions is None else len(query_suggestions),
+                        'comparisons': _get_profiled_calls(function_stats, Suggestion.__lt__)[0]},
+             'functions': _get_slowest_functions(function_stats)}
+
+    def __observe(self, basket: frozenset[np.int32]) -> None:
+        if self.__online_rule_learner is not None and basket:
+            self.__online_rule_learner.observe(basket)
+
+    def create_session(self, basket: Iterable[int] = frozenset()) -> str:
+        # Starts a session for a basket to be changed one item at a time, and returns its identifier.
+        basket = frozenset(map(np.int32, basket))
+        self.__check_basket_size(len(basket))
+        session = _BasketSession()
+        for item in basket:
+            session.add(item, self.__get_antecedent_item_set_suggestions_by_item(item))
+        self.__observe(basket)
+        with self.__session_lock:
+            now = monotonic()
+            while self.__sessions and (len(self.__sessions) >= self.__session_count
+                                       or next(iter(self.__sessions.values())).expiry < now):
+                self.__sessions.popitem(last=False)
+            session.expiry = now + self.__session_lifetime
+            self.__sessions[session_id := token_urlsafe(16)] = session
+        return session_id
+
+    def update_session(self, session_id: str, add: Iterable[int] = frozenset(), remove: Iterable[int] = frozenset()) \
+            -> None:
+        # Adds items to and removes items from a session’s basket; adding an item matches only the sets of antecedent
+        # items containing it. Raises KeyError for a session which never existed or has expired, and ValueError, leaving
+        # the basket unchanged, for changes which would make the basket too large.
+        session = self.__get_session(session_id)
+        add, remove = frozenset(map(np.int32, add)), frozenset(map(np.int32, remove))
+        with session.lock:
+            self.__check_basket_size(len(session.basket - remove | add))
+            basket = frozenset(session.basket)
+            for item in remove:
+                session.remove(item)
+            for item in add:
+                session.add(item, self.__get_antecedent_item_set_suggestions_by_item(item))
+            # Each basket a session goes through is learned from once, as it changes.
+            if session.basket != basket:
+                self.__observe(frozenset(session.basket))
+
+    def get_session_suggestions(self, session_id: str, query: str = '') -> list[dict]:
+        # The same as get_suggestions for the session’s basket
+        return list(map(self.__to_dict, self.__suggest_for_session(session_id, query)))
+
+    def get_session_suggestions_json(self, session_id: str, query: str = '') -> bytes:
+        # The same as get_session_suggestions, but already serialized to a JSON array from cached fragments
+        return self.__to_json(self.__suggest_for_session(session_id, query))
+
+    def set_unavailable_products(self, products: Iterable[int]) -> None:
+        # Takes the products off sale, and puts every other product back on. Raises ValueError for unknown products.
+        products = self.__availability.get_products(products)
+        with self.__availability.lock:
+            self.__availability.set(products)
+
+    def update_unavailable_products(self, add: Iterable[int] = frozenset(), remove: Iterable[int] = frozenset()) \
+            -> None:
+        # Takes the products to add off sale and puts those to remove back on. Raises ValueError for unknown products,
+        # leaving the products off sale unchanged.
+        add, remove = self.__availability.get_products(add), self.__availability.get_products(remove)
+        with self.__availability.lock:
+            self.__availability.set(sorted(set(self.__availability.products).difference(remove).union(add)))
+
+
+
+def _pack(suggestions: Sequence[Suggestion]) -> tuple[np.ndarray, np.ndarray]:
+    # Concatenates the data of the suggestions, to be sent to another process in one piece, along with where each ends.
+    return (np.concatenate([suggestion.data for suggestion in suggestions] or [np.empty(0, np.uint32)]),
+            np.cumsum([len(suggestion.data) for suggestion in suggestions], dtype=np.int64))
+
+
+def _unpack(packed_suggestions: tuple[np.ndarray, np.ndarray]) -> list[Suggestion]:
+    data, ends = packed_suggestions
+    return list(map(Suggestion, np.split(data, ends[:-1]))) if len(ends) else []
+
+
+def _serve_shard(address: str, products_data_file: str, suggestions_data_file: str, options: dict,
+                 ready_connection: Connection) -> None:
+    # Serves a shard from a ProductLookupService over its rules to the coordinators connecting to the Unix socket at
+    # address, each connection from a thread of its own. Errors raised by the service for the request are sent back in
+    # place of the result, those other than the KeyError or ValueError of a bad request as a RuntimeError, so that the
+    # connection outlives any request.
+    product_lookup_service = ProductLookupService(ProductRepository(products_data_file),
+                                                  SuggestionRepository(suggestions_data_file), **options)
+    handlers = {'rank': lambda basket, query, count, rank_by: tuple(zipapply((_pack, identity),
+                                                                             product_lookup_service.rank(basket, query,
+                                                                                                         count,
+                                                                                                         rank_by))),
+                'rank_completions': compose(product_lookup_service.rank_completions, _pack),
+                'rank_session': compose(product_lookup_service.rank_session, _pack),
+                'create_session': product_lookup_service.create_session,
+                'update_session': product_lookup_service.update_session,
+                'set_unavailable_products': product_lookup_service.set_unavailable_products,
+                'stats': lambda: product_lookup_service.stats,
+                'get_memory_stats': product_lookup_service.get_memory_stats}
+
+    def serve(connection: Connection) -> None:
+        with connection:
+            while True:
+                try:
+                    method, arguments = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    result = handlers[method](*arguments)
+                except (KeyError, ValueError) as error:
+                    result = error
+                except Exception as error:
+                    result = RuntimeError(f'The shard failed to {method}: {error!r}')
+                # A result is pickled whole before any of it is sent, so one which cannot be is replaced by an error.
+                try:
+                    connection.send(result)
+                except OSError:
+                    return
+                except Exception as error:
+                    connection.send(RuntimeError(f'The shard failed to send the result of {method}: {error!r}'))
+
+    with Listener(address, 'AF_UNIX') as listener:
+        ready_connection.send(product_lookup_service.model_version)
+        ready_connection.close()
+        while True:
+            Thread(target=serve, args=(listener.accept(),), daemon=True).start()
+
+
+def _stop_shards(owner_process_id: int, processes: Sequence[multiprocessing.Process], directory: str) -> None:
+    # Only the process which started the shards stops them, not the processes forked from it later on.
+    if getpid() != owner_process_id:
+        return
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+    rmtree(directory, ignore_errors=True)
+
+
+class ShardedProductLookupService:
+    # Serves the same requests as ProductLookupService from association rules partitioned by consequent item (see
+    # shard_suggestions.py) across shard processes on this machine, talking to them over Unix sockets. Every rule
+    # suggesting an item, and hence the best suggestion of it for any basket or query, lies in the same shard, so that
+    # merging the top suggestions of each shard in rank order gives the top suggestions overall. Options are passed on
+    # to the ProductLookupService of each shard.
+    def __init__(self, product_repository: ProductRepository,
+                 shard_suggestions_repositories: Sequence[SuggestionRepository], fragment_cache_size: int = 1 << 16,
+                 coalescing_timeout: float = 1.0, **options) -> None:
+        get_time_as_string = compose(time, ctime)
+
+        print(f'[{get_time_as_string()}] Initializing ShardedProductLookupService…',
+              file=sys.stderr)
+
+        # Shard processes, started afresh rather than forked, each listening on a socket of its own
+        print(f'[{get_time_as_string()}]  Starting {len(shard_suggestions_repositories):,} shards…',
+              file=sys.stderr)
+        context = multiprocessing.get_context('spawn')
+        directory = mkdtemp(prefix='shopping-assistant-shards-')
+        self.__addresses = tuple(path.join(directory, f'shard-{index}.sock')
+                                 for index in range(len(shard_suggestions_repositories)))
+        processes, ready_connections = [], []
+        for address, suggestions_repository in zip(self.__addresses, shard_suggestions_repositories):
+            ready_connection, shard_ready_connection = context.Pipe(duplex=False)
+            process = context.Process(target=_serve_shard,
+                                      args=(address, product_repository.products_data_file,
+                                            suggestions_repository.suggestions_data_file, options,
+                                            shard_ready_connection),
+                                      daemon=True)
+            process.start()
+            shard_ready_connection.close()
+            processes.append(process)
+            ready_connections.append(ready_connection)
+        finalize(self, _stop_shards, getpid(), processes, directory)
+        try:
+            shard_model_versions = [ready_connection.recv() for ready_connection in ready_connections]
+        except EOFError:
+            raise RuntimeError('A shard failed to start.') from None
+        print(f'[{get_time_as_string()}]   Started {len(shard_suggestions_repositories):,} shards.',
+              file=sys.stderr)
+
+        # Connections to the shards by process and thread, as each process forked from this one and each thread needs
+        # connections of its own
+        self.__connections: dict[tuple[int, int], list[Connection]] = {}
+        # Identical requests being ranked at the same time, each sent to the shards only once
+        self.__single_flight = _SingleFlight(coalescing_timeout)
+
+        # Model version, and the depth the shards rank suggestions to if they were trimmed
+        self.__model_version = sha256(' '.join(shard_model_versions).encode()).hexdigest()
+        self.__ranking_depth: Optional[int] = min(filter(None, (suggestions_repository.get_top_per_antecedent()
+                                                                 for suggestions_repository
+                                                                 in shard_suggestions_repositories)),
+                                                  default=None)
+
+        products = product_repository.get_all_products()[0]
+        self.__to_dict: Callable[[Suggestion], dict] = partial(_to_dict, products.__getitem__)
+        self.__serialize: Callable[[Suggestion], bytes] = \
+            lru_cache(maxsize=fragment_cache_size)(compose(self.__to_dict,
+                                                           partial(json.dumps, sort_keys=True, separators=(',', ':')),
+                                                           str.encode))
+
+        # Products taken off sale, shared with the processes forked from this one, which every shard is told of
+        self.__availability = _AvailabilityMask(len(products))
+
+        print(f'[{get_time_as_string()}]  Initialized ShardedProductLookupService.',
+              file=sys.stderr)
+
+    @property
+    def model_version(self) -> str:
+        return self.__model_version
+
+    @property
+    def availability_version(self) -> str:
+        return self.__availability.version
+
+    @property
+    def unavailable_products(self) -> list[int]:
+        return self.__availability.products
+
+    @property
+    def online_rules_version(self) -> str:
+        # Rules are never learned online across shards.
+        return ''
+
+    @property
+    def stats(self) -> dict:
+        return {'coalescing': self.__single_flight.stats,
+                'unavailable_products': int(np.count_nonzero(self.__availability.mask)),
+                'shards': self.__call_shards('stats', repeat(()))}
+
+    def get_memory_stats(self) -> dict:
+        # The resident pages of this process, which holds no index of its own, and the memory report of each shard.
+        return {'process': get_page_usage(), 'shards': self.__call_shards('get_memory_stats', repeat(()))}
+
+    def __call_shards(self, method: str, arguments: Iterable[tuple]) -> list:
+        # Sends each shard the request with its arguments before waiting on any of them, and re-raises the first error.
+        # Connections which broke off, and with them the others of the thread, which may still hold replies to the
+        # request, are dropped, so that the next request connects afresh.
+        key = getpid(), get_ident()
+        try:
+            if (connections := self.__connections.get(key)) is None:
+                connections = self.__connections[key] = [Client(address, 'AF_UNIX') for address in self.__addresses]
+            for connection, shard_arguments in zip(connections, arguments):
+                connection.send((method, shard_arguments))
+            results = [connection.recv() for connection in connections]
+        except (EOFError, OSError) as error:
+            for connection in self.__connections.pop(key, ()):
+                connection.close()
+            raise RuntimeError(f'The connection to a shard broke off during {method}.') from error
+        for error in filter(lambda result: isinstance(result, Exception), results):
+            raise error
+        return results
+
+    def __merge(self, packed_suggestions: Iterable[tuple[np.ndarray, np.ndarray]], rank_by: str = 'lift') \
+            -> Iterator[Suggestion]:
+        return unique(merge_sorted(*map(_unpack, packed_suggestions),
+                                   key=None if rank_by == 'lift' else partial(_get_metric_rank_key, rank_by)),
+                      key=lambda suggestion: suggestion.consequent_item)
+
+    def __to_json(self, suggestions: Iterable[Suggestion]) -> bytes:
+        return b'[' + b','.join(map(self.__serialize, suggestions)) + b']'
+
+    def __rank(self, basket: Iterable[int], query: str, count: int, rank_by: str = 'lift') \
+            -> tuple[list[Suggestion], bool]:
+        results = self.__call_shards('rank', repeat((tuple(map(int, basket)), query, count, rank_by)))
+        return list(islice(self.__merge(map(first, results), rank_by), count)), any(map(second, results))
+
+    def __complete(self, query: str) -> list[Suggestion]:
+        return (list(islice(self.__merge(self.__call_shards('rank_completions', repeat((query,)))), 10))
+                or first(self.__suggest((), query)))
+
+    def __suggest(self, basket: Iterable[int], query: str, limit: int = 10, cursor: Optional[str] = None,
+                  rank_by: str = 'lift') -> tuple[list[Suggestion], Optional[str], bool]:
+        # Each shard ranks as many suggestions as there are up to the end of the page, and one more to tell whether
+        # another page follows. Identical requests arriving while one is under way wait for its suggestions.
+        offset = _get_offset(limit, cursor)
+        _check_rank_by(rank_by)
+        basket, query = frozenset(map(int, basket)), query.strip()
+        suggestions, truncated = self.__single_flight.run((basket, query, offset + limit + 1, rank_by,
+                                                           self.__availability.version),
+                                                          partial(self.__rank, basket, query, offset + limit + 1,
+                                                                  rank_by))
+        return _end_at_ranking_depth((suggestions[offset:offset + limit],
+                                      str(offset + limit) if len(suggestions) > offset + limit else None,
+                                      truncated),
+                                     offset, self.__ranking_depth)
+
+    def __suggest_for_session(self, session_id: str, query: str) -> list[Suggestion]:
+        # A session is a session in every shard, identified by their identifiers joined together.
+        shard_session_ids = session_id.split('.')
+        if len(shard_session_ids) != len(self.__addresses):
+            raise KeyError(session_id)
+        return list(islice(self.__merge(self.__call_shards('rank_session',
+                                                           ((shard_session_id, query, 10)
+                                                            for shard_session_id in shard_session_ids))),
+                           10))
+
+    def complete(self, query: str = '') -> list[dict]:
+        return list(map(self.__to_dict, self.__complete(query)))
+
+    def complete_json(self, query: str = '') -> bytes:
+        return self.__to_json(self.__complete(query))
+
+    def get_suggestions(self, basket: Iterable[int] = frozenset(), query: str = '', rank_by: str = 'lift') \
+            -> list[dict]:
+        return list(map(self.__to_dict, first(self.__suggest(basket, query, rank_by=rank_by))))
+
+    def get_suggestions_json(self, basket: Iterable[int] = frozenset(), query: str = '', rank_by: str = 'lift') \
+            -> bytes:
+        return self.__to_json(first(self.__suggest(basket, query, rank_by=rank_by)))
+
+    def get_suggestions_page(self, basket: Iterable[int] = frozenset(), query: str = '', limit: int = 10,
+                             cursor: Optional[str] = None, rank_by: str = 'lift') \
+            -> tuple[list[dict], Optional[str], bool]:
+        suggestions, next_cursor, truncated = self.__suggest(basket, query, limit, cursor, rank_by)
+        return list(map(self.__to_dict, suggestions)), next_cursor, truncated
+
+    def get_suggestions_page_json(self, basket: Iterable[int] = frozenset(), query: str = '', limit: int = 10,
+                                  cursor: Optional[str] = None, rank_by: str = 'lift') \
+            -> tuple[bytes, Optional[str], bool]:
+        suggestions, next_cursor, truncated = self.__suggest(basket, query, limit, cursor, rank_by)
+        return self.__to_json(suggestions), next_cursor, truncated
+
+    def profile_suggestions_page_json(self, basket: Iterable[int] = frozenset(), query: str = '', limit: int = 10,
+                                      cursor: Optional[str] = None, rank_by: str = 'lift') \
+            -> tuple[bytes, Optional[str], bool, dict]:
+        # Only the coordinator is profiled: the shards are timed as a whole, from sending them the request to receiving
+        # the last of their suggestions, which are then merged.
+        (data, next_cursor, truncated), total_time, function_stats = \
+            _profile(self.get_suggestions_page_json, basket, query, limit, cursor, rank_by)
+        stage_times = {'shards': _get_profiled_calls(function_stats, ShardedProductLookupService.__call_shards)[1]}
+        stage_times['merge'] = max(_get_profiled_calls(function_stats, ShardedProductLookupService.__rank)[1]
+                                   - stage_times['shards'], 0.0)
+        stage_times['serialization'] = _get_profiled_calls(function_stats, ShardedProductLookupService.__to_json)[1]
+        stage_times['other'] = max(total_time - sum(stage_times.values()), 0.0)
+        return data, next_cursor, truncated, \
+            {'seconds': total_time,
+             'stages': stage_times,
+             'counts': {'shards': len(self.__addresses),
+                        'comparisons': _get_profiled_calls(function_stats, Suggestion.__lt__)[0]},
+             'functions': _get_slowest_functions(function_stats)}
+
+    def create_session(self, basket: Iterable[int] = frozenset()) -> str:
+        return '.'.join(self.__call_shards('create_session', repeat((tuple(map(int, basket)),))))
+
+    def update_session(self, session_id: str, add: Iterable[int] = frozenset(), remove: Iterable[int] = frozenset()) \
+            -> None:
+        shard_session_ids = session_id.split('.')
+        if len(shard_session_ids) != len(self.__addresses):
+            raise KeyError(session_id)
+        add, remove = tuple(map(int, add)), tuple(map(int, remove))
+        self.__call_shards('update_session',
+                           ((shard_session_id, add, remove) for shard_session_id in shard_session_ids))
+
+    def get_session_suggestions(self, session_id: str, query: str = '') -> list[dict]:
+        return list(map(self.__to_dict, self.__suggest_for_session(session_id, query)))
+
+    def get_session_suggestions_json(self, session_id: str, query: str = '') -> bytes:
+        return self.__to_json(self.__suggest_for_session(session_id, query))
+
+    # The shards are told of the products taken off sale before the version of the mask changes, so that a response
+    # identified by the new version never comes from shards still suggesting them.
+    def set_unavailable_products(self, products: Iterable[int]) -> None:
+        products = self.__availability.get_products(products)
+        with self.__availability.lock:
+            self.__call_shards('set_unavailable_products', repeat((products,)))
+            self.__availability.set(products)
+
+    def update_unavailable_products(self, add: Iterable[int] = frozenset(), remove: Iterable[int] = frozenset()) \
+            -> None:
+        add, remove = self.__availability.get_products(add), self.__availability.get_products(remove)
+        with self.__availability.lock:
+            products = sorted(set(self.__availability.products).difference(remove).union(add))
+            self.__call_shards('set_unavailable_products', repeat((products,)))
+            self.__availability.set(products)
 
 
-__all__ = ('ProductLookupService',)
+__all__ = ('MAX_PAGE_SIZE', 'ProductLookupService', 'RANKING_METRICS', 'ShardedProductLookupService')
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+import numpy as np
+from os.path import abspath, splitext
+from typing import Iterable
+from repositories import SuggestionRepository
+
+
+def get_shard_data_file(suggestions_data_file: str, shard_index: int, shard_count: int) -> str:
+    # suggestions.npz → suggestions.shard-0-of-4.npz
+    root, extension = splitext(suggestions_data_file)
+    return f'{root}.shard-{shard_index}-of-{shard_count}{extension}'
+
+
+def shard(suggestions: Iterable[np.ndarray], shard_count: int) -> list[list[np.ndarray]]:
+    # Partitions the rules by consequent item, so that all the rules suggesting an item lie in the same shard, and
+    # every shard has the rules without antecedent items for its share of the products to back text search.
+    shards = [[] for _ in range(shard_count)]
+    for data in suggestions:
+        shards[int(data[0]) % shard_count].append(data)
+    if not all(shards):
+        raise ValueError('Every shard must get some rules; use fewer shards.')
+    return shards
+
+
+def _parse_args() -> tuple[str, int]:
+    parser = ArgumentParser(description='Partitions the association rules by consequent item for the API server to'
+                                        ' serve from several shard processes.')
+    parser.add_argument('--input', metavar='PATH', action='store', type=str, default='suggestions.npz',
+                        help='the association rules to partition, next to which the shards are saved as'
+                             ' <name>.shard-<index>-of-<count>.npz')
+    parser.add_argument('--shards', metavar='COUNT', action='store', type=int, required=True,
+                        help='the number of shards')
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error('--shards must be at least 1')
+    return abspath(args.input), args.shards
+
+
+def run() -> None:
+    input_path, shard_count = _parse_args()
+    print(f'Loading rules from {input_path}…')
+    suggestions = SuggestionRepository(input_path).get_all_suggestion_data()
+    top_per_antecedent = SuggestionRepository(input_path).get_top_per_antecedent()
+    print(f' Loaded {len(suggestions):,} rules.')
+    for shard_index, shard_suggestions in enumerate(shard(suggestions, shard_count)):
+        output_path = get_shard_data_file(input_path, shard_index, shard_count)
+        print(f'Saving {len(shard_suggestions):,} rules to {output_path}…')
+        SuggestionRepository(output_path).save_all_suggestions(shard_suggestions,
+                                                                   top_per_antecedent=top_per_antecedent)
+
+
+__all__ = ('get_shard_data_file', 'shard')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,337 @@
+from heapq import heapify, heappop, heappush
+from mmap import mmap
+import multiprocessing
+import numpy as np
+from os import getpid, stat
+from queue import Empty, Full
+import sys
+from threading import Event, Lock, Thread
+from time import monotonic, time
+import traceback
+from typing import Iterable, Optional
+from models import Suggestion
+from repositories import SketchRepository
+
+
+class CountMinSketch:
+    # Estimates how often each key of a stream was added in a fixed number of counters, however many distinct keys there
+    # are: each key is counted in one counter of each row, picked by a hash of its own, and its estimate is the smallest
+    # of those, which is never less than the true count. The counters are floating-point so that they can be decayed.
+    def __init__(self, width: int, depth: int, seed: int = 0) -> None:
+        generator = np.random.default_rng(seed)
+        self.counters = np.zeros((depth, width), np.float32)
+        # Multiply-shift hashes, one per row
+        self.__multipliers = generator.integers(1 << 62, dtype=np.uint64, size=(depth, 1)) * np.uint64(2) + np.uint64(1)
+        self.__increments = generator.integers(1 << 62, dtype=np.uint64, size=(depth, 1))
+        self.__rows = np.arange(depth)[:, np.newaxis]
+
+    def __get_columns(self, keys: np.ndarray) -> np.ndarray:
+        return (self.__multipliers * keys + self.__increments >> np.uint64(32)) % np.uint64(self.counters.shape[1])
+
+    def add(self, keys: np.ndarray) -> None:
+        # Counts each key once for every time it occurs.
+        np.add.at(self.counters, (self.__rows, self.__get_columns(keys)), 1)
+
+    def estimate(self, keys: np.ndarray) -> np.ndarray:
+        return self.counters[self.__rows, self.__get_columns(keys)].min(axis=0)
+
+
+class HeavyHitters:
+    # Tracks the capacity keys with the largest counts seen so far, given an estimate of each key's count whenever it
+    # changes, by evicting the key with the smallest count for any key with a larger one. The key with the smallest
+    # count is found on a heap, whose entries for counts since changed are skipped and dropped on the way.
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.counts: dict[int, float] = {}
+        self.__heap: list[tuple[float, int]] = []
+
+    def __get_smallest(self) -> tuple[float, int]:
+        while self.counts.get(self.__heap[0][1]) != self.__heap[0][0]:
+            heappop(self.__heap)
+        return self.__heap[0]
+
+    def update(self, keys: np.ndarray, counts: np.ndarray) -> None:
+        if not self.capacity:
+            return
+        if len(self.counts) >= self.capacity:
+            # Only keys already tracked or counted more often than the least of them can change what is tracked.
+            floor = self.__get_smallest()[0]
+            selected = counts > floor
+            selected[~selected] = np.fromiter(map(self.counts.__contains__, keys[~selected].tolist()), bool)
+            keys, counts = keys[selected], counts[selected]
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            if key not in self.counts and len(self.counts) >= self.capacity:
+                smallest_count, smallest_key = self.__get_smallest()
+                if count <= smallest_count:
+                    continue
+                heappop(self.__heap)
+                del self.counts[smallest_key]
+            self.counts[key] = count
+            heappush(self.__heap, (count, key))
+        if len(self.__heap) > 4 * self.capacity:
+            self.__heap = [(count, key) for key, count in self.counts.items()]
+            heapify(self.__heap)
+
+    def scale(self, factor: float) -> None:
+        self.counts = {key: count * factor for key, count in self.counts.items()}
+        self.__heap = [(count, key) for key, count in self.counts.items()]
+        heapify(self.__heap)
+
+
+class OnlineRuleLearner:
+    # Learns rules of one antecedent item from baskets as they are seen, so that pairs of products bought together since
+    # the model was mined are suggested before the next training run. Baskets are sent from any process forked from the
+    # one which created the learner, such as the workers of a preloaded gunicorn app, through a bounded queue, and those
+    # which do not fit are dropped rather than waited on. A thread in the process which created the learner counts the
+    # transactions, the items in a count-min sketch, and the pairs of items in another, tracking the most frequent
+    # pairs, all in as much memory however many baskets are seen. Counts are decayed with the given half-life, so that
+    # the rules follow recent baskets. Every refresh interval, the rules for the tracked pairs seen at least
+    # min_pair_count times, with a lift above 1, are published in memory shared with the processes forked from this one,
+    # in one of two buffers while the other is read, and every checkpoint interval, the sketches are saved, to be
+    # carried on from when the server restarts. Orders may also be learned from a log of them appended to by another
+    # application, one basket of comma-separated product identifiers per line, read from where the last checkpoint left
+    # off.
+    def __init__(self, product_count: int, item_sketch_width: int = 1 << 16, pair_sketch_width: int = 1 << 20,
+                 sketch_depth: int = 4, pair_capacity: int = 10_000, min_pair_count: float = 10,
+                 half_life: float = 7 * 24 * 60 * 60, max_basket_size: int = 20, queue_size: int = 10_000,
+                 refresh_interval: float = 60, checkpoint_interval: float = 10 * 60,
+                 sketch_repository: Optional[SketchRepository] = None, order_log_file: Optional[str] = None,
+                 seed: int = 0) -> None:
+        self.__configuration = np.array([product_count, item_sketch_width, pair_sketch_width, sketch_depth,
+                                         pair_capacity, seed], np.int64)
+        self.__product_count = product_count
+        self.__min_pair_count = min_pair_count
+        self.__half_life = half_life
+        self.__max_basket_size = max_basket_size
+        self.__refresh_interval = refresh_interval
+        self.__checkpoint_interval = checkpoint_interval
+        self.__sketch_repository = sketch_repository
+        self.__order_log_file = order_log_file
+        self.__generator = np.random.default_rng(seed)
+
+        # State of the thread learning from the baskets, only ever used by it, or in its place with the lock held
+        self.__lock = Lock()
+        self.__item_sketch = CountMinSketch(item_sketch_width, sketch_depth, seed)
+        self.__pair_sketch = CountMinSketch(pair_sketch_width, sketch_depth, seed + 1)
+        self.__pairs = HeavyHitters(pair_capacity)
+        self.__transaction_count = 0.0
+        self.__order_log_position = np.zeros(2, np.int64)  # The inode of the log and how far it has been read
+        self.__last_decay = monotonic()
+        self.__owner_process_id = getpid()
+        self.__queue = multiprocessing.Queue(queue_size)
+        self.__stopping = Event()
+        self.__thread: Optional[Thread] = None
+
+        # Shared memory: the generation of the published rules, the buffer holding them, and the numbers of baskets
+        # learned and dropped, followed by the number of rules in each buffer and the buffers themselves, each row a
+        # suggestion's data of a single antecedent item
+        memory = mmap(-1, 8 * 4 + 8 * 2 + 2 * 2 * pair_capacity * 6 * 4)
+        self.__header = np.frombuffer(memory, np.uint64, 4)
+        self.__rule_counts = np.frombuffer(memory, np.uint64, 2, 8 * 4)
+        self.__rule_buffers = np.frombuffer(memory, np.uint32, 2 * 2 * pair_capacity * 6, 8 * 6) \
+            .reshape(2, 2 * pair_capacity, 6)
+        # The rules last read from shared memory by this process, by antecedent item, with their consequent items
+        self.__rules_lock = Lock()
+        self.__rules_generation = 0
+        self.__rules: dict[int, tuple[tuple[Suggestion, ...], np.ndarray]] = {}
+
+        if sketch_repository is not None and (arrays := sketch_repository.get_sketches()) is not None:
+            if np.array_equal(arrays['configuration'], self.__configuration):
+                self.__item_sketch.counters[:] = arrays['item_counters']
+                self.__pair_sketch.counters[:] = arrays['pair_counters']
+                self.__pairs.update(arrays['pair_keys'], arrays['pair_counts'])
+                self.__transaction_count = float(arrays['transaction_count'])
+                self.__order_log_position[:] = arrays['order_log_position']
+                self.__last_decay -= max(time() - float(arrays['saved_at']), 0)  # Decays them for the time since.
+                self.refresh()
+                print(f'Loaded sketches of {self.__transaction_count:,.0f} baskets from'
+                      f' {sketch_repository.sketch_data_file}.', file=sys.stderr)
+            else:
+                print(f'Ignored sketches configured otherwise in {sketch_repository.sketch_data_file}.',
+                      file=sys.stderr)
+
+    @property
+    def stats(self) -> dict:
+        return {'generation': int(self.__header[0]),
+                'learned_baskets': int(self.__header[2]),
+                'dropped_baskets': int(self.__header[3]),  # Counted by every process without a lock, so approximate
+                'rules': int(self.__rule_counts[int(self.__header[1])])}
+
+    @property
+    def version(self) -> int:
+        # The generation of the rules published, which changes whenever they are
+        return int(self.__header[0])
+
+    def observe(self, basket: Iterable[int]) -> None:
+        # Queues the basket to be learned, from any process forked from this one, unless the queue is full.
+        # Baskets still queued in a process when it exits are dropped rather than waited on.
+        self.__queue.cancel_join_thread()
+        try:
+            self.__queue.put_nowait(tuple(map(int, basket)))
+        except Full:
+            self.__header[3] += 1
+
+    def learn(self, baskets: Iterable[Iterable[int]]) -> None:
+        # Counts the baskets in the sketches at once. Baskets of more than max_basket_size items are counted as a random
+        # sample of that many of them, so that a single basket never takes long.
+        pair_keys = []
+        with self.__lock:
+            for basket in baskets:
+                items = np.unique(np.fromiter(basket, np.int64))
+                items = items[(items >= 0) & (items < self.__product_count)]
+                if len(items) > self.__max_basket_size:
+                    items = np.sort(self.__generator.choice(items, self.__max_basket_size, replace=False))
+                self.__transaction_count += 1
+                self.__header[2] += 1
+                self.__item_sketch.add(items.astype(np.uint64))
+                first_items, second_items = np.triu_indices(len(items), 1)
+                pair_keys.append(items[first_items].astype(np.uint64) << np.uint64(32)
+                                 | items[second_items].astype(np.uint64))
+            if pair_keys:
+                pair_keys = np.concatenate(pair_keys)
+                self.__pair_sketch.add(pair_keys)
+                pair_keys = np.unique(pair_keys)
+                self.__pairs.update(pair_keys, self.__pair_sketch.estimate(pair_keys))
+
+    def __get_rule_rows(self) -> np.ndarray:
+        # The data of the suggestions in both directions for the tracked pairs of items, in rows. Estimates are rounded
+        # to whole counts no larger than those they are part of.
+        pair_keys = np.fromiter(self.__pairs.counts.keys(), np.uint64, len(self.__pairs.counts))
+        item_set_counts = np.rint(self.__pair_sketch.estimate(pair_keys)).astype(np.int64)
+        first_items, second_items = (pair_keys >> np.uint64(32)).astype(np.int64), \
+            (pair_keys & np.uint64(0xFFFFFFFF)).astype(np.int64)
+        first_counts, second_counts = \
+            np.maximum(np.rint(self.__item_sketch.estimate(np.stack((first_items, second_items)).astype(np.uint64)
+                                                           .ravel()))
+                       .astype(np.int64).reshape(2, -1), item_set_counts)
+        transaction_counts = np.maximum(np.maximum(first_counts, second_counts), round(self.__transaction_count))
+        selected = (item_set_counts >= max(self.__min_pair_count, 1)) \
+            & (transaction_counts.astype(float) * item_set_counts > first_counts.astype(float) * second_counts)
+        rows = np.concatenate((np.stack((second_items, transaction_counts, item_set_counts, first_counts,
+                                         second_counts, first_items), axis=1)[selected],
+                               np.stack((first_items, transaction_counts, item_set_counts, second_counts,
+                                         first_counts, second_items), axis=1)[selected]))
+        return rows.astype(np.uint32)
+
+    def refresh(self) -> None:
+        # Decays the counts for the time since they last were, and publishes the rules, to the buffer not being read.
+        with self.__lock:
+            factor = 0.5 ** (((now := monotonic()) - self.__last_decay) / self.__half_life)
+            self.__last_decay = now
+            self.__item_sketch.counters *= factor
+            self.__pair_sketch.counters *= factor
+            self.__pairs.scale(factor)
+            self.__transaction_count *= factor
+            rows = self.__get_rule_rows()
+            buffer = 1 - int(self.__header[1])
+            self.__rule_counts[buffer] = len(rows)
+            self.__rule_buffers[buffer, :len(rows)] = rows
+            self.__header[1] = buffer
+            self.__header[0] += 1
+
+    def checkpoint(self) -> None:
+        with self.__lock:
+            self.__sketch_repository.save_sketches({
+                'configuration': self.__configuration,
+                'item_counters': self.__item_sketch.counters,
+                'pair_counters': self.__pair_sketch.counters,
+                'pair_keys': np.fromiter(self.__pairs.counts.keys(), np.uint64, len(self.__pairs.counts)),
+                'pair_counts': np.fromiter(self.__pairs.counts.values(), np.float32, len(self.__pairs.counts)),
+                'transaction_count': np.array(self.__transaction_count),
+                'order_log_position': self.__order_log_position,
+                'saved_at': np.array(time())})
+
+    def get_rules(self) -> dict[int, tuple[tuple[Suggestion, ...], np.ndarray]]:
+        # The rules last published, sorted, by antecedent item, along with their consequent items. They are read again
+        # only when a newer generation has been published, and read over if another is published while they are read.
+        if (generation := int(self.__header[0])) == self.__rules_generation:
+            return self.__rules
+        with self.__rules_lock:
+            while generation != self.__rules_generation:
+                buffer = int(self.__header[1])
+                rows = self.__rule_buffers[buffer, :int(self.__rule_counts[buffer])].copy()
+                if int(self.__header[0]) != generation:
+                    generation = int(self.__header[0])
+                    continue
+                # The rows are sorted by antecedent item and then as the suggestions rank, all at once, the metrics
+                # computed as Suggestion computes them.
+                transaction_counts, item_set_counts, antecedent_counts, consequent_counts = \
+                    rows[:, 1:5].astype(float).T
+                lifts = transaction_counts * item_set_counts / (antecedent_counts * consequent_counts)
+                rows = rows[np.lexsort((-rows[:, 0].astype(np.int64), -(item_set_counts / transaction_counts), -lifts,
+                                        rows[:, 5]))]
+                antecedent_items, starts = np.unique(rows[:, 5], return_index=True)
+                suggestions = tuple(map(Suggestion.from_validated_data, rows))
+                ends = (*starts[1:].tolist(), len(rows))
+                self.__rules = {antecedent_item: (suggestions[start:end], rows[start:end, 0])
+                                for antecedent_item, start, end
+                                in zip(antecedent_items.tolist(), starts.tolist(), ends)}
+                self.__rules_generation = generation
+        return self.__rules
+
+    def __read_order_log(self, size: int = 1 << 20) -> list[list[int]]:
+        # Reads up to size bytes of whole lines from where the log was last read, from its start if it was replaced or
+        # cut short. Lines which are not baskets are skipped.
+        try:
+            log_stat = stat(self.__order_log_file)
+        except FileNotFoundError:
+            return []
+        inode, position = self.__order_log_position.tolist()
+        if inode != log_stat.st_ino or position > log_stat.st_size:
+            inode, position = log_stat.st_ino, 0
+        with open(self.__order_log_file, 'rb') as file:
+            file.seek(position)
+            data = file.read(size)
+        data = data[:data.rfind(b'\n') + 1]
+        baskets = []
+        for line in data.splitlines():
+            try:
+                baskets.append(list(map(int, filter(None, line.split(b',')))))
+            except ValueError:
+                pass
+        with self.__lock:
+            self.__order_log_position[:] = inode, position + len(data)
+        return baskets
+
+    def __run(self) -> None:
+        next_refresh = monotonic() + self.__refresh_interval
+        next_checkpoint = monotonic() + self.__checkpoint_interval
+        while not self.__stopping.is_set():
+            try:
+                baskets = []
+                try:
+                    baskets.append(self.__queue.get(timeout=min(self.__refresh_interval, 1)))
+                    while len(baskets) < 1000:
+                        baskets.append(self.__queue.get_nowait())
+                except Empty:
+                    pass
+                if self.__order_log_file is not None:
+                    baskets.extend(self.__read_order_log())
+                self.learn(baskets)
+                if monotonic() >= next_refresh:
+                    self.refresh()
+                    next_refresh = monotonic() + self.__refresh_interval
+                if self.__sketch_repository is not None and monotonic() >= next_checkpoint:
+                    self.checkpoint()
+                    next_checkpoint = monotonic() + self.__checkpoint_interval
+            except Exception:
+                traceback.print_exc()
+                self.__stopping.wait(1)
+
+    def start(self) -> None:
+        self.__thread = Thread(target=self.__run, name='OnlineRuleLearner', daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        # Stops learning, saving the sketches once more. Only the process which created the learner does so, not those
+        # forked from it, whose copies of the sketches are out of date.
+        if getpid() != self.__owner_process_id or self.__thread is None:
+            return
+        self.__stopping.set()
+        self.__thread.join()
+        self.__thread = None
+        if self.__sketch_repository is not None:
+            self.checkpoint()
+
+
+__all__ = ('CountMinSketch', 'HeavyHitters', 'OnlineRuleLearner')
@@ -37,10 +37,15 @@ function App() {
 
   useEffect(() => {
     const timer = setTimeout(() => {
-      axios.post('/api/suggestion',
+      // GET requests in the canonical form (sorted identifiers, normalized query) are cached by the browser and nginx.
+      const basket = listItems.map(value => value.identifier).sort((a, b) => a - b);
+      const query = searchQuery.trim().split(/\s+/).join(' ');
+      axios.get('/api/suggestion',
       {
-        basket: listItems.map(value => value.identifier),
-        query: searchQuery
+        params: {
+          basket: basket.length ? basket.join(',') : undefined,
+          query: query || undefined
+        }
       })
       .then(response => {
         setSuggestions(response.data['data']);
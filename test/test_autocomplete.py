@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor
+from fast_autocomplete import AutoComplete
+from itertools import chain, groupby
+from toolz import unique
+import unittest
+from autocomplete import *
+from repositories import ProductRepository
+
+
+class TestAutocomplete(unittest.TestCase):
+    def test_Autocompleter(self):
+        synonyms = {'apple': ('apples',), 'cheddar': (), 'cheese': ('cheeses',), 'pesto': (), 'tomato': ('tomatoes',)}
+        autocompleter = Autocompleter(synonyms)
+        with self.subTest('Terms complete to the lemmas of the words beginning with them'):
+            self.assertSequenceEqual(autocompleter.search('ch'), ['cheese', 'cheddar'])
+            self.assertSequenceEqual(autocompleter.search('chee'), ['cheese'])
+        with self.subTest('Other forms of words map to their lemmas'):
+            self.assertSequenceEqual(autocompleter.search('Apples'), ['apple'])
+            self.assertSequenceEqual(autocompleter.search('tomatoe'), ['tomato'])
+        with self.subTest('Misspellings are forgiven'):
+            self.assertSequenceEqual(autocompleter.search('cheesy'), ['cheese'])
+            self.assertSequenceEqual(autocompleter.search('peso'), ['pesto'])
+        with self.subTest('Only misspellings less than the maximum cost away are forgiven'):
+            self.assertSequenceEqual(autocompleter.search('xpesto'), [])
+            self.assertSequenceEqual(Autocompleter(synonyms, max_cost=2).search('xpesto'), ['pesto'])
+        with self.subTest('At most size matches are returned'):
+            self.assertSequenceEqual(autocompleter.search('x', size=2), ['apple', 'pesto'])
+        with self.subTest('Words are counted'):
+            self.assertEqual(autocompleter.stats['words'], 8)
+
+    def test_Autocompleter_product_names(self):
+        # The lemmas of the test model's product names, each with its other forms, as ProductLookupService indexes them
+        synonyms = {lemma: tuple(unique(filter(None, (word for _, word in pairs))))
+                    for lemma, pairs in groupby(sorted(unique(chain.from_iterable(ProductRepository('products.txt.xz')
+                                                                                  .get_all_products()[1])),
+                                                       key=lambda pair: pair if pair[1] else (pair[0],)),
+                                                key=lambda pair: pair[0])}
+        words = sorted(set(chain(synonyms.keys(), chain.from_iterable(synonyms.values()))))
+        # Every prefix of every word, every word less a character, and every word with a character added or replaced
+        terms = sorted(set(chain.from_iterable(chain((word[:index] for index in range(1, len(word) + 1)),
+                                                     (word[:index] + word[index + 1:] for index in range(len(word))),
+                                                     (word[:index] + 'x' + word[index:] for index in range(len(word))),
+                                                     (word[:index] + 'x' + word[index + 1:]
+                                                      for index in range(len(word))))
+                                               for word in words)))
+        for max_cost in (1, 2):
+            autocompleter = Autocompleter(synonyms, max_cost)
+            with self.subTest('Matches are those of fast_autocomplete, lemmas in order', max_cost=max_cost):
+                reference = AutoComplete(words=dict.fromkeys(synonyms.keys(), {}), synonyms=synonyms)
+                for term in terms:
+                    self.assertSequenceEqual(autocompleter.search(term),
+                                             list(unique(chain.from_iterable(reference.search(term, max_cost=max_cost,
+                                                                                              size=3)))),
+                                             term)
+        autocompleter = Autocompleter(synonyms)
+        with self.subTest('Terms complete from their longest prefix found among the words'):
+            self.assertSequenceEqual(autocompleter.search('ch'), ['cheese', 'cheddar'])
+            self.assertSequenceEqual(autocompleter.search('ale'), ['apple'])
+            self.assertSequenceEqual(autocompleter.search('back'), ['bacon'])
+            self.assertSequenceEqual(autocompleter.search('cheesy'), ['cheese'])
+        with self.subTest('Searches from many threads at once get the same matches as one at a time'):
+            with ThreadPoolExecutor(8) as executor:
+                self.assertSequenceEqual(list(executor.map(autocompleter.search, terms * 4)),
+                                         list(map(autocompleter.search, terms * 4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
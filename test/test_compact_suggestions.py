@@ -0,0 +1,110 @@
+import numpy as np
+import os
+import os.path as path
+from tempfile import TemporaryDirectory
+from toolz import thread_last as thread
+import unittest
+from unittest.mock import patch
+import compact_suggestions
+from compact_suggestions import *
+from models import Suggestion
+from repositories import SuggestionRepository
+
+
+class TestCompactSuggestions(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.suggestion_data = \
+            (*(np.array([consequent, 100, 16 - consequent, 20, 20, 1], dtype=np.uint32)  # {1} → 12 consequents
+               for consequent in range(2, 14)),
+             np.array([30, 100, 2, 2, 20, *range(1, 11)], dtype=np.uint32),  # 10 antecedent items
+             np.array([31, 100, 2, 2, 20, *range(1, 10)], dtype=np.uint32),  # 9 antecedent items
+             *(np.array([consequent, 100, 50 - consequent, 100, 50 - consequent], dtype=np.uint32)
+               for consequent in range(2, 16)))  # 14 suggestions without antecedent items
+
+    def test_compact(self):
+        def to_tuple(array: np.ndarray) -> tuple[int, ...]:
+            return tuple(array.tolist())
+
+        def compact_to_tuples(*arguments) -> tuple[tuple[int, ...], ...]:
+            return thread(compact(self.suggestion_data, *arguments),
+                          (map, to_tuple),
+                          tuple)
+
+        expected_order = thread(self.suggestion_data,
+                                (map, Suggestion),
+                                sorted,
+                                (map, lambda suggestion: to_tuple(suggestion.data)),
+                                tuple)
+        with self.subTest('Without limits, all suggestions are kept in sorted order'):
+            self.assertSequenceEqual(compact_to_tuples(None, None), expected_order)
+        with self.subTest('Suggestions with more antecedent items than the maximum are dropped'):
+            self.assertSequenceEqual(compact_to_tuples(9, None),
+                                     tuple(filter(lambda data: data[0] != 30, expected_order)))
+        with self.subTest('Only the top consequents are kept for each set of antecedent items'):
+            self.assertSequenceEqual(compact_to_tuples(None, 10),
+                                     tuple(filter(lambda data: data[5:] != (1,) or data[0] < 12, expected_order)))
+        with self.subTest('Suggestions without antecedent items are never trimmed'):
+            self.assertEqual(sum(1 for data in compact_to_tuples(None, 10) if len(data) == 5), 14)
+
+    def test_prune_redundant(self):
+        suggestion_data = (np.array([5, 100, 10, 20, 20, 1], dtype=np.uint32),  # {1} → 5, lift 2.5
+                           np.array([5, 100, 5, 20, 20, 2], dtype=np.uint32),  # {2} → 5, lift 1.25
+                           np.array([5, 100, 8, 20, 20, 1, 2], dtype=np.uint32),  # {1, 2} → 5, lift 2.0
+                           np.array([5, 100, 8, 10, 20, 1, 3], dtype=np.uint32),  # {1, 3} → 5, lift 4.0
+                           np.array([5, 100, 8, 20, 20, 1, 2, 3], dtype=np.uint32),  # {1, 2, 3} → 5, lift 2.0
+                           np.array([6, 100, 8, 20, 20, 2], dtype=np.uint32),  # {2} → 6, lift 2.0
+                           np.array([6, 100, 9, 20, 20, 1, 2], dtype=np.uint32),  # {1, 2} → 6, lift 2.25
+                           np.array([7, 100, 20, 100, 20], dtype=np.uint32),  # ∅ → 7, lift 1.0
+                           np.array([7, 100, 2, 20, 20, 1], dtype=np.uint32))  # {1} → 7, lift 0.5, confidence 0.1
+        self.assertSequenceEqual(thread(prune_redundant(suggestion_data),
+                                        (map, lambda array: tuple(array.tolist())),
+                                        tuple),
+                                 ((5, 100, 10, 20, 20, 1),
+                                  (5, 100, 5, 20, 20, 2),
+                                  (5, 100, 8, 10, 20, 1, 3),
+                                  (6, 100, 8, 20, 20, 2),
+                                  (6, 100, 9, 20, 20, 1, 2),
+                                  (7, 100, 20, 100, 20),
+                                  (7, 100, 2, 20, 20, 1)))
+
+    def test_verify(self):
+        suggestions_repository = SuggestionRepository('suggestions.npz.xz')
+        with TemporaryDirectory() as directory:
+            pruned_suggestions_repository = SuggestionRepository(path.join(directory, 'suggestions.npz'))
+            pruned_suggestions_repository.save_all_suggestions(
+                prune_redundant(suggestions_repository.get_all_suggestion_data()))
+            with self.subTest('Pruning redundant suggestions does not change any responses'):
+                self.assertEqual(verify('products.txt.xz', suggestions_repository.suggestions_data_file,
+                                        pruned_suggestions_repository.suggestions_data_file, 200),
+                                 0)
+            with self.subTest('Responses from a model missing its best suggestions differ'):
+                pruned_suggestions_repository.save_all_suggestions(
+                    suggestions_repository.get_all_suggestion_data()[40:])
+                self.assertGreater(verify('products.txt.xz', suggestions_repository.suggestions_data_file,
+                                          pruned_suggestions_repository.suggestions_data_file, 200),
+                                   0)
+            with self.subTest('Responses from a model trimmed shallower than a page differ'):
+                pruned_suggestions_repository.save_all_suggestions(
+                    compact(suggestions_repository.get_all_suggestion_data(), top_per_antecedent_items=2),
+                    top_per_antecedent=2)
+                self.assertGreater(verify('products.txt.xz', suggestions_repository.suggestions_data_file,
+                                          pruned_suggestions_repository.suggestions_data_file, 200),
+                                   0)
+            with self.subTest('Compacted rules which change responses are not saved'):
+                output_path = path.join(directory, 'compacted.npz')
+                with patch('sys.argv', ['compact_suggestions.py', '--input', 'suggestions.npz.xz', '--output',
+                                        output_path, '--max-antecedents', '1', '--verify', '200', '--products',
+                                        'products.txt.xz']):
+                    self.assertRaises(SystemExit, compact_suggestions.run)
+                self.assertSequenceEqual(os.listdir(directory), ['suggestions.npz'])
+            with self.subTest('Compacted rules which change no response are saved'):
+                with patch('sys.argv', ['compact_suggestions.py', '--input', 'suggestions.npz.xz', '--output',
+                                        output_path, '--prune-redundant', '--verify', '200', '--products',
+                                        'products.txt.xz']):
+                    compact_suggestions.run()
+                self.assertSequenceEqual(sorted(os.listdir(directory)), ['compacted.npz', 'suggestions.npz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
+from hashlib import sha256
 from io import StringIO
 from operator import add, mul
+from tempfile import NamedTemporaryFile
 import unittest
 from helpers import *
 
@@ -19,6 +21,12 @@ class TestHelpers(unittest.TestCase):
     def test_first(self):
         self.assertEqual(first((0, 1)), 0)
 
+    def test_hash_file(self):
+        with NamedTemporaryFile() as file:
+            file.write(self.csv_data.encode())
+            file.flush()
+            self.assertEqual(hash_file(file.name), sha256(self.csv_data.encode()).hexdigest())
+
     def test_read_csv(self):
         with StringIO(self.csv_data) as stream:
             self.assertSequenceEqual(self.row_sequence, tuple(read_csv(stream, ',')))
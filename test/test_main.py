@@ -0,0 +1,71 @@
+import lzma
+import os
+import os.path as path
+import shutil
+from tempfile import TemporaryDirectory
+import unittest
+from repositories import ProductRepository
+
+
+class TestMain(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The app loads the model from the working directory when it is imported.
+        cls.directory = TemporaryDirectory()
+        for source, destination in (('products.txt.xz', 'products.tsv'), ('suggestions.npz.xz', 'suggestions.npz')):
+            with lzma.open(source) as source_file, open(path.join(cls.directory.name, destination), 'wb') as file:
+                shutil.copyfileobj(source_file, file)
+        working_directory = os.getcwd()
+        os.chdir(cls.directory.name)
+        try:
+            import main
+        finally:
+            os.chdir(working_directory)
+        cls.client = main.flask_app.test_client()
+        cls.products = ProductRepository('products.txt.xz').get_all_products()[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_get_suggestion(self):
+        kimchi, bacon = self.products.index('Kimchi'), self.products.index('Bacon')
+        with self.subTest('Requests are redirected to their canonical URLs'):
+            response = self.client.get(f'/api/suggestion?query=cheese&basket={bacon},{kimchi},{bacon}&limit=10')
+            self.assertEqual(response.status_code, 301)
+            self.assertEqual(response.location, f'/api/suggestion?basket={min(kimchi, bacon)},{max(kimchi, bacon)}'
+                                                f'&query=cheese')
+            self.assertEqual(self.client.get(response.location).status_code, 200)
+        with self.subTest('Responses are revalidated by their ETags'):
+            response = self.client.get(f'/api/suggestion?basket={kimchi}')
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNotNone(response.get_etag()[0])
+            revalidated_response = self.client.get(f'/api/suggestion?basket={kimchi}',
+                                                   headers={'If-None-Match': response.headers['ETag']})
+            self.assertEqual(revalidated_response.status_code, 304)
+            self.assertEqual(revalidated_response.get_data(), b'')
+            self.assertEqual(self.client.get(f'/api/suggestion?basket={bacon}',
+                                             headers={'If-None-Match': response.headers['ETag']}).status_code, 200)
+        with self.subTest('Apostrophes are canonical as browsers escape them'):
+            response = self.client.get("/api/suggestion?query=annie's")
+            self.assertEqual(response.status_code, 301)
+            self.assertEqual(response.location, '/api/suggestion?query=annie%27s')
+            self.assertEqual(self.client.get('/api/suggestion?query=annie%27s').status_code, 200)
+        with self.subTest('Non-numeric limits are rejected'):
+            self.assertEqual(self.client.get('/api/suggestion?limit=ten').status_code, 400)
+
+    def test_suggestion(self):
+        kimchi = self.products.index('Kimchi')
+        with self.subTest('Posted requests get pages of suggestions'):
+            response = self.client.post('/api/suggestion', json={'basket': [kimchi], 'limit': 1})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json['data']), 1)
+            self.assertEqual(response.json['next_cursor'], '1')
+        with self.subTest('Limits and cursors of the wrong types are rejected'):
+            for arguments in ({'limit': '5'}, {'limit': True}, {'limit': 2.5}, {'cursor': 5}, {'cursor': ['1']}):
+                self.assertEqual(self.client.post('/api/suggestion', json={'basket': [kimchi], **arguments})
+                                 .status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+import numpy as np
+import unittest
+from materialize_suggestions import *
+from models import Suggestion
+
+
+class TestMaterializeSuggestions(unittest.TestCase):
+    def test_get_frequent_pairs(self):
+        suggestions = tuple(map(Suggestion,
+                                (np.array([2, 100, 30, 40, 50, 1], dtype=np.uint32),  # {1, 2} occur together 30 times.
+                                 np.array([1, 100, 30, 50, 40, 2], dtype=np.uint32),  # The same pair, the other way
+                                 np.array([5, 100, 10, 20, 50, 3, 4], dtype=np.uint32),  # {3, 4} occur 20 times.
+                                 np.array([6, 100, 10, 10, 50, 1, 3, 4], dtype=np.uint32),  # Too many antecedents
+                                 np.array([7, 100, 50, 100, 50], dtype=np.uint32))))  # No antecedent items
+        with self.subTest('Pairs come from single antecedent items with their consequents and from pairs of'
+                          ' antecedent items, most frequent first'):
+            self.assertSequenceEqual(get_frequent_pairs(suggestions, 10), ((1, 2), (3, 4)))
+        with self.subTest('Only the most frequent pairs are kept'):
+            self.assertSequenceEqual(get_frequent_pairs(suggestions, 1), ((1, 2),))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import numpy as np
+import os
+import sys
+import unittest
+from memory import *
+
+
+class TestMemory(unittest.TestCase):
+    def test_get_deep_size(self):
+        array = np.zeros(1000)
+        with self.subTest('The data of an array is counted once, however many views of it are reached'):
+            self.assertGreater(get_deep_size([array[:10], array[10:]]), array.nbytes)
+            self.assertLess(get_deep_size([array[:10], array[10:]]), 2 * array.nbytes)
+        with self.subTest('Containers are counted along with their contents'):
+            strings = [str(number) * 100 for number in range(10)]
+            self.assertEqual(get_deep_size([strings]), sys.getsizeof(strings) + sum(map(sys.getsizeof, strings)))
+        with self.subTest('Objects already seen are not counted again'):
+            seen = set()
+            self.assertGreater(get_deep_size([array], seen), array.nbytes)
+            self.assertEqual(get_deep_size([array[:10]], seen), sys.getsizeof(array[:10]))
+        with self.subTest('Functions and types are never counted'):
+            self.assertEqual(get_deep_size([len, int, self.test_get_deep_size]), 0)
+
+    def test_get_set_trie_stats(self):
+        with self.subTest('Sets sharing their smallest items share nodes'):
+            self.assertEqual(get_set_trie_stats([(), (1,), (2, 1), (1, 3), (2, 5, 9)]),
+                             {'entries': 5, 'nodes': 6, 'depth': 3, 'mean_fan_out': 1.5, 'max_fan_out': 2})
+        with self.subTest('An empty trie has no nodes'):
+            self.assertEqual(get_set_trie_stats([]),
+                             {'entries': 0, 'nodes': 0, 'depth': 0, 'mean_fan_out': 0.0, 'max_fan_out': 0})
+
+    @unittest.skipUnless(os.path.exists('/proc/self/smaps_rollup'), 'Only Linux reports pages')
+    def test_get_page_usage(self):
+        page_usage = get_page_usage()
+        with self.subTest('Resident pages are either shared or private'):
+            self.assertEqual(page_usage['rss'], page_usage['shared'] + page_usage['private'])
+            self.assertLessEqual(page_usage['pss'], page_usage['rss'])
+        with self.subTest('The process tree begins with the process'):
+            self.assertEqual(get_process_tree(os.getpid())[0], os.getpid())
+
+
+if __name__ == '__main__':
+    unittest.main()
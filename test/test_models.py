@@ -56,6 +56,41 @@ class TestModels(unittest.TestCase):
                                             (map, self.suggestion_data.__getitem__),
                                             tuple))
 
+        with self.subTest('Suggestions constructed from validated data are equal to those constructed normally'):
+            self.assertSequenceEqual(tuple(map(Suggestion.from_validated_data, self.suggestion_data)),
+                                     tuple(map(Suggestion, self.suggestion_data)))
+
+    def test_validate_suggestion_data(self):
+        def validate(suggestion_data: tuple[np.ndarray, ...], product_count: int = None) -> None:
+            validate_suggestion_data(np.concatenate(suggestion_data),
+                                     np.cumsum(tuple(map(len, suggestion_data[:-1]))),
+                                     product_count)
+
+        with self.subTest('Valid suggestion data passes'):
+            validate(self.suggestion_data, 36)
+        with self.subTest('Data of the wrong type is rejected'):
+            with self.assertRaises(TypeError):
+                validate_suggestion_data(np.concatenate(self.suggestion_data).astype(np.int64), np.array([6]))
+        for index, data in ((1, np.array([9, 25, 3, 7, 8, 10], dtype=np.uint32)),  # Valid
+                            (1, np.array([9, 0, 3, 7, 8, 10], dtype=np.uint32)),
+                            (1, np.array([9, 25, 3, 0, 8, 10], dtype=np.uint32)),
+                            (1, np.array([9, 25, 3, 7, 0, 10], dtype=np.uint32)),
+                            (1, np.array([9, 25, 3, 7], dtype=np.uint32)),
+                            (1, np.array([9, 25, 3, 7, 8, 10, 10], dtype=np.uint32)),
+                            (1, np.array([9, 25, 3, 7, 8, 28, 10], dtype=np.uint32))):
+            suggestion_data = (*self.suggestion_data[:index], data, *self.suggestion_data[index + 1:])
+            with self.subTest(f'Suggestion data {data} is rejected exactly when Suggestion rejects it'):
+                try:
+                    Suggestion(data)
+                except ValueError:
+                    with self.assertRaisesRegex(ValueError, f'^Suggestion {index}:'):
+                        validate(suggestion_data)
+                else:
+                    validate(suggestion_data)
+        with self.subTest('Items outside the range of products are rejected'):
+            with self.assertRaisesRegex(ValueError, '^Suggestion 1:'):
+                validate(self.suggestion_data, 35)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,12 @@
+import os
+import os.path as path
+from tempfile import TemporaryDirectory
 import unittest
-from numpy import array, uint32
+from zipfile import ZipFile
+from numpy import arange, array, array_equal, concatenate, diff, empty, int64, memmap, savez, savez_compressed, uint8, \
+    uint16, uint32
 from models import Suggestion
+import repositories
 from repositories import *
 
 
@@ -580,6 +586,138 @@ class TestRepositories(unittest.TestCase):
                                       Suggestion(array([ 2, 25,  1, 25,  1], dtype=uint32)),
                                       Suggestion(array([ 0, 25,  1, 25,  1], dtype=uint32))),
                                      suggestions)
+        with self.subTest('Saved suggestions load back unchanged'):
+            suggestion_data = suggestions_repository.get_all_suggestion_data()
+            with TemporaryDirectory() as directory:
+                saved_suggestions_repository = SuggestionRepository(path.join(directory, 'suggestions.npz.xz'))
+                saved_suggestions_repository.save_all_suggestions(suggestion_data)
+                self.assertTrue(all(map(array_equal,
+                                        suggestion_data,
+                                        saved_suggestions_repository.get_all_suggestion_data())))
+        with self.subTest('The depth of trimmed suggestions is saved with them'):
+            with TemporaryDirectory() as directory:
+                saved_suggestions_repository = SuggestionRepository(path.join(directory, 'suggestions.npz'))
+                saved_suggestions_repository.save_all_suggestions(suggestion_data)
+                self.assertIsNone(saved_suggestions_repository.get_top_per_antecedent())
+                saved_suggestions_repository.save_all_suggestions(suggestion_data, top_per_antecedent=12)
+                self.assertEqual(saved_suggestions_repository.get_top_per_antecedent(), 12)
+                self.assertTrue(all(map(array_equal,
+                                        suggestion_data,
+                                        saved_suggestions_repository.get_all_suggestion_data())))
+        with self.subTest('Suggestions referring to nonexistent products are not saved'):
+            with TemporaryDirectory() as directory, self.assertRaises(ValueError):
+                SuggestionRepository(path.join(directory, 'suggestions.npz')).save_all_suggestions(suggestion_data, 44)
+        with self.subTest('Suggestions referring to products beyond those given are not loaded, checksum or not'):
+            with TemporaryDirectory() as directory:
+                data_file = path.join(directory, 'suggestions.npz')
+                SuggestionRepository(data_file).save_all_suggestions(suggestion_data, 45)
+                self.assertEqual(len(SuggestionRepository(data_file, product_count=45).get_all_suggestions()),
+                                 len(suggestion_data))
+                with self.assertRaises(ValueError):
+                    SuggestionRepository(data_file, product_count=44).get_all_suggestions()
+        with self.subTest('No suggestions save and load back as none'):
+            with TemporaryDirectory() as directory:
+                saved_suggestions_repository = SuggestionRepository(path.join(directory, 'suggestions.npz'))
+                saved_suggestions_repository.save_all_suggestions(())
+                self.assertSequenceEqual(saved_suggestions_repository.get_all_suggestions(), ())
+                self.assertSequenceEqual(saved_suggestions_repository.get_all_suggestion_data(), [])
+        with self.subTest('Suggestions whose checksum does not match are not loaded'):
+            with TemporaryDirectory() as directory:
+                saved_suggestions_repository = SuggestionRepository(path.join(directory, 'suggestions.npz'))
+                saved_suggestions_repository.save_all_suggestions(suggestion_data)
+                with ZipFile(saved_suggestions_repository.suggestions_data_file) as archive:
+                    members = {name: archive.read(name) for name in archive.namelist()}
+                members['item_set_counts/0'] = bytes([members['item_set_counts/0'][0] ^ 1]) \
+                    + members['item_set_counts/0'][1:]
+                with ZipFile(saved_suggestions_repository.suggestions_data_file, 'w') as archive:
+                    for name, data in members.items():
+                        archive.writestr(name, data)
+                with self.assertRaises(ValueError):
+                    saved_suggestions_repository.get_all_suggestions()
+        with self.subTest('Suggestions saved as .npz files before blocks load, checked against their checksum'):
+            with TemporaryDirectory() as directory:
+                saved_suggestions_repository = SuggestionRepository(path.join(directory, 'suggestions.npz'))
+                saved_suggestions_repository.save_all_suggestions(suggestion_data)
+                with ZipFile(saved_suggestions_repository.suggestions_data_file) as archive:
+                    columns = repositories._load_blocks(archive)
+                savez_compressed(saved_suggestions_repository.suggestions_data_file, **columns)
+                self.assertTrue(all(map(array_equal,
+                                        suggestion_data,
+                                        saved_suggestions_repository.get_all_suggestion_data())))
+                columns['item_set_counts'][0] += 1
+                savez(saved_suggestions_repository.suggestions_data_file, **columns)
+                with self.assertRaises(ValueError):
+                    saved_suggestions_repository.get_all_suggestions()
+        with self.subTest('Suggestions saved with their antecedent items delta-encoded load'):
+            with TemporaryDirectory() as directory:
+                saved_suggestions_repository = SuggestionRepository(path.join(directory, 'suggestions.npz'))
+                saved_suggestions_repository.save_all_suggestions(suggestion_data)
+                with ZipFile(saved_suggestions_repository.suggestions_data_file) as archive:
+                    columns = repositories._load_blocks(archive)
+                del columns['antecedent_items'], columns['checksum']
+                columns['antecedent_deltas'] = concatenate([diff(data[5:].astype(int64), prepend=0)
+                                                            for data in suggestion_data]).astype(uint16)
+                columns['checksum'] = repositories._compute_checksum(columns)
+                savez_compressed(saved_suggestions_repository.suggestions_data_file, **columns)
+                self.assertTrue(all(map(array_equal,
+                                        suggestion_data,
+                                        saved_suggestions_repository.get_all_suggestion_data())))
+        with self.subTest('Arrays saved in blocks load back unchanged, whatever their size'):
+            arrays = {'empty': empty(0, uint32), 'short': arange(3, dtype=uint8),
+                      'long': arange(1000, dtype=uint16).reshape(10, 100)}
+            with TemporaryDirectory() as directory:
+                with open(path.join(directory, 'arrays.zip'), 'wb') as file:
+                    repositories._save_blocks(file, arrays, 64)
+                with ZipFile(path.join(directory, 'arrays.zip')) as archive:
+                    self.assertEqual(len(archive.namelist()), 1 + 0 + 1 + 32)
+                    loaded_arrays = repositories._load_blocks(archive)
+                self.assertEqual(loaded_arrays.keys(), arrays.keys())
+                self.assertTrue(all(array_equal(loaded_arrays[name], arrays[name])
+                                    and loaded_arrays[name].dtype == arrays[name].dtype for name in arrays))
+
+
+    def test_MaterializedSuggestionRepository(self):
+        arrays = {'single_suggestions': array([[1, 2, 3], [4, 5, 6]], dtype=uint32),
+                  'pair_items': array([[0, 1]], dtype=uint32)}
+        with TemporaryDirectory() as directory:
+            materialized_suggestions_repository = \
+                MaterializedSuggestionRepository(path.join(directory, 'suggestions.materialized.npz'))
+            materialized_suggestions_repository.save_materialized_suggestions('0123abcd', arrays)
+            model_version, loaded_arrays = materialized_suggestions_repository.get_materialized_suggestions()
+            with self.subTest('Saved materialized suggestions load back unchanged, with their model version'):
+                self.assertEqual(model_version, '0123abcd')
+                self.assertEqual(loaded_arrays.keys(), arrays.keys())
+                self.assertTrue(all(array_equal(loaded_arrays[name], arrays[name]) for name in arrays))
+            with self.subTest('Materialized suggestions are memory-mapped'):
+                self.assertTrue(all(isinstance(loaded_array, memmap) for loaded_array in loaded_arrays.values()))
+            del loaded_arrays
+
+    def test_AvailabilityRepository(self):
+        with TemporaryDirectory() as directory:
+            availability_repository = AvailabilityRepository(path.join(directory, 'unavailable.txt'))
+            with self.subTest('Every product is available without a file'):
+                self.assertEqual(availability_repository.get_unavailable_products(), frozenset())
+            with self.subTest('Saved unavailable products load back unchanged'):
+                availability_repository.save_unavailable_products([7, 3, 7, 12])
+                self.assertEqual(availability_repository.get_unavailable_products(), {3, 7, 12})
+                availability_repository.save_unavailable_products([])
+                self.assertEqual(availability_repository.get_unavailable_products(), frozenset())
+                self.assertEqual(os.listdir(directory), ['unavailable.txt'])
+
+    def test_SketchRepository(self):
+        with TemporaryDirectory() as directory:
+            sketch_repository = SketchRepository(path.join(directory, 'sketches.npz'))
+            with self.subTest('sketch_data_file property'):
+                self.assertEqual(path.join(directory, 'sketches.npz'), sketch_repository.sketch_data_file)
+            with self.subTest('No sketches without a file'):
+                self.assertIsNone(sketch_repository.get_sketches())
+            with self.subTest('Saved sketches load back unchanged'):
+                sketch_repository.save_sketches({'counters': array([[1.5, 0], [0, 2]]), 'keys': array([3], uint32)})
+                sketches = sketch_repository.get_sketches()
+                self.assertEqual(sketches.keys(), {'counters', 'keys'})
+                self.assertTrue(array_equal(sketches['counters'], [[1.5, 0], [0, 2]]))
+                self.assertTrue(array_equal(sketches['keys'], [3]))
+                self.assertEqual(os.listdir(directory), ['sketches.npz'])
 
 
 if __name__ == '__main__':
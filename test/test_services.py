@@ -1,7 +1,23 @@
-from toolz import first, thread_last as thread
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, jsonify
+from itertools import chain
+import multiprocessing
+import os
+import os.path as path
+import random
+import sys
+from tempfile import TemporaryDirectory
+from threading import Barrier, get_ident
+from toolz import first, merge_sorted, take, thread_last as thread, unique
+from typing import Optional
 import unittest
-from repositories import ProductRepository, SuggestionRepository
+from unittest.mock import patch
+from autocomplete import Autocompleter
+from compact_suggestions import compact
+from repositories import MaterializedSuggestionRepository, ProductRepository, SuggestionRepository
 from services import *
+from shard_suggestions import get_shard_data_file, shard
+from sketches import OnlineRuleLearner
 from helpers import star
 
 
@@ -40,6 +56,510 @@ class TestServices(unittest.TestCase):
         with self.subTest('Query for text that does not exist in any product names results in zero suggestions'):
             self.assertSequenceEqual(product_lookup_service.get_suggestions(query='burrito'),
                                      ())  # Sorry, friend. No burritos here!
+        with self.subTest('Completion of “ch” suggests both mozzarella and cheddar (in that order)'):
+            self.assertSequenceEqual(thread(product_lookup_service.complete('ch'),
+                                            (map, lambda item: item['name']),
+                                            tuple),
+                                     ('Mozzarella Cheese', 'Cheddar Cheese'))
+        with self.subTest('Completion of the last term is narrowed by the whole words before it'):
+            self.assertSequenceEqual(thread(product_lookup_service.complete('basil p'),
+                                            (map, lambda item: item['name']),
+                                            tuple),
+                                     ('Basil Pesto',))
+        with self.subTest('Completion falls back to fuzzy matching when nothing begins with the prefix'):
+            self.assertSequenceEqual(product_lookup_service.complete('cheesy'),
+                                     product_lookup_service.get_suggestions(query='cheesy'))
+
+        with self.subTest('Pages of suggestions follow on from one another'):
+            basket = {products.index('Kimchi')}
+            all_suggestions, next_cursor, _ = product_lookup_service.get_suggestions_page(basket,
+                                                                                            limit=MAX_PAGE_SIZE)
+            self.assertIsNone(next_cursor)
+            self.assertSequenceEqual(product_lookup_service.get_suggestions_page(basket)[0],
+                                     product_lookup_service.get_suggestions(basket))
+            pages = []
+            while True:
+                suggestions, next_cursor, _ = product_lookup_service.get_suggestions_page(basket, limit=3,
+                                                                                          cursor=next_cursor)
+                pages.append(suggestions)
+                if next_cursor is None:
+                    break
+            self.assertTrue(all(len(suggestions) == 3 for suggestions in pages[:-1]))
+            self.assertSequenceEqual(tuple(chain.from_iterable(pages)), all_suggestions)
+            self.assertSequenceEqual(product_lookup_service.get_suggestions_page(basket, limit=3, cursor='3')[0],
+                                     all_suggestions[3:6])  # Pages can be requested again.
+        with self.subTest('Invalid limits and cursors are rejected'):
+            self.assertRaises(ValueError, product_lookup_service.get_suggestions_page, limit=0)
+            self.assertRaises(ValueError, product_lookup_service.get_suggestions_page, limit=MAX_PAGE_SIZE + 1)
+            self.assertRaises(ValueError, product_lookup_service.get_suggestions_page, cursor='-1')
+            self.assertRaises(ValueError, product_lookup_service.get_suggestions_page, limit='5')
+            self.assertRaises(ValueError, product_lookup_service.get_suggestions_page, limit=True)
+            self.assertRaises(ValueError, product_lookup_service.get_suggestions_page, cursor=5)
+        with self.subTest('Pages of suggestions from a trimmed model end at the depth it was trimmed to'):
+            with TemporaryDirectory() as directory:
+                trimmed_suggestions_repository = SuggestionRepository(path.join(directory, 'suggestions.npz'))
+                trimmed_suggestions_repository.save_all_suggestions(
+                    compact(suggestions_repository.get_all_suggestion_data(), top_per_antecedent_items=10),
+                    top_per_antecedent=10)
+                trimmed_product_lookup_service = ProductLookupService(product_repository,
+                                                                      trimmed_suggestions_repository)
+            self.assertGreater(len(all_suggestions), 10)
+            self.assertEqual(trimmed_product_lookup_service.get_suggestions_page(basket, limit=MAX_PAGE_SIZE),
+                             (all_suggestions[:10], None, False))
+            self.assertEqual(trimmed_product_lookup_service.get_suggestions_page(basket, limit=4, cursor='8'),
+                             (all_suggestions[8:10], None, False))
+            self.assertEqual(trimmed_product_lookup_service.get_suggestions_page(basket, limit=5, cursor='5'),
+                             (all_suggestions[5:10], None, False))
+            self.assertEqual(trimmed_product_lookup_service.get_suggestions_page(basket, limit=3, cursor='10'),
+                             ([], None, False))
+            self.assertEqual(trimmed_product_lookup_service.get_suggestions_page(basket, limit=3),
+                             (all_suggestions[:3], '3', False))
+        with self.subTest('Queries with a basket suggest the products matching the query in basket rank order'):
+            for basket in ({products.index('Bacon')}, {products.index('Kimchi'), products.index('Bacon')}):
+                for query in ('cheese', 'rice', 'c'):
+                    query_products = set(map(lambda item: item['identifier'],
+                                             product_lookup_service.get_suggestions_page(query=query,
+                                                                                         limit=MAX_PAGE_SIZE)[0]))
+                    self.assertSequenceEqual(product_lookup_service.get_suggestions_page(basket, query,
+                                                                                         MAX_PAGE_SIZE)[0],
+                                             [item
+                                              for item in product_lookup_service.get_suggestions_page(
+                                                  basket, limit=MAX_PAGE_SIZE)[0]
+                                              if item['identifier'] in query_products])
+        with self.subTest('Suggestions ranked by another metric are the matching rules in that order'):
+            suggestions = sorted(suggestions_repository.get_all_suggestions())
+            for rank_by in RANKING_METRICS:
+                for basket in (set(), {products.index('Kimchi')},
+                               {products.index('Bacon'), products.index('Kimchi')}):
+                    for query in ('', 'cheese'):
+                        query_products = set(map(lambda item: item['identifier'],
+                                                 product_lookup_service.get_suggestions_page(query=query,
+                                                                                             limit=MAX_PAGE_SIZE)[0]))
+                        matching_suggestions = sorted(
+                            (suggestion for suggestion in suggestions
+                             if suggestion.antecedent_items and basket.issuperset(suggestion.antecedent_items)),
+                            key=lambda suggestion: -getattr(suggestion, rank_by))
+                        default_suggestions = [suggestion for suggestion in suggestions
+                                               if not suggestion.antecedent_items]
+                        self.assertSequenceEqual(
+                            [(item['identifier'], item['antecedent_items'])
+                             for item in product_lookup_service.get_suggestions_page(basket, query, MAX_PAGE_SIZE,
+                                                                                     rank_by=rank_by)[0]],
+                            thread(chain(matching_suggestions, default_suggestions),
+                                   (filter, lambda suggestion: suggestion.consequent_item not in basket
+                                    and (not query or suggestion.consequent_item in query_products)),
+                                   lambda suggestions: unique(suggestions,
+                                                              key=lambda suggestion: suggestion.consequent_item),
+                                   (map, lambda suggestion: (int(suggestion.consequent_item),
+                                                             [products[item] for item in suggestion.antecedent_items])),
+                                   (take, MAX_PAGE_SIZE),
+                                   list))
+            self.assertRaises(ValueError, product_lookup_service.get_suggestions, rank_by='popularity')
+        with self.subTest('Materialized suggestions for small baskets are the same as those computed live'):
+            pairs = ((products.index('Kimchi'), products.index('Bacon')),
+                     (products.index('Rice'), products.index('Bacon')))
+            with TemporaryDirectory() as directory:
+                materialized_suggestions_repository = \
+                    MaterializedSuggestionRepository(path.join(directory, 'suggestions.materialized.npz'))
+                materialized_suggestions_repository.save_materialized_suggestions(
+                    product_lookup_service.model_version, product_lookup_service.materialize_suggestions(pairs))
+                materialized_product_lookup_service = \
+                    ProductLookupService(product_repository, suggestions_repository,
+                                         materialized_suggestions_repository=materialized_suggestions_repository)
+                for basket in (*map(lambda item: {item}, range(len(products))), *map(set, pairs)):
+                    for limit in (1, 10):
+                        self.assertSequenceEqual(materialized_product_lookup_service.get_suggestions_page(basket,
+                                                                                                          limit=limit),
+                                                 product_lookup_service.get_suggestions_page(basket, limit=limit))
+                materialized_product_lookup_service.get_suggestions({products.index('Kimchi'), products.index('Rice')})
+                self.assertEqual(materialized_product_lookup_service.stats['materialized'],
+                                 {'single_items': len(products), 'pairs': 2, 'hits': 2 * (len(products) + 2),
+                                  'misses': 1})
+                unavailable_products = {products.index('Rice'), products.index('Cheddar Cheese')}
+                materialized_product_lookup_service.set_unavailable_products(unavailable_products)
+                for basket in (*map(lambda item: {item}, range(len(products))), *map(set, pairs)):
+                    for limit in (1, 10):
+                        self.assertSequenceEqual(
+                            materialized_product_lookup_service.get_suggestions_page(basket, limit=limit)[0],
+                            [item
+                             for item in product_lookup_service.get_suggestions_page(basket, limit=MAX_PAGE_SIZE)[0]
+                             if item['identifier'] not in unavailable_products][:limit])
+        with self.subTest('Baskets matched within a time budget suggest the same as those matched at once'):
+            budgeted_product_lookup_service = ProductLookupService(product_repository, suggestions_repository,
+                                                                   basket_time_budget=60)
+            for basket in ({products.index('Kimchi')}, {products.index('Bacon'), products.index('Kimchi')},
+                           set(range(len(products)))):
+                for query in ('', 'cheese'):
+                    self.assertSequenceEqual(budgeted_product_lookup_service.get_suggestions_page(basket, query,
+                                                                                                  MAX_PAGE_SIZE),
+                                             (*product_lookup_service.get_suggestions_page(basket, query,
+                                                                                           MAX_PAGE_SIZE)[:2],
+                                              False))
+        with self.subTest('Baskets cut short by the time budget are flagged and counted'):
+            budgeted_product_lookup_service = ProductLookupService(product_repository, suggestions_repository,
+                                                                   basket_time_budget=0)
+            self.assertTrue(budgeted_product_lookup_service.get_suggestions_page({products.index('Kimchi')})[2])
+            self.assertEqual(budgeted_product_lookup_service.stats['truncated_requests'], 1)
+        with self.subTest('Baskets larger than the maximum are rejected'):
+            capped_product_lookup_service = ProductLookupService(product_repository, suggestions_repository,
+                                                                 max_basket_size=1)
+            self.assertRaises(ValueError, capped_product_lookup_service.get_suggestions, {0, 1})
+            self.assertRaises(ValueError, capped_product_lookup_service.create_session, {0, 1})
+            session_id = capped_product_lookup_service.create_session({0})
+            self.assertRaises(ValueError, capped_product_lookup_service.update_session, session_id, add=[1])
+            capped_product_lookup_service.update_session(session_id, add=[1], remove=[0])
+        with self.subTest('Sessions suggest the same as baskets sent whole as items are added and removed'):
+            session_id = product_lookup_service.create_session()
+            basket = set()
+            for name, added in (('Kimchi', True), ('Bacon', True), ('Kimchi', False), ('Kimchi', True),
+                                ('Bacon', False), ('Kimchi', False)):
+                item = products.index(name)
+                if added:
+                    basket.add(item)
+                    product_lookup_service.update_session(session_id, add=[item])
+                else:
+                    basket.remove(item)
+                    product_lookup_service.update_session(session_id, remove=[item])
+                for query in ('', 'cheese'):
+                    self.assertSequenceEqual(product_lookup_service.get_session_suggestions(session_id, query),
+                                             product_lookup_service.get_suggestions(basket, query))
+        with self.subTest('Unknown sessions are rejected'):
+            self.assertRaises(KeyError, product_lookup_service.get_session_suggestions, 'unknown')
+            self.assertRaises(KeyError, product_lookup_service.update_session, 'unknown', add=[0])
+        with self.subTest('Products taken off sale are never suggested, and pages are still filled'):
+            unavailable_products = {products.index('Rice'), products.index('Cheddar Cheese'), products.index('Bread')}
+            available_product_lookup_service = ProductLookupService(product_repository, suggestions_repository)
+            available_product_lookup_service.set_unavailable_products(unavailable_products)
+            for basket in (set(), {products.index('Kimchi')}, {products.index('Bacon'), products.index('Kimchi')}):
+                for query in ('', 'cheese'):
+                    for rank_by in RANKING_METRICS:
+                        available_suggestions = [item
+                                                 for item in product_lookup_service.get_suggestions_page(
+                                                     basket, query, MAX_PAGE_SIZE, rank_by=rank_by)[0]
+                                                 if item['identifier'] not in unavailable_products]
+                        self.assertSequenceEqual(available_product_lookup_service.get_suggestions_page(
+                                                     basket, query, MAX_PAGE_SIZE, rank_by=rank_by)[0],
+                                                 available_suggestions)
+                        self.assertSequenceEqual(available_product_lookup_service.get_suggestions(basket, query,
+                                                                                                  rank_by),
+                                                 available_suggestions[:10])
+            self.assertSequenceEqual(thread(available_product_lookup_service.complete('ch'),
+                                            (map, lambda item: item['name']),
+                                            tuple),
+                                     ('Mozzarella Cheese',))
+            session_id = available_product_lookup_service.create_session({products.index('Kimchi')})
+            self.assertSequenceEqual(available_product_lookup_service.get_session_suggestions(session_id),
+                                     available_product_lookup_service.get_suggestions({products.index('Kimchi')}))
+            self.assertEqual(available_product_lookup_service.stats['unavailable_products'], 3)
+        with self.subTest('Products are put back on sale, and taken off sale from a forked process for all processes'):
+            version = available_product_lookup_service.availability_version
+            available_product_lookup_service.update_unavailable_products(add=[products.index('Bacon')],
+                                                                         remove=[products.index('Rice')])
+            self.assertEqual(available_product_lookup_service.unavailable_products,
+                             sorted(unavailable_products - {products.index('Rice')} | {products.index('Bacon')}))
+            self.assertNotEqual(available_product_lookup_service.availability_version, version)
+            process = multiprocessing.get_context('fork').Process(
+                target=available_product_lookup_service.set_unavailable_products, args=(unavailable_products,))
+            process.start()
+            process.join()
+            self.assertEqual(available_product_lookup_service.unavailable_products, sorted(unavailable_products))
+            self.assertEqual(available_product_lookup_service.availability_version, version)
+            available_product_lookup_service.set_unavailable_products(())
+            self.assertSequenceEqual(available_product_lookup_service.get_suggestions({products.index('Kimchi')}),
+                                     product_lookup_service.get_suggestions({products.index('Kimchi')}))
+            self.assertEqual(available_product_lookup_service.availability_version,
+                             product_lookup_service.availability_version)
+            self.assertRaises(ValueError, available_product_lookup_service.set_unavailable_products, [len(products)])
+            self.assertRaises(ValueError, available_product_lookup_service.update_unavailable_products, add=[-1])
+        with self.subTest('Pages ranked while products are taken off sale and put back on are ranked under one mask'):
+            basket = {products.index('Kimchi')}
+            responses = []
+            for products_off_sale in (unavailable_products, ()):
+                available_product_lookup_service.set_unavailable_products(products_off_sale)
+                responses.append(available_product_lookup_service.get_suggestions_page(basket, limit=MAX_PAGE_SIZE))
+            process = multiprocessing.get_context('fork').Process(
+                target=lambda: [available_product_lookup_service.set_unavailable_products(products_off_sale)
+                                for _ in range(500) for products_off_sale in (unavailable_products, ())])
+            process.start()
+            while process.is_alive():
+                self.assertIn(available_product_lookup_service.get_suggestions_page(basket, limit=MAX_PAGE_SIZE),
+                              responses)
+            process.join()
+            self.assertEqual(available_product_lookup_service.get_suggestions_page(basket, limit=MAX_PAGE_SIZE),
+                             responses[1])
+        with self.subTest('Rules learned online are ranked along with the mined ones by lift'):
+            kimchi, cheddar_cheese = products.index('Kimchi'), products.index('Cheddar Cheese')
+            online_rule_learner = OnlineRuleLearner(len(products), item_sketch_width=1024, pair_sketch_width=1024,
+                                                    pair_capacity=64, min_pair_count=5)
+            online_product_lookup_service = ProductLookupService(product_repository, suggestions_repository,
+                                                                 online_rule_learner=online_rule_learner)
+            version = online_product_lookup_service.online_rules_version
+            online_rule_learner.learn([[kimchi, cheddar_cheese]] * 20 + [[products.index('Beer')]] * 20)
+            online_rule_learner.refresh()
+            self.assertNotEqual(online_product_lookup_service.online_rules_version, version)
+            online_suggestions = online_rule_learner.get_rules()[kimchi][0]
+            session_id = online_product_lookup_service.create_session({kimchi})
+            for query in ('', 'cheese'):
+                suggestions = first(online_product_lookup_service.rank({kimchi}, query, MAX_PAGE_SIZE))
+                self.assertIn(online_suggestions[0], suggestions)
+                self.assertSequenceEqual(suggestions,
+                                         thread(merge_sorted(first(product_lookup_service.rank({kimchi}, query,
+                                                                                               MAX_PAGE_SIZE)),
+                                                             online_suggestions),
+                                                lambda suggestions: unique(suggestions,
+                                                                           key=lambda suggestion:
+                                                                           suggestion.consequent_item),
+                                                (take, MAX_PAGE_SIZE),
+                                                list))
+                self.assertSequenceEqual(online_product_lookup_service.get_session_suggestions(session_id, query),
+                                         online_product_lookup_service.get_suggestions({kimchi}, query))
+            self.assertSequenceEqual(online_product_lookup_service.get_suggestions({kimchi}, rank_by='confidence'),
+                                     product_lookup_service.get_suggestions({kimchi}, rank_by='confidence'))
+            self.assertEqual(online_product_lookup_service.stats['online_learning']['rules'], 2)
+        with self.subTest('Each basket is learned from once, not once per query typed against it'):
+            bacon = products.index('Bacon')
+            with patch.object(OnlineRuleLearner, 'observe') as observe:
+                for query in ('', 'c', 'ch', 'che', 'chee', 'chees', 'cheese'):
+                    online_product_lookup_service.get_suggestions_page({kimchi}, query)
+                online_product_lookup_service.get_suggestions_page({kimchi}, limit=3, cursor='3')
+                session_id = online_product_lookup_service.create_session({kimchi})
+                online_product_lookup_service.update_session(session_id, add=[bacon])
+                online_product_lookup_service.update_session(session_id, add=[bacon])
+                online_product_lookup_service.update_session(session_id, remove=[kimchi])
+                for query in ('', 'c', 'ch'):
+                    online_product_lookup_service.get_session_suggestions(session_id, query)
+            self.assertSequenceEqual([set(map(int, first(call.args))) for call in observe.call_args_list],
+                                     [{kimchi}, {kimchi}, {kimchi, bacon}, {bacon}])
+        with self.subTest('Queries typed a character at a time are refined from the products matching their prefixes'):
+            uncached_product_lookup_service = ProductLookupService(product_repository, suggestions_repository,
+                                                                   term_cache_size=0)
+            stats = product_lookup_service.stats['term_cache']
+            for query in ('mo', 'moz', 'mozz', 'mozza', 'mozz', 'mozzarella ch', 'mozzarella che', 'mozzarellx',
+                          'mozzarellxa', 'chese', 'chesee'):
+                self.assertSequenceEqual(product_lookup_service.get_suggestions(query=query),
+                                         uncached_product_lookup_service.get_suggestions(query=query))
+            refined_stats = product_lookup_service.stats['term_cache']
+            self.assertGreater(refined_stats['refinements'], stats['refinements'])
+            self.assertGreater(refined_stats['hits'], stats['hits'])
+        with self.subTest('Terms are only autocompleted when no word begins with them'):
+            with patch.object(Autocompleter, 'search', autospec=True, side_effect=Autocompleter.search) as search:
+                refined_product_lookup_service = ProductLookupService(product_repository, suggestions_repository)
+                for query in ('mo', 'moz', 'mozz', 'mozza', 'mozzarella'):
+                    refined_product_lookup_service.get_suggestions(query=query)
+                self.assertEqual(search.call_count, 0)
+                self.assertSequenceEqual(refined_product_lookup_service.get_suggestions(query='mozzarellx'),
+                                         refined_product_lookup_service.get_suggestions(query='mozzarella'))
+                self.assertEqual(search.call_count, 1)
+        with self.subTest('The model version is the same for the same model'):
+            self.assertEqual(product_lookup_service.model_version,
+                             ProductLookupService(product_repository, suggestions_repository).model_version)
+        with self.subTest('Profiled requests get the same page, with where the time went'):
+            basket = {products.index('Kimchi'), products.index('Bacon')}
+            *page, profile = product_lookup_service.profile_suggestions_page_json(basket, 'cheese', limit=1)
+            self.assertEqual(tuple(page), product_lookup_service.get_suggestions_page_json(basket, 'cheese', limit=1))
+            self.assertEqual(profile['stages'].keys(), {'tokenize', 'autocomplete', 'word_index', 'antecedent_lookup',
+                                                        'merge', 'serialization', 'other'})
+            self.assertAlmostEqual(sum(profile['stages'].values()), profile['seconds'], 3)
+            self.assertEqual(profile['counts']['query_terms'], 1)
+            self.assertEqual(profile['counts']['query_products'], 2)
+            self.assertGreater(profile['counts']['rules'], 0)
+            self.assertLessEqual(len(profile['functions']), 20)
+        with self.subTest('Memory is reported for every structure and cache'):
+            memory_stats = product_lookup_service.get_memory_stats()
+            self.assertEqual(memory_stats['structures'].keys(),
+                             {'rules', 'products', 'antecedent_index', 'antecedent_item_index', 'word_index',
+                              'autocompleter', 'materialized'})
+            self.assertEqual(memory_stats['structures']['rules']['entries'],
+                             len(suggestions_repository.get_all_suggestions()))
+            self.assertEqual(memory_stats['structures']['products']['entries'], len(products))
+            self.assertLessEqual(memory_stats['structures']['word_index']['entries'], len(products))
+            self.assertTrue(all(memory_stats['structures'][name]['bytes'] > 0
+                                for name in ('rules', 'products', 'antecedent_index', 'word_index')))
+            self.assertEqual({name for name, structure_stats in memory_stats['structures'].items()
+                              if structure_stats.get('bytes_lower_bound')},
+                             {'antecedent_index', 'word_index'})
+            self.assertEqual(memory_stats['caches'].keys(), {'pages', 'sessions', 'terms', 'fragments'})
+            self.assertGreater(memory_stats['caches']['terms']['entries'], 0)
+        with self.subTest('Serialized suggestions are byte-for-byte what jsonify makes of them'):
+            with Flask(__name__).app_context():
+                for basket, query in ((set(), ''), ({products.index('Kimchi')}, ''), (set(), 'cheese'),
+                                      ({products.index('Bacon')}, 'cheese'), (set(), 'burrito')):
+                    for _ in range(2):  # Once to serialize, and once more to reuse the cached fragments
+                        self.assertEqual(b'{"data":' + product_lookup_service.get_suggestions_json(basket, query)
+                                         + b'}\n',
+                                         jsonify({'data': product_lookup_service.get_suggestions(basket, query)})
+                                         .get_data())
+                for query in ('ch', 'basil p', 'cheesy'):
+                    self.assertEqual(b'{"data":' + product_lookup_service.complete_json(query) + b'}\n',
+                                     jsonify({'data': product_lookup_service.complete(query)}).get_data())
+
+    def test_ProductLookupService_concurrency(self):
+        product_repository = ProductRepository('products.txt.xz')
+        suggestions_repository = SuggestionRepository('suggestions.npz.xz')
+        products = product_repository.get_all_products()[0]
+        # Small caches, so that entries are evicted while other threads use them
+        product_lookup_service = ProductLookupService(product_repository, suggestions_repository, page_cache_size=2,
+                                                      session_count=8, term_cache_size=4)
+        expected_product_lookup_service = ProductLookupService(product_repository, suggestions_repository)
+        queries = ('', 'c', 'ch', 'che', 'chee', 'cheese', 'cheesy', 'rice', 'basil p')
+
+        def page_through(basket: set[int], query: str) -> list[dict]:
+            suggestions, next_cursor, _ = product_lookup_service.get_suggestions_page(basket, query, 2)
+            while next_cursor is not None:
+                page, next_cursor, _ = product_lookup_service.get_suggestions_page(basket, query, 2, next_cursor)
+                suggestions.extend(page)
+            return suggestions
+
+        def change_session(seed: int) -> list[tuple[list[dict], list[dict]]]:
+            generator = random.Random(seed)
+            basket = set(generator.sample(range(len(products)), 2))
+            session_id = product_lookup_service.create_session(basket)
+            responses = []
+            for _ in range(3):
+                item = generator.randrange(len(products))
+                try:
+                    if item in basket:
+                        basket.remove(item)
+                        product_lookup_service.update_session(session_id, remove=[item])
+                    else:
+                        basket.add(item)
+                        product_lookup_service.update_session(session_id, add=[item])
+                    responses.append((product_lookup_service.get_session_suggestions(session_id, 'c'),
+                                      expected_product_lookup_service.get_suggestions(basket, 'c')))
+                except KeyError:  # Evicted by the sessions of other threads
+                    session_id = product_lookup_service.create_session(basket)
+            return responses
+
+        # Each task pages through the suggestions for a request, completes its query, and changes a session of its
+        # own, so that every kind of request runs alongside every other.
+        def serve(seed: int) -> tuple[list[dict], list[dict], list[tuple[list[dict], list[dict]]]]:
+            basket, query = requests[seed]
+            return page_through(basket, query), product_lookup_service.complete(query), change_session(seed)
+
+        # Identical requests released at once, many of which wait on the first rather than being ranked themselves
+        coalescing_product_lookup_service = ProductLookupService(product_repository, suggestions_repository,
+                                                                 coalescing_timeout=60)
+        barrier = Barrier(16)
+
+        def request_everything(_) -> tuple[list[dict], Optional[str], bool]:
+            barrier.wait()
+            return coalescing_product_lookup_service.get_suggestions_page(set(range(len(products))), 'c',
+                                                                          MAX_PAGE_SIZE)
+
+        generator = random.Random(0)
+        requests = [(set(generator.sample(range(len(products)), generator.randrange(3))), generator.choice(queries))
+                    for _ in range(500)]
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # Switches threads as often as possible, to bring out races.
+        try:
+            with ThreadPoolExecutor(16) as executor:
+                pages, completions, session_responses = zip(*executor.map(serve, range(len(requests))))
+                coalesced_pages = [page for _ in range(20) for page in executor.map(request_everything, range(16))]
+        finally:
+            sys.setswitchinterval(switch_interval)
+        with self.subTest('Concurrent requests for pages get the same suggestions as requests one at a time'):
+            for (basket, query), suggestions in zip(requests, pages):
+                self.assertSequenceEqual(suggestions,
+                                         expected_product_lookup_service.get_suggestions_page(basket, query,
+                                                                                              MAX_PAGE_SIZE)[0])
+        with self.subTest('Concurrent completions are the same as completions one at a time'):
+            for (_, query), suggestions in zip(requests, completions):
+                self.assertSequenceEqual(suggestions, expected_product_lookup_service.complete(query))
+        with self.subTest('Concurrently changed sessions suggest the same as baskets sent whole'):
+            for actual, expected in chain.from_iterable(session_responses):
+                self.assertSequenceEqual(actual, expected)
+        with self.subTest('Identical requests at the same time are ranked once and get the same suggestions'):
+            expected_page = expected_product_lookup_service.get_suggestions_page(set(range(len(products))), 'c',
+                                                                                 MAX_PAGE_SIZE)
+            self.assertTrue(all(page == expected_page for page in coalesced_pages))
+            stats = coalescing_product_lookup_service.stats['coalescing']
+            self.assertEqual(stats['computed'] + stats['coalesced'], len(coalesced_pages))
+            self.assertGreater(stats['coalesced'], 0)
+            self.assertEqual(stats['fallbacks'], 0)
+        with self.subTest('Caches stay within their bounds'):
+            self.assertLessEqual(product_lookup_service.stats['term_cache']['size'], 4)
+
+    def test_ShardedProductLookupService(self):
+        product_repository = ProductRepository(path.abspath('products.txt.xz'))
+        suggestions_repository = SuggestionRepository('suggestions.npz.xz')
+        product_lookup_service = ProductLookupService(product_repository, suggestions_repository)
+        products = product_repository.get_all_products()[0]
+        with TemporaryDirectory() as directory:
+            shard_suggestions_repositories = [
+                SuggestionRepository(get_shard_data_file(path.join(directory, 'suggestions.npz'), index, 3))
+                for index in range(3)]
+            for shard_suggestions_repository, shard_suggestions in zip(
+                    shard_suggestions_repositories, shard(suggestions_repository.get_all_suggestion_data(), 3)):
+                shard_suggestions_repository.save_all_suggestions(shard_suggestions)
+            sharded_product_lookup_service = ShardedProductLookupService(product_repository,
+                                                                         shard_suggestions_repositories)
+            baskets = (set(), {products.index('Kimchi')}, {products.index('Bacon'), products.index('Kimchi')},
+                       set(range(len(products))))
+            with self.subTest('Shards merged together suggest the same as all the rules in one place'):
+                for basket in baskets:
+                    for query in ('', 'cheese', 'cheesy', 'c', 'burrito'):
+                        for limit, cursor in ((10, None), (3, None), (3, '3'), (MAX_PAGE_SIZE, None)):
+                            self.assertSequenceEqual(sharded_product_lookup_service.get_suggestions_page(basket, query,
+                                                                                                         limit, cursor),
+                                                     product_lookup_service.get_suggestions_page(basket, query, limit,
+                                                                                                 cursor))
+                        for rank_by in RANKING_METRICS[1:]:
+                            self.assertSequenceEqual(
+                                sharded_product_lookup_service.get_suggestions_page(basket, query, 3, '3', rank_by),
+                                product_lookup_service.get_suggestions_page(basket, query, 3, '3', rank_by))
+                        self.assertEqual(sharded_product_lookup_service.get_suggestions_json(basket, query),
+                                         product_lookup_service.get_suggestions_json(basket, query))
+            with self.subTest('Shards merged together complete the same as all the rules in one place'):
+                for query in ('', 'ch', 'basil p', 'cheesy', 'burrito'):
+                    self.assertSequenceEqual(sharded_product_lookup_service.complete(query),
+                                             product_lookup_service.complete(query))
+            with self.subTest('Sessions span every shard'):
+                session_id = sharded_product_lookup_service.create_session({products.index('Kimchi')})
+                sharded_product_lookup_service.update_session(session_id, add=[products.index('Bacon')])
+                for query in ('', 'cheese'):
+                    self.assertSequenceEqual(sharded_product_lookup_service.get_session_suggestions(session_id, query),
+                                             product_lookup_service.get_suggestions(baskets[2], query))
+                self.assertRaises(KeyError, sharded_product_lookup_service.get_session_suggestions, 'unknown')
+            with self.subTest('Products taken off sale are taken off sale in every shard'):
+                unavailable_products = {products.index('Rice'), products.index('Cheddar Cheese')}
+                sharded_product_lookup_service.update_unavailable_products(add=unavailable_products)
+                product_lookup_service.set_unavailable_products(unavailable_products)
+                for basket in baskets[:3]:
+                    for query in ('', 'cheese'):
+                        self.assertSequenceEqual(sharded_product_lookup_service.get_suggestions_page(basket, query),
+                                                 product_lookup_service.get_suggestions_page(basket, query))
+                self.assertSequenceEqual(sharded_product_lookup_service.complete('ch'),
+                                         product_lookup_service.complete('ch'))
+                self.assertEqual([shard_stats['unavailable_products']
+                                  for shard_stats in sharded_product_lookup_service.stats['shards']], [2] * 3)
+                self.assertRaises(ValueError, sharded_product_lookup_service.set_unavailable_products, [len(products)])
+                sharded_product_lookup_service.set_unavailable_products(())
+                product_lookup_service.set_unavailable_products(())
+                self.assertSequenceEqual(sharded_product_lookup_service.get_suggestions(baskets[1]),
+                                         product_lookup_service.get_suggestions(baskets[1]))
+            with self.subTest('Errors raised in the shards are raised by the coordinator'):
+                self.assertRaises(ValueError, sharded_product_lookup_service.get_suggestions_page, cursor='-1')
+                self.assertRaises(KeyError, sharded_product_lookup_service.update_session,
+                                  '.'.join(['unknown'] * 3), add=[0])
+            with self.subTest('Shards keep serving after unexpected errors, and broken connections are reopened'):
+                self.assertRaises(RuntimeError, sharded_product_lookup_service.complete, None)
+                self.assertSequenceEqual(sharded_product_lookup_service.complete('ch'),
+                                         product_lookup_service.complete('ch'))
+                for connection in sharded_product_lookup_service._ShardedProductLookupService__connections[
+                        (os.getpid(), get_ident())]:
+                    connection.close()
+                self.assertRaises(RuntimeError, sharded_product_lookup_service.complete, 'ch')
+                self.assertSequenceEqual(sharded_product_lookup_service.complete('ch'),
+                                         product_lookup_service.complete('ch'))
+            with self.subTest('Profiled requests through the coordinator get the same page'):
+                *page, profile = sharded_product_lookup_service.profile_suggestions_page_json(baskets[2], 'cheese')
+                self.assertEqual(tuple(page), sharded_product_lookup_service.get_suggestions_page_json(baskets[2],
+                                                                                                       'cheese'))
+                self.assertEqual(profile['counts']['shards'], 3)
+                self.assertGreater(profile['stages']['shards'], 0)
+            with self.subTest('Every shard reports its memory'):
+                self.assertEqual(len(sharded_product_lookup_service.get_memory_stats()['shards']), 3)
+            self.assertEqual(len(sharded_product_lookup_service.stats['shards']), 3)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,24 @@
+import numpy as np
+import unittest
+from shard_suggestions import *
+
+
+class TestShardSuggestions(unittest.TestCase):
+    def test_get_shard_data_file(self):
+        self.assertEqual(get_shard_data_file('/data/suggestions.npz', 1, 4), '/data/suggestions.shard-1-of-4.npz')
+
+    def test_shard(self):
+        suggestions = (np.array([0, 100, 50, 100, 50], dtype=np.uint32),
+                       np.array([1, 100, 40, 100, 40], dtype=np.uint32),
+                       np.array([2, 100, 30, 100, 30], dtype=np.uint32),
+                       np.array([2, 100, 20, 40, 30, 0], dtype=np.uint32))
+        with self.subTest('Rules are partitioned by consequent item'):
+            shards = shard(suggestions, 2)
+            self.assertSequenceEqual([[int(data[0]) for data in shard_suggestions] for shard_suggestions in shards],
+                                     [[0, 2, 2], [1]])
+        with self.subTest('Shards without rules are rejected'):
+            self.assertRaises(ValueError, shard, suggestions, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
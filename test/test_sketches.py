@@ -0,0 +1,102 @@
+from collections import Counter
+import numpy as np
+import os.path as path
+from tempfile import TemporaryDirectory
+from time import monotonic, sleep
+import unittest
+from repositories import SketchRepository
+from sketches import *
+
+
+class TestSketches(unittest.TestCase):
+    def test_CountMinSketch(self):
+        generator = np.random.default_rng(0)
+        keys = generator.zipf(1.5, 10_000).astype(np.uint64)
+        sketch = CountMinSketch(256, 4)
+        sketch.add(keys)
+        unique_keys, counts = np.unique(keys, return_counts=True)
+        estimates = sketch.estimate(unique_keys)
+        with self.subTest('Counts are never underestimated'):
+            self.assertTrue(np.all(estimates >= counts))
+        with self.subTest('The most frequent keys are estimated closely'):
+            top = np.argsort(counts)[-10:]
+            self.assertTrue(np.all(estimates[top] <= counts[top] + 0.05 * len(keys)))
+
+    def test_HeavyHitters(self):
+        counts = Counter({key: key % 97 for key in range(1000)})
+        heavy_hitters = HeavyHitters(20)
+        for start in range(0, 1000, 100):
+            keys = np.arange(start, start + 100)
+            heavy_hitters.update(keys, np.array([counts[key] for key in keys.tolist()], float))
+        with self.subTest('The keys with the largest counts are tracked'):
+            self.assertEqual(sorted(heavy_hitters.counts.values()), sorted(counts.values())[-20:])
+        with self.subTest('Counts scale'):
+            heavy_hitters.scale(0.5)
+            self.assertEqual(sorted(heavy_hitters.counts.values()),
+                             [count / 2 for count in sorted(counts.values())[-20:]])
+        with self.subTest('Nothing is tracked without capacity'):
+            heavy_hitters = HeavyHitters(0)
+            heavy_hitters.update(np.arange(3), np.ones(3))
+            self.assertEqual(heavy_hitters.counts, {})
+
+    def test_OnlineRuleLearner(self):
+        # Products 0 and 1 are bought together, and 2 mostly on its own, less often with them than by chance.
+        baskets = [[0, 1]] * 50 + [[0, 1, 2]] * 5 + [[2]] * 45
+        with TemporaryDirectory() as directory:
+            sketch_repository = SketchRepository(path.join(directory, 'sketches.npz'))
+            learner = OnlineRuleLearner(3, item_sketch_width=64, pair_sketch_width=256, pair_capacity=16,
+                                        min_pair_count=5, sketch_repository=sketch_repository)
+            with self.subTest('Nothing is published before the first refresh'):
+                self.assertEqual(learner.get_rules(), {})
+                self.assertEqual(learner.version, 0)
+            learner.learn(baskets)
+            learner.refresh()
+            rules = learner.get_rules()
+            with self.subTest('Rules are learned for the pairs bought together more often than by chance'):
+                self.assertEqual(rules.keys(), {0, 1})
+                (suggestion,), consequent_items = rules[0]
+                self.assertEqual((suggestion.consequent_item, suggestion.antecedent_items), (1, (0,)))
+                self.assertTrue(np.array_equal(consequent_items, [1]))
+                self.assertAlmostEqual(suggestion.support, 0.55, 2)
+                self.assertAlmostEqual(suggestion.confidence, 1.0, 2)
+                self.assertAlmostEqual(suggestion.lift, 100 / 55, 2)
+            with self.subTest('Every refresh publishes a new generation'):
+                self.assertEqual(learner.version, 1)
+                self.assertEqual(learner.stats, {'generation': 1, 'learned_baskets': 100, 'dropped_baskets': 0,
+                                                 'rules': 2})
+            with self.subTest('Checkpointed sketches are carried on from'):
+                learner.checkpoint()
+                restored_learner = OnlineRuleLearner(3, item_sketch_width=64, pair_sketch_width=256, pair_capacity=16,
+                                                     min_pair_count=5, sketch_repository=sketch_repository)
+                self.assertEqual(restored_learner.get_rules().keys(), {0, 1})
+                self.assertAlmostEqual(restored_learner.get_rules()[0][0][0].lift, 100 / 55, 2)
+            with self.subTest('Sketches configured otherwise are ignored'):
+                other_learner = OnlineRuleLearner(3, item_sketch_width=32, sketch_repository=sketch_repository)
+                self.assertEqual(other_learner.get_rules(), {})
+
+    def test_OnlineRuleLearner_threaded(self):
+        with TemporaryDirectory() as directory:
+            order_log_file = path.join(directory, 'orders.log')
+            with open(order_log_file, 'w') as file:
+                file.write('0,1\n' * 10 + 'not a basket\n2\n3\n2,3,')  # The last line is yet to be finished.
+            learner = OnlineRuleLearner(4, item_sketch_width=64, pair_sketch_width=256, pair_capacity=16,
+                                        min_pair_count=5, refresh_interval=0.05, order_log_file=order_log_file)
+            learner.start()
+            try:
+                for _ in range(10):
+                    learner.observe([0, 1])
+                    learner.observe([2, 3])
+                deadline = monotonic() + 10
+                while learner.stats['rules'] < 4 and monotonic() < deadline:
+                    sleep(0.05)
+            finally:
+                learner.stop()
+            with self.subTest('Baskets observed and logged are learned from, whole lines only'):
+                self.assertEqual(learner.stats['learned_baskets'], 32)
+                self.assertEqual(learner.get_rules().keys(), {0, 1, 2, 3})
+            with self.subTest('Stopping twice does nothing'):
+                learner.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()